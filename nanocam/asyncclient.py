@@ -0,0 +1,399 @@
+import asyncio
+import json
+import sys
+import time
+from nanocam import framecodec, protocol
+from nanocam.globals import Protocol
+
+# asyncio version of MediaClient. Every request is a coroutine, so a single event loop can drive many servers:
+#
+#   clients = [AsyncMediaClient(host, 7200, '/home/media/') for host in hosts]
+#   loop = asyncio.get_event_loop()
+#   results = loop.run_until_complete(asyncio.gather(*[c.image_request(3, 5, timeout=30) for c in clients],
+#                                                    return_exceptions=True))
+#
+# Requests on one client are sent one at a time over its connection.  A request that times out or is cancelled
+# closes the connection, since the rest of its response can not be told apart from the next one; the next request
+# reconnects.  The server finishes a capture that was abandoned this way unless send_kill() is called.
+# Written for the asyncio of Python 3.6 (JetPack 4.x).
+
+
+class AsyncMediaClient:
+    def __init__(self, hostip='', port=0, media_path='', timeout=None):
+        self.hostip = hostip        # IP address of server
+        self.port = port            # Messaging port
+        self.media_port = 5004      # Media port
+        self.media_path = media_path
+        self.timeout = timeout      # Default timeout of each request in seconds, None waits forever
+        self.reader = None
+        self.writer = None
+        self.lock = None            # Serializes requests on the connection, created in the running loop
+        self.request_id = 0
+        self.WAIT_FOR_OK = False
+        self.vid = None
+        self.capture_report = None  # Capture times reported by the server for the last request with "at"
+        self.queue = {}             # Queue options added to image/video requests, see set_queue
+        self.queue_position = None  # Position in the server queue reported for the last request
+        self.codec = None           # (codec, JPEG quality) asked for with "opencv" requests, see set_codec
+        self.meter = framecodec.BandwidthMeter()    # Measured receive bandwidth, reported with codec "auto"
+
+    def set_hostip(self, host):
+        self.hostip = host
+
+    def set_msg_port(self, port):
+        self.port = port
+
+    def set_media_path(self, path):
+        self.media_path = path
+
+    def set_queue(self, enable=True, priority=0, deadline=None):
+        # Wait in the server queue when the camera is busy instead of receiving BUSY, see MediaClient.set_queue
+        self.queue = {}
+        if enable:
+            self.queue = {"queue": True, "priority": priority}
+            if deadline is not None:
+                self.queue["deadline"] = deadline
+
+    def set_codec(self, codec="auto", quality=90):
+        # Receive the frame arrays of "opencv" requests encoded with codec, see MediaClient.set_codec. Frames are
+        # decoded in the default executor
+        self.codec = (codec, quality) if codec is not None else None
+
+    def connected(self):
+        return self.writer is not None and not self.writer.transport.is_closing()
+
+    async def connect(self):
+        if not self.connected():
+            # The stream buffer limit sets how much is read ahead while a received block is written to disk
+            self.reader, self.writer = await asyncio.open_connection(self.hostip, self.port, limit=protocol.WRITE_SIZE)
+
+    async def close(self):
+        # Say goodbye to the server and close the connection
+        if self.connected():
+            self.writer.write(protocol.pack_header(Protocol.MSG_GOODBYE, 0))
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                pass
+        self.abort()
+
+    def abort(self):
+        # Close the connection without waiting for the rest of the response
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+    async def call(self, func, *args, timeout=None):
+        # Run the request coroutine func(*args) with exclusive use of the connection
+        # timeout - seconds, defaults to self.timeout. Raises asyncio.TimeoutError
+        if timeout is None:
+            timeout = self.timeout
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+
+        async def locked():
+            async with self.lock:
+                try:
+                    await self.connect()
+                    return await func(*args)
+                except asyncio.CancelledError:
+                    # Timed out or cancelled part way through the response, the connection can not be reused
+                    self.abort()
+                    raise
+                except (ConnectionError, asyncio.IncompleteReadError, protocol.ProtocolError):
+                    self.abort()
+                    raise
+
+        return await asyncio.wait_for(locked(), timeout)
+
+    async def send_request(self, message):
+        # Send JSON request to server tagged with a new request id
+        self.request_id = self.request_id % 0xFFFFFFFF + 1
+        if self.queue and message["type"] in ("image", "video"):
+            message = dict(message, **self.queue)
+            self.queue_position = None
+        if self.codec is not None and message.get("format") == "opencv":
+            message = dict(message, **framecodec.request_fields(self.codec[0], self.codec[1], self.meter.bandwidth))
+        payload = json.dumps(message).encode()
+        self.writer.write(protocol.pack_header(Protocol.MSG_JSON, len(payload), self.request_id) + payload)
+        await self.writer.drain()
+        return self.request_id
+
+    async def recv_header(self):
+        # Returns tuple of message type, request id, payload length
+        return protocol.unpack_header(await self.reader.readexactly(protocol.HEADER.size))
+
+    async def recv_msg(self):
+        # Returns tuple of message type, request id, payload. Notifications (e.g. the kill notification sent when a
+        # UDP stream ends) are skipped
+        while True:
+            msg_type, request_id, length = await self.recv_header()
+            payload = await self.reader.readexactly(length) if length else b""
+            if request_id != Protocol.NOTIFY_ID:
+                return msg_type, request_id, payload
+
+    async def recv_status(self):
+        # Wait for OK/BUSY response from server, skipping queue notifications
+        while True:
+            msg_type, request_id, payload = await self.recv_msg()
+            if msg_type != Protocol.MSG_JSON:
+                return msg_type
+            _json = json.loads(payload.decode())
+            if _json.get("type") == "queued":
+                self.queue_position = _json["position"]
+            elif _json.get("type") == "error":
+                print("{}: Server error: {}".format(self.hostip, _json.get("message")))
+            elif _json.get("type") != "expired":
+                return msg_type
+
+    async def recv_frame(self, length):
+        # Reads the payload of a MSG_FRAME into a newly allocated array. Returns tuple of timestamp, array
+        timestamp, dtype_str, ndim = protocol.FRAME.unpack(await self.reader.readexactly(protocol.FRAME.size))
+        dims = await self.reader.readexactly(ndim * protocol.FRAME_DIM.size)
+        arr = protocol.frame_array(dtype_str, dims, length)
+        view = memoryview(arr.reshape(-1)).cast('B')
+        pos = 0
+        while pos < len(view):
+            block = await self.reader.readexactly(min(protocol.WRITE_SIZE, len(view) - pos))
+            view[pos:pos + len(block)] = block
+            pos += len(block)
+
+        return timestamp, arr
+
+    async def recv_coded_frame(self, length):
+        # Reads the payload of a MSG_CODED_FRAME. Returns framecodec.CodedFrame
+        (codec,) = protocol.CODEC.unpack(await self.reader.readexactly(protocol.CODEC.size))
+        timestamp, dtype_str, ndim = protocol.FRAME.unpack(await self.reader.readexactly(protocol.FRAME.size))
+        dims = await self.reader.readexactly(ndim * protocol.FRAME_DIM.size)
+        size = length - protocol.CODEC.size - protocol.FRAME.size - len(dims)
+        if size < 0:
+            raise protocol.ProtocolError("Frame size does not match message length")
+        data = await self.reader.readexactly(size)
+        return framecodec.CodedFrame(timestamp, codec.rstrip(b"\0").decode(), protocol.frame_shape(dims),
+                                     protocol.frame_dtype(dtype_str), data)
+
+    async def recv_to_file(self, fname, length):
+        # Copy exactly length bytes from the connection to the file fname
+        with open(fname, 'wb', buffering=0) as f:
+            remaining = length
+            while remaining > 0:
+                block = await self.reader.readexactly(min(protocol.WRITE_SIZE, remaining))
+                f.write(block)
+                remaining -= len(block)
+
+        return length
+
+    def local_name(self, name):
+        # Map file name from server to a valid path in the local media directory
+        return self.media_path + name.split('/')[-1].replace(':', '+')
+
+    async def fetch_files(self, callback=None):
+        # Receive the files (or numpy arrays of MSG_FRAMEs) of a server response until MSG_END
+        # callback - function or coroutine function called with each item as soon as it has been received
+        # Sets WAIT_FOR_OK if the server is busy. Returns array of filenames/arrays
+        # Coded frames are decoded in the default executor while the rest of the response is received
+        loop = asyncio.get_event_loop()
+        items = []
+        tot_bytes = 0
+
+        while True:
+            msg_type, request_id, length = await self.recv_header()
+            t0 = time.perf_counter()
+
+            if msg_type == Protocol.MSG_BUSY:
+                self.WAIT_FOR_OK = True
+                return items
+
+            elif msg_type == Protocol.MSG_FILE:
+                (name_len,) = protocol.FILE_NAME.unpack(await self.reader.readexactly(protocol.FILE_NAME.size))
+                name = (await self.reader.readexactly(name_len)).decode()
+                item = self.local_name(name)
+                tot_bytes += await self.recv_to_file(item, length - protocol.FILE_NAME.size - name_len)
+
+            elif msg_type == Protocol.MSG_FRAME:
+                timestamp, item = await self.recv_frame(length)
+                tot_bytes += item.nbytes
+
+            elif msg_type == Protocol.MSG_CODED_FRAME:
+                frame = await self.recv_coded_frame(length)
+                tot_bytes += length
+                item = loop.run_in_executor(None, frame.decode)
+                if callback is not None:
+                    item = await item
+
+            elif msg_type == Protocol.MSG_END:
+                print("Received {} kB from {}".format(tot_bytes/1000, self.hostip))
+                return [(await item) if isinstance(item, asyncio.Future) else item for item in items]
+
+            elif msg_type == Protocol.MSG_JSON:
+                _json = json.loads((await self.reader.readexactly(length)).decode())
+                if _json.get("type") == "capture":
+                    self.capture_report = _json
+                elif _json.get("type") == "queued":
+                    self.queue_position = _json["position"]
+                elif _json.get("type") == "error":
+                    print("{}: Server error: {}".format(self.hostip, _json.get("message")))
+                continue
+
+            else:
+                # Discard unexpected messages (e.g. late kill notifications)
+                await self.reader.readexactly(length)
+                continue
+
+            self.meter.add(length, time.perf_counter() - t0)
+            items.append(item)
+            if callback is not None:
+                result = callback(item)
+                if asyncio.iscoroutine(result):
+                    await result
+
+    async def fetch_response(self, message, override, callback=None):
+        # Send message and receive its files, overriding a busy server if enabled
+        await self.send_request(message)
+        items = await self.fetch_files(callback)
+
+        if self.WAIT_FOR_OK:
+            self.WAIT_FOR_OK = False
+            if override and await self.kill():
+                items = await self.fetch_files(callback)
+            else:
+                print("{}: Server is busy, try again later or override".format(self.hostip))
+
+        return items
+
+    async def kill(self):
+        message = {"type": "kill"}
+        await self.send_request(message)
+        return await self.recv_status() == Protocol.MSG_OK
+
+    async def status_request(self, timeout=None):
+        # Returns dict describing the server state, e.g. {"busy": True, "clients": 2, "streaming": False}
+        async def request():
+            await self.send_request({"type": "status"})
+            msg_type, request_id, payload = await self.recv_msg()
+            return json.loads(payload.decode())
+
+        return await self.call(request, timeout=timeout)
+
+    async def metrics_request(self, format_="json", timeout=None):
+        # Returns the server metrics as a dict (format_="json") or Prometheus text (format_="prometheus")
+        async def request():
+            await self.send_request({"type": "metrics", "format": format_})
+            msg_type, request_id, payload = await self.recv_msg()
+            reply = json.loads(payload.decode())
+            return reply["text"] if format_ == "prometheus" else reply["metrics"]
+
+        return await self.call(request, timeout=timeout)
+
+    async def cached_image_request(self, timeout=None):
+        # Fetch the images from the most recent image capture on the server without using the camera
+        # Returns array of filenames
+        return await self.call(self.fetch_response, {"type": "cached_image"}, False, timeout=timeout)
+
+    async def image_request(self, frames, interval, width=3280, height=2464, override=False, callback=None,
+                            format_="file", at=None, timeout=None, max_age=None, crop=None):
+        # Fetch a series of images from the server camera
+        # Arguments as MediaClient.image_request, plus
+        # format_ - "file" to receive image files or "opencv" to receive numpy arrays
+        # at - server time (seconds since the epoch) to capture the first image. The server reports the capture
+        #      times, which are stored in self.capture_report
+        # timeout - seconds for the whole request, defaults to self.timeout
+        # max_age - accept a single image captured by the server up to max_age seconds ago, served from its cache
+        # Returns array of filenames (or arrays)
+        message = {"type": "image", "width": width, "height": height, "frames": frames, "interval": interval,
+                   "format": format_}
+        if callback is not None:
+            message["stream"] = True
+        if at is not None:
+            message["at"] = at
+            self.capture_report = None
+        if max_age is not None:
+            message["max_age"] = max_age
+        if crop is not None:
+            message["crop"] = list(crop)
+
+        return await self.call(self.fetch_response, message, override, callback, timeout=timeout)
+
+    async def video_request(self, duration, width=3280, height=2464, override=False, src="file", timeout=None,
+                            crop=None):
+        # Fetch a video from the server camera
+        # Arguments as MediaClient.video_request. With src="udp" the stream is received by a VideoStream running
+        # in the default executor
+        # Returns array of filenames
+        if src == "file":
+            message = {"type": "video", "width": width, "height": height, "duration": duration, "format": "file"}
+            if crop is not None:
+                message["crop"] = list(crop)
+            return await self.call(self.fetch_response, message, override, timeout=timeout)
+
+        elif src == "udp":
+            def make_stream():
+                from nanocam.tools import VideoStream
+                vid = VideoStream(duration, src="udp", sink="file")
+                vid.set_output_resolution(width, height)
+                vid.configure_udp_conn(port=self.media_port)
+                return vid
+
+            message = {"type": "video", "width": width, "height": height, "duration": duration, "format": "udp"}
+            if crop is not None:
+                message["crop"] = list(crop)
+            await self.call(self.udp_stream, message, make_stream, override, True, timeout=timeout)
+            return []
+
+        else:
+            print("Invalid source argument provided.  Valid options are \'file\' or \'udp\'.")
+            return []
+
+    async def hls_request(self, duration, hls_root, hls_playloc, hls_loc, width=3280, height=2464, override=False,
+                          hls_len=10, hls_maxfiles=10, hls_duration=5, timeout=None):
+        # Activate an HLS stream on the server
+        # Arguments as MediaClient.hls_request. Returns True once the stream has started
+        def make_stream():
+            from nanocam.tools import VideoStream
+            vid = VideoStream(duration, src="udp", sink="hls")
+            vid.set_output_resolution(width, height)
+            vid.configure_udp_conn(port=self.media_port)
+            vid.configure_hls(hls_len, hls_maxfiles, hls_duration, hls_root, hls_playloc, hls_loc)
+            return vid
+
+        message = {"type": "video", "width": width, "height": height, "duration": duration, "format": "udp"}
+        return await self.call(self.udp_stream, message, make_stream, override, False, timeout=timeout)
+
+    async def udp_stream(self, message, make_stream, override, wait):
+        # Request a UDP stream and receive it with the VideoStream returned by make_stream
+        # wait - wait for the stream to finish. Otherwise returns once it has started
+        if not sys.platform == 'linux':
+            print("UDP streams can only be received on Linux")
+            return False
+
+        loop = asyncio.get_event_loop()
+        self.vid = make_stream()
+        await self.send_request(message)
+        status = await self.recv_status()
+        if status == Protocol.MSG_BUSY:
+            if not (override and await self.kill()):
+                print("{}: Server is busy, try again later or override".format(self.hostip))
+                return False
+        elif status != Protocol.MSG_OK:
+            # Rejected or expired request
+            return False
+
+        stream = loop.run_in_executor(None, self.vid.start_stream)
+        if wait:
+            try:
+                await stream
+            except asyncio.CancelledError:
+                self.vid.Gstobj.quit()
+                raise
+        return True
+
+    async def send_timer_reset(self, duration, timeout=None):
+        async def request():
+            await self.send_request({"type": "reset_timer", "duration": str(duration)})
+
+        await self.call(request, timeout=timeout)
+
+    async def send_kill(self, timeout=None):
+        # Close the active pipeline on the server. Returns True if the server acknowledged
+        return await self.call(self.kill, timeout=timeout)
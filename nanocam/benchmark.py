@@ -0,0 +1,553 @@
+import argparse
+import contextlib
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread, Timer
+from nanocam import protocol
+from nanocam.globals import Protocol
+
+# Benchmarks for nanocam. Results are printed as JSON so that runs can be compared across commits
+# Usage: python -m nanocam.benchmark transfer --size 200
+
+
+def thread_cpu_time():
+    # CPU time (user + system) consumed by the calling thread
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def make_file(size_mb, directory=None):
+    # Create a temporary file of size_mb megabytes. Caller is responsible for removing it
+    block = os.urandom(1024 * 1024)
+    fd, path = tempfile.mkstemp(suffix='.mp4', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        for i in range(size_mb):
+            f.write(block)
+
+    return path
+
+
+def legacy_send(sock, path):
+    # File transfer loop used by MediaServer.send_files before the framed protocol
+    with open(path, "rb") as f:
+        data = f.read(1024)
+        while data:
+            sock.sendall(data)
+            data = f.read(1024)
+
+
+def drain(server, result):
+    # Receive and discard everything sent on the first accepted connection
+    conn, addr = server.accept()
+    buf = bytearray(protocol.BLOCK_SIZE)
+    total = 0
+    while True:
+        n = conn.recv_into(buf)
+        if n == 0:
+            break
+        total += n
+    conn.close()
+    result["bytes"] = total
+
+
+def bench_transfer(size_mb=200, repeat=3):
+    # Compare MB/s and sender CPU time of the file transfer paths over a loopback TCP connection
+    senders = {
+        "legacy": legacy_send,
+        "buffered": lambda sock, path: protocol.send_file(sock, path, zero_copy=False),
+        "sendfile": lambda sock, path: protocol.send_file(sock, path, zero_copy=True),
+    }
+
+    path = make_file(size_mb)
+    results = []
+    try:
+        for name, send in senders.items():
+            for i in range(repeat):
+                server = socket.socket()
+                server.bind(('127.0.0.1', 0))
+                server.listen(1)
+                received = {}
+                receiver = Thread(target=drain, args=(server, received))
+                receiver.start()
+
+                sock = socket.create_connection(server.getsockname())
+                cpu0 = thread_cpu_time()
+                t0 = time.perf_counter()
+                send(sock, path)
+                sock.shutdown(socket.SHUT_WR)
+                receiver.join()
+                wall = time.perf_counter() - t0
+                cpu = thread_cpu_time() - cpu0
+                sock.close()
+                server.close()
+
+                results.append({"bench": "transfer", "method": name, "run": i, "size_mb": size_mb,
+                                "bytes": received["bytes"], "wall_s": wall, "sender_cpu_s": cpu,
+                                "mb_per_s": size_mb / wall})
+    finally:
+        os.remove(path)
+
+    return results
+
+
+def legacy_fetch(sock, fname):
+    # Receive loop used by MediaClient.fetch_video before the framed protocol: <file bytes>QUIT
+    tot_bytes = 0
+    with open(fname, 'wb') as f:
+        while True:
+            data = sock.recv(1024)
+            if data.find(b"QUIT") != -1:
+                f.write(data[:-4])
+                return tot_bytes + len(data) - 4
+            f.write(data)
+            tot_bytes += len(data)
+
+
+def serve_file(server, path, legacy):
+    # Send path on the first accepted connection as a framed response, or raw followed by QUIT if legacy
+    conn, addr = server.accept()
+    if legacy:
+        with open(path, 'rb') as f:
+            conn.sendfile(f)
+        conn.sendall(b"QUIT")
+    else:
+        protocol.send_file(conn, path, request_id=1)
+        protocol.send_msg(conn, Protocol.MSG_END, request_id=1)
+    conn.close()
+
+
+def bench_fetch(size_mb=200, repeat=3):
+    # Compare client receive throughput of the legacy 1 kB recv loop with MediaClient.fetch_files over loopback.
+    # Both are fed by a sendfile server so that the client side is the bottleneck
+    from nanocam.mediaclient import MediaClient
+
+    path = make_file(size_mb)
+    out_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        for legacy in (True, False):
+            for i in range(repeat):
+                server = socket.socket()
+                server.bind(('127.0.0.1', 0))
+                server.listen(1)
+                sender = Thread(target=serve_file, args=(server, path, legacy))
+                sender.start()
+
+                client = MediaClient()
+                client.set_media_path(out_dir + '/')
+                client.sock = socket.create_connection(server.getsockname())
+                cpu0 = thread_cpu_time()
+                t0 = time.perf_counter()
+                if legacy:
+                    fname = os.path.join(out_dir, 'legacy.mp4')
+                    legacy_fetch(client.sock, fname)
+                else:
+                    fname = client.fetch_files(1)[0]
+                wall = time.perf_counter() - t0
+                cpu = thread_cpu_time() - cpu0
+                sender.join()
+                client.sock.close()
+                server.close()
+                received = os.path.getsize(fname)
+                os.remove(fname)
+
+                results.append({"bench": "fetch", "method": "legacy" if legacy else "fetch_files", "run": i,
+                                "size_mb": size_mb, "bytes": received, "wall_s": wall, "client_cpu_s": cpu,
+                                "mb_per_s": size_mb / wall})
+    finally:
+        os.remove(path)
+        os.rmdir(out_dir)
+
+    return results
+
+
+def bench_idle(duration=5):
+    # Process CPU usage while a live pipeline idles in the main loop, and latency from a kill request to the
+    # pipeline shutting down. Requires GStreamer (videotestsrc and fakesink)
+    from nanocam.globals import StreamStatus
+    from nanocam.tools import GstBackEnd, Gst
+
+    backend = GstBackEnd()
+    backend.init()
+    src = Gst.ElementFactory.make('videotestsrc', 'src')
+    src.set_property('is-live', True)
+    caps = Gst.ElementFactory.make('capsfilter', 'caps')
+    caps.set_property('caps', Gst.caps_from_string('video/x-raw, width=(int)64, height=(int)48, framerate=(fraction)1/1'))
+    sink = Gst.ElementFactory.make('fakesink', 'sink')
+    for elem in (src, caps, sink):
+        backend.pipeline.add(elem)
+    src.link(caps)
+    caps.link(sink)
+
+    stopped = {}
+
+    def request_kill():
+        time.sleep(duration)
+        stopped["cpu_s"] = time.process_time() - cpu0
+        stopped["t"] = time.perf_counter()
+        StreamStatus.LOCAL_KILL.set()
+
+    killer = Thread(target=request_kill)
+    cpu0 = time.process_time()
+    killer.start()
+    backend.start()
+    t_end = time.perf_counter()
+    killer.join()
+    StreamStatus.LOCAL_KILL.clear()
+
+    return [{"bench": "idle", "duration_s": duration, "cpu_s": stopped["cpu_s"],
+             "cpu_percent": 100 * stopped["cpu_s"] / duration, "kill_latency_s": t_end - stopped["t"]}]
+
+
+def bench_extract(width=3280, height=2464, frames=8, iterations=50):
+    # Frames per second and peak memory allocated when converting BGR appsink samples to numpy arrays with the
+    # legacy extract_dup() copy, a mapped view (MappedFrame) and a mapped copy (sample_to_array)
+    # Requires GStreamer (videotestsrc and appsink)
+    import numpy
+    import tracemalloc
+    from nanocam.tools import Gst, MappedFrame, sample_to_array
+
+    def extract_dup(sample):
+        buf = sample.get_buffer()
+        return numpy.ndarray((height, width, 3), buffer=buf.extract_dup(0, buf.get_size()), dtype=numpy.uint8)
+
+    def mapped_view(sample):
+        frame = MappedFrame(sample)
+        frame.release()
+
+    methods = {"extract_dup": extract_dup, "mapped_view": mapped_view, "mapped_copy": sample_to_array}
+
+    Gst.init(None)
+    pipeline = Gst.parse_launch('videotestsrc num-buffers={} ! video/x-raw, format=(string)BGR, width=(int){}, '
+                                'height=(int){} ! appsink name=sink sync=false'.format(frames, width, height))
+    sink = pipeline.get_by_name('sink')
+    pipeline.set_state(Gst.State.PLAYING)
+    samples = [sink.emit('pull-sample') for i in range(frames)]
+
+    results = []
+    for name, convert in methods.items():
+        t0 = time.perf_counter()
+        for i in range(iterations):
+            convert(samples[i % frames])
+        wall = time.perf_counter() - t0
+
+        tracemalloc.start()
+        convert(samples[0])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results.append({"bench": "extract", "method": name, "width": width, "height": height,
+                        "frames_per_s": iterations / wall, "peak_alloc_bytes_per_frame": peak})
+
+    pipeline.set_state(Gst.State.NULL)
+    return results
+
+
+def instrument(stream, runs):
+    # Time every pipeline built by a VideoStream/ImageStream. A dict is appended to runs for each pipeline with the
+    # perf_counter times at which it was built, reached PLAYING, delivered its first and last frame at the output
+    # caps, posted EOS and finished cleaning up
+    from nanocam.tools import Gst
+
+    create_elements = stream.create_elements
+    start = stream.Gstobj.start
+
+    def timed_create_elements():
+        t0 = time.perf_counter()
+        create_elements()
+        run = {"build_start": t0, "built": time.perf_counter(), "playing": None, "first_buffer": None,
+               "last_buffer": None, "buffers": 0, "eos": None, "stopped": None}
+        runs.append(run)
+        pipeline = stream.Gstobj.pipeline
+
+        def on_buffer(pad, info):
+            now = time.perf_counter()
+            if run["first_buffer"] is None:
+                run["first_buffer"] = now
+            run["last_buffer"] = now
+            run["buffers"] += 1
+            return Gst.PadProbeReturn.OK
+
+        pipeline.get_by_name('outcaps').get_static_pad('src').add_probe(Gst.PadProbeType.BUFFER, on_buffer)
+
+        # Sync messages are emitted from the posting thread, independent of the bus watch of GstBackEnd
+        def on_message(bus, msg):
+            if msg.type == Gst.MessageType.STATE_CHANGED and msg.src == pipeline:
+                old, new, pending = msg.parse_state_changed()
+                if new == Gst.State.PLAYING and run["playing"] is None:
+                    run["playing"] = time.perf_counter()
+            elif msg.type == Gst.MessageType.EOS and run["eos"] is None:
+                run["eos"] = time.perf_counter()
+
+        bus = pipeline.get_bus()
+        bus.enable_sync_message_emission()
+        bus.connect('sync-message', on_message)
+
+    def timed_start():
+        start()
+        if runs:
+            runs[-1]["stopped"] = time.perf_counter()
+
+    stream.create_elements = timed_create_elements
+    stream.Gstobj.start = timed_start
+
+
+def summarize_run(run, stop_request):
+    # Seconds between the events of an instrumented pipeline. stop_request is the time EOS was requested
+    def interval(a, b):
+        return b - a if a is not None and b is not None else None
+
+    fps = None
+    if run["buffers"] > 1:
+        fps = (run["buffers"] - 1) / (run["last_buffer"] - run["first_buffer"])
+
+    return {"build_s": interval(run["build_start"], run["built"]), "playing_s": interval(run["built"], run["playing"]),
+            "first_buffer_s": interval(run["built"], run["first_buffer"]), "frames": run["buffers"], "fps": fps,
+            "eos_s": interval(stop_request, run["eos"]), "cleanup_s": interval(run["eos"], run["stopped"])}
+
+
+def synthetic_camera(width, height, framerate):
+    # CSIcamera for pipelines built with the synthetic elements
+    from nanocam import tools
+
+    tools.use_synthetic_elements()
+    cam = tools.CSIcamera()
+    cam.set_resolution(width, height)
+    cam.set_framerate(framerate)
+    return cam
+
+
+def bench_video(sink="file", width=1280, height=720, framerate=30, duration=5, profile=False):
+    # Run a VideoStream with the synthetic elements for duration seconds, then stop it with a kill request
+    # Reports pipeline build time, time to PLAYING, first frame latency, sustained fps, EOS and cleanup time
+    # profile - add the per element PadProfiler summary
+    from nanocam import tools
+    from nanocam.globals import StreamStatus
+
+    cam = synthetic_camera(width, height, framerate)
+    out_dir = tempfile.mkdtemp()
+    vid = tools.VideoStream(0, src="camera", sink=sink)
+    vid.media_path = out_dir + '/'
+    vid.connect_camera(cam)
+    vid.set_output_resolution(width, height)
+    if sink == "opencv":
+        vid.set_ring_buffer(8)
+    if profile:
+        vid.enable_profiling()
+
+    runs = []
+    instrument(vid, runs)
+    stop = {}
+
+    def request_kill():
+        stop["t"] = time.perf_counter()
+        StreamStatus.LOCAL_KILL.set()
+
+    timer = Timer(duration, request_kill)
+    timer.start()
+    try:
+        out = vid.start_stream()
+    finally:
+        timer.cancel()
+        StreamStatus.LOCAL_KILL.clear()
+        tools.use_synthetic_elements(False)
+
+    size = 0
+    if sink == "file":
+        for fname in out:
+            if os.path.exists(fname):
+                size += os.path.getsize(fname)
+                os.remove(fname)
+    os.rmdir(out_dir)
+
+    result = {"bench": "pipeline", "pipeline": "video-" + sink, "width": width, "height": height,
+              "framerate": framerate, "duration_s": duration, "output_bytes": size}
+    result.update(summarize_run(runs[0], stop.get("t")))
+    if profile:
+        result["elements"] = vid.profile
+    return [result]
+
+
+def bench_image(sink="file", width=1280, height=720, framerate=30, frames=3, profile=False):
+    # Capture frames images with an ImageStream and the synthetic elements, one pipeline per image
+    # Reports the per image timings averaged over the images, and the total time per image
+    from nanocam import tools
+
+    cam = synthetic_camera(width, height, framerate)
+    out_dir = tempfile.mkdtemp()
+    imager = tools.ImageStream(frames, 0, sink=sink)
+    imager.media_path = out_dir + '/'
+    imager.connect_camera(cam)
+    imager.set_output_resolution(width, height)
+    if profile:
+        imager.enable_profiling()
+
+    runs = []
+    instrument(imager, runs)
+    t0 = time.perf_counter()
+    try:
+        out = imager.start_stream()
+    finally:
+        tools.use_synthetic_elements(False)
+    wall = time.perf_counter() - t0
+
+    if sink == "file":
+        for fname in out:
+            if os.path.exists(fname):
+                os.remove(fname)
+    for fname in os.listdir(out_dir):
+        os.remove(os.path.join(out_dir, fname))
+    os.rmdir(out_dir)
+
+    # The source stops itself after its warm-up frames, so EOS is timed from the last frame
+    summaries = [summarize_run(run, run["last_buffer"]) for run in runs]
+    result = {"bench": "pipeline", "pipeline": "image-" + sink, "width": width, "height": height,
+              "framerate": framerate, "images": len(runs), "s_per_image": wall / max(1, len(runs))}
+    for key in summaries[0] if summaries else []:
+        values = [summary[key] for summary in summaries if summary[key] is not None]
+        result[key] = sum(values) / len(values) if values else None
+    if profile:
+        result["elements"] = imager.profile
+    return [result]
+
+
+def bench_synthetic(width=1280, height=720, framerate=30, duration=5, size_mb=100):
+    # Pipelines and transport without a Jetson: video to file and appsink, JPEG images, and loopback transfers
+    results = []
+    results += bench_video("file", width, height, framerate, duration)
+    results += bench_video("opencv", width, height, framerate, duration)
+    results += bench_image("file", width, height, framerate)
+    results += bench_transfer(size_mb, repeat=1)
+    results += bench_fetch(size_mb, repeat=1)
+    return results
+
+
+# Modules that are only imported on first use (see nanocam.lazy)
+HEAVY_MODULES = ("cv2", "gi", "nanocam.tools", "numpy", "http.server")
+
+IMPORT_SCRIPT = """
+import json, resource, sys, time
+def rss():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize() // 1024
+rss0 = rss()
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+rss1 = rss()
+print(json.dumps({{"import_s": t1 - t0, "rss_kb": rss1 - rss0, "loaded": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def bench_imports(modules=("nanocam.mediaclient", "nanocam.mediaserver"), repeat=5):
+    # Cold import time and resident memory added by importing each module, in a fresh interpreter per run
+    # Reports the median over repeat runs and which heavy dependencies were loaded by the import
+    results = []
+    for module in modules:
+        runs = []
+        for i in range(repeat):
+            out = subprocess.check_output([sys.executable, "-c", IMPORT_SCRIPT.format(module=module,
+                                                                                     heavy=HEAVY_MODULES)])
+            runs.append(json.loads(out.decode()))
+        runs.sort(key=lambda run: run["import_s"])
+        median = runs[len(runs) // 2]
+        results.append({"bench": "imports", "module": module, "repeat": repeat, "import_ms": median["import_s"] * 1000,
+                        "rss_kb": median["rss_kb"], "heavy_loaded": median["loaded"]})
+
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m nanocam.benchmark")
+    sub = parser.add_subparsers(dest="bench")
+
+    p = sub.add_parser("transfer", help="loopback file transfer throughput")
+    p.add_argument("--size", type=int, default=200, help="file size in MB")
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = sub.add_parser("fetch", help="loopback client receive throughput")
+    p.add_argument("--size", type=int, default=200, help="file size in MB")
+    p.add_argument("--repeat", type=int, default=3)
+
+    p = sub.add_parser("idle", help="CPU usage of an idle pipeline and kill latency")
+    p.add_argument("--duration", type=int, default=5, help="seconds to run the pipeline")
+    p.add_argument("--max-cpu", type=float, default=None, help="fail if CPU usage exceeds this percentage")
+    p.add_argument("--max-kill-ms", type=float, default=None, help="fail if the kill latency exceeds this")
+
+    p = sub.add_parser("extract", help="numpy frame extraction from appsink samples")
+    p.add_argument("--width", type=int, default=3280)
+    p.add_argument("--height", type=int, default=2464)
+    p.add_argument("--iterations", type=int, default=50)
+
+    p = sub.add_parser("synthetic", help="pipelines with software elements in place of the camera, and transport")
+    p.add_argument("--width", type=int, default=1280)
+    p.add_argument("--height", type=int, default=720)
+    p.add_argument("--framerate", type=int, default=30)
+    p.add_argument("--duration", type=int, default=5, help="seconds to run each video pipeline")
+    p.add_argument("--size", type=int, default=100, help="transfer size in MB")
+
+    p = sub.add_parser("pipeline", help="a single pipeline with software elements in place of the camera")
+    p.add_argument("kind", choices=["video-file", "video-opencv", "image-file", "image-jpeg"])
+    p.add_argument("--width", type=int, default=1280)
+    p.add_argument("--height", type=int, default=720)
+    p.add_argument("--framerate", type=int, default=30)
+    p.add_argument("--duration", type=int, default=5, help="seconds to run a video pipeline")
+    p.add_argument("--frames", type=int, default=3, help="number of images")
+    p.add_argument("--profile", action="store_true", help="add per element latency and throughput")
+
+    p = sub.add_parser("imports", help="cold import time of the client and server modules")
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--max-ms", type=float, default=None, help="fail if any import takes longer than this")
+    p.add_argument("--no-heavy", action="store_true", help="fail if an import loads OpenCV, GStreamer or numpy")
+
+    args = parser.parse_args(argv)
+    status = 0
+
+    # Pipelines print progress messages, keep stdout for the results
+    with contextlib.redirect_stdout(sys.stderr):
+        if args.bench == "transfer":
+            results = bench_transfer(args.size, args.repeat)
+        elif args.bench == "fetch":
+            results = bench_fetch(args.size, args.repeat)
+        elif args.bench == "extract":
+            results = bench_extract(args.width, args.height, iterations=args.iterations)
+        elif args.bench == "idle":
+            results = bench_idle(args.duration)
+            if args.max_cpu is not None and results[0]["cpu_percent"] > args.max_cpu:
+                print("Idle CPU usage {:.1f}% exceeds {}%".format(results[0]["cpu_percent"], args.max_cpu))
+                status = 1
+            if args.max_kill_ms is not None and 1000 * results[0]["kill_latency_s"] > args.max_kill_ms:
+                print("Kill latency {:.0f} ms exceeds {} ms".format(1000 * results[0]["kill_latency_s"], args.max_kill_ms))
+                status = 1
+        elif args.bench == "imports":
+            results = bench_imports(repeat=args.repeat)
+            for result in results:
+                if args.max_ms is not None and result["import_ms"] > args.max_ms:
+                    status = 1
+                if args.no_heavy and result["heavy_loaded"]:
+                    status = 1
+        elif args.bench == "synthetic":
+            results = bench_synthetic(args.width, args.height, args.framerate, args.duration, args.size)
+        elif args.bench == "pipeline":
+            kind, sink = args.kind.split("-")
+            if kind == "video":
+                results = bench_video(sink, args.width, args.height, args.framerate, args.duration, args.profile)
+            else:
+                results = bench_image(sink, args.width, args.height, args.framerate, args.frames, args.profile)
+        else:
+            parser.print_help()
+            return 1
+
+    json.dump(results, sys.stdout, indent=2)
+    print()
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
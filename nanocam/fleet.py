@@ -0,0 +1,127 @@
+import asyncio
+import time
+from nanocam.asyncclient import AsyncMediaClient
+
+# Synchronised capture on many media servers.  A FleetClient keeps a connection to every server and sends each of
+# them the same image request with a shared target time, so all cameras fire together instead of one after another:
+#
+#   fleet = FleetClient(['192.168.1.1', '192.168.1.2'], 7200, '/home/media/')
+#   loop = asyncio.get_event_loop()
+#   loop.run_until_complete(fleet.connect())
+#   result = loop.run_until_complete(fleet.capture(width=1920, height=1080, delay=1.0))
+#   print(result["skew_s"], result["failures"])
+#
+# The target time is translated to the clock of each server with an offset estimated from status requests, so the
+# servers do not need synchronised clocks, although NTP on all of them gives the best estimate.  Cameras fire at the
+# target only when the servers run a capture service (MediaServer.enable_capture_service); otherwise each server
+# first has to start its camera pipeline.
+
+
+class FleetClient:
+    def __init__(self, hosts, port=7200, media_path='', timeout=None):
+        # hosts - list of server IP addresses
+        # media_path - directory for saving images, a subdirectory per host is not created so file names may clash
+        # timeout - default timeout of each request in seconds
+        self.clients = {host: AsyncMediaClient(host, port, media_path, timeout) for host in hosts}
+        self.offsets = {}   # Server clock minus local clock of each host in seconds
+        self.rtts = {}      # Round trip time of the status request used for the offset
+
+    async def connect(self, samples=3, timeout=5):
+        # Connect to all servers and estimate their clock offsets
+        # samples - status requests per server, the one with the shortest round trip is used
+        # Returns dict of host: exception for the servers that could not be reached
+        hosts = list(self.clients)
+        results = await asyncio.gather(*[self.sync_clock(host, samples, timeout) for host in hosts],
+                                       return_exceptions=True)
+        return {host: result for host, result in zip(hosts, results) if isinstance(result, Exception)}
+
+    async def sync_clock(self, host, samples=3, timeout=5):
+        # Estimate the clock offset of host from the time reported in status responses
+        client = self.clients[host]
+        best = None
+        for i in range(samples):
+            t0 = time.time()
+            status = await client.status_request(timeout=timeout)
+            t1 = time.time()
+            if "time" not in status:
+                break
+            if best is None or t1 - t0 < best[0]:
+                best = (t1 - t0, status["time"] - (t0 + t1) / 2)
+
+        if best is not None:
+            self.rtts[host], self.offsets[host] = best
+        return self.offsets.get(host, 0.0)
+
+    async def capture(self, frames=1, interval=1, width=3280, height=2464, format_="file", delay=1.0,
+                      override=False, timeout=None, callback=None):
+        # Capture on all servers starting at the same time
+        # delay - seconds from now to the target time, long enough for the request to reach every server
+        # timeout - seconds for each server to respond
+        # callback - called with the result of each server as soon as it has finished
+        # Returns dict:
+        #   target - target time (local clock, seconds since the epoch)
+        #   nodes - per server results in order of completion, see capture_node
+        #   skew_s - spread of the first capture times of the servers that reported them
+        #   failures - hosts that failed
+        target = time.time() + delay
+        tasks = [asyncio.ensure_future(self.capture_node(host, target, frames, interval, width, height, format_,
+                                                         override, timeout))
+                 for host in self.clients]
+
+        nodes = []
+        try:
+            for task in asyncio.as_completed(tasks):
+                node = await task
+                nodes.append(node)
+                if callback is not None:
+                    callback(node)
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        first = [node["captured"][0] for node in nodes if node["captured"]]
+        return {"target": target, "nodes": nodes, "skew_s": max(first) - min(first) if first else None,
+                "failures": [node["host"] for node in nodes if not node["ok"]]}
+
+    async def capture_node(self, host, target, frames, interval, width, height, format_, override, timeout):
+        # Returns dict:
+        #   host, ok, error - error message if the request failed
+        #   items - received filenames (or arrays)
+        #   latency_s - time from sending the request to receiving the last image
+        #   captured - capture times reported by the server, converted to the local clock
+        #   skew_s - first capture time minus target time
+        #   offset_s - estimated server clock offset
+        client = self.clients[host]
+        offset = self.offsets.get(host, 0.0)
+        node = {"host": host, "ok": False, "error": None, "items": [], "latency_s": None, "captured": [],
+                "skew_s": None, "offset_s": offset}
+
+        t0 = time.time()
+        try:
+            node["items"] = await client.image_request(frames, interval, width, height, override, format_=format_,
+                                                       at=target + offset, timeout=timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            node["error"] = "timed out"
+        except Exception as e:
+            node["error"] = "{}: {}".format(type(e).__name__, e)
+        node["latency_s"] = time.time() - t0
+
+        report = client.capture_report
+        if report is not None:
+            node["captured"] = [t - offset for t in report["captured"]]
+            if node["captured"]:
+                node["skew_s"] = node["captured"][0] - target
+
+        if node["error"] is None:
+            if node["items"]:
+                node["ok"] = True
+            else:
+                node["error"] = "no images received (server busy?)"
+
+        return node
+
+    async def close(self):
+        await asyncio.gather(*[client.close() for client in self.clients.values()], return_exceptions=True)
@@ -0,0 +1,202 @@
+import importlib.util
+from nanocam.lazy import LazyModule
+from nanocam.protocol import ProtocolError
+
+# Codecs for the frame arrays of "opencv" responses.  The client lists the codecs it can decode in "accept" and
+# asks for one in "codec"; the server answers with MSG_CODED_FRAME messages in the codec it picked (MSG_FRAME for
+# "raw").  "auto" lets the server pick from the bandwidth the client measured on earlier responses:
+#
+#   raw   - no encoding, cheapest CPU path for LAN clients
+#   lz4   - fast lossless compression (optional dependency: lz4)
+#   zstd  - stronger lossless compression (optional dependency: zstandard)
+#   png   - lossless image compression (OpenCV)
+#   jpeg  - lossy image compression at the requested quality (OpenCV), smallest payloads
+#
+# Dependencies are imported on first use, so that the server and client start without them
+
+numpy = LazyModule("numpy")
+cv2 = LazyModule("cv2")
+lz4_frame = LazyModule("lz4.frame")
+zstandard = LazyModule("zstandard")
+
+CODECS = ("raw", "lz4", "zstd", "png", "jpeg")
+
+# Module providing each codec
+MODULES = {"lz4": "lz4", "zstd": "zstandard", "png": "cv2", "jpeg": "cv2"}
+
+# Link bandwidths in bytes/s for the "auto" codec: raw above FAST_LINK, lossless compression above SLOW_LINK,
+# JPEG below
+FAST_LINK = 50e6
+SLOW_LINK = 5e6
+
+# Lossless frames are decompressed in blocks of this many bytes, so memory follows the data that is actually
+# decompressed rather than the shape a frame claims
+DECODE_BLOCK = 4 * 1024 * 1024
+
+available_codecs = None
+
+
+def installed(name):
+    try:
+        return importlib.util.find_spec(name) is not None
+    except ValueError:
+        # Already imported without a module spec
+        return True
+
+
+def available():
+    # Returns list of the codecs whose dependencies are installed
+    global available_codecs
+    if available_codecs is None:
+        available_codecs = [codec for codec in CODECS if codec not in MODULES or installed(MODULES[codec])]
+    return available_codecs
+
+
+def image_compatible(arr):
+    # PNG and JPEG only hold 8 bit images with 1, 3 or 4 channels (JPEG 1 or 3)
+    return arr.dtype == numpy.uint8 and (arr.ndim == 2 or (arr.ndim == 3 and arr.shape[2] in (1, 3, 4)))
+
+
+def choose(codec, accept=None, bandwidth=None):
+    # Returns the codec the server uses for a request
+    # codec - codec asked for by the client, or "auto"
+    # accept - codecs the client can decode, defaults to codec alone
+    # bandwidth - link bandwidth in bytes/s measured by the client, None if unknown
+    if accept is None:
+        accept = [codec]
+    usable = [c for c in available() if c in accept or c == "raw"]
+
+    if codec != "auto":
+        return codec if codec in usable else "raw"
+
+    if bandwidth is None or bandwidth >= FAST_LINK:
+        order = ("raw",)
+    elif bandwidth >= SLOW_LINK:
+        order = ("lz4", "zstd", "png")
+    else:
+        order = ("jpeg", "zstd", "lz4", "png")
+    for c in order:
+        if c in usable:
+            return c
+    return "raw"
+
+
+def encode(arr, codec, quality=90):
+    # Returns tuple of codec, encoded bytes-like object. Falls back to a lossless codec, or raw, for arrays the
+    # image codecs can not hold
+    if codec in ("png", "jpeg") and not image_compatible(arr):
+        codec = "zstd" if "zstd" in available() else "lz4" if "lz4" in available() else "raw"
+    if codec == "jpeg" and arr.ndim == 3 and arr.shape[2] == 4:
+        codec = "png"
+
+    arr = numpy.ascontiguousarray(arr)
+    if codec == "raw":
+        return codec, memoryview(arr.reshape(-1)).cast('B')
+    elif codec == "lz4":
+        return codec, lz4_frame.compress(arr, compression_level=0)
+    elif codec == "zstd":
+        return codec, zstandard.ZstdCompressor(level=1).compress(arr)
+    elif codec == "png":
+        ok, data = cv2.imencode('.png', arr, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+    else:
+        ok, data = cv2.imencode('.jpg', arr, [cv2.IMWRITE_JPEG_QUALITY, int(quality)])
+    if not ok:
+        raise ValueError("Failed to encode frame as {}".format(codec))
+    return codec, data
+
+
+def decode(data, codec, shape, dtype):
+    # Returns the array of shape and dtype encoded in data. Frames that do not decode to exactly that array raise
+    # ProtocolError, and decompression stops at the size of the array, so a corrupt or hostile frame can not make the
+    # client allocate more memory than the frame claims to hold
+    dtype = numpy.dtype(dtype)
+    size = int(numpy.prod(shape)) * dtype.itemsize
+    if codec == "raw":
+        buf = data
+    elif codec == "lz4":
+        try:
+            buf = decompress_lz4(data, size)
+        except RuntimeError as e:
+            raise ProtocolError("Invalid lz4 frame ({})".format(e))
+    elif codec == "zstd":
+        try:
+            buf = decompress_zstd(data, size)
+        except zstandard.ZstdError as e:
+            raise ProtocolError("Invalid zstd frame ({})".format(e))
+    elif codec in ("png", "jpeg"):
+        arr = cv2.imdecode(numpy.frombuffer(data, numpy.uint8), cv2.IMREAD_UNCHANGED)
+        if arr is None:
+            raise ProtocolError("Failed to decode {} frame".format(codec))
+        if arr.dtype != dtype or arr.nbytes != size:
+            raise ProtocolError("{} frame does not match shape {} and dtype {}".format(codec, shape, dtype))
+        return arr.reshape(shape)
+    else:
+        raise ProtocolError("Unknown frame codec {}".format(codec))
+
+    if len(buf) != size:
+        raise ProtocolError("{} frame does not match shape {} and dtype {}".format(codec, shape, dtype))
+    return numpy.frombuffer(buf, dtype).reshape(shape)
+
+
+def decompress_lz4(data, size):
+    # Returns at most size + 1 bytes of the lz4 frame data. Raises ProtocolError if the frame is truncated
+    decompressor = lz4_frame.LZ4FrameDecompressor()
+    buf = bytearray()
+    while not decompressor.eof and len(buf) <= size:
+        block = decompressor.decompress(data, max_length=min(DECODE_BLOCK, size + 1 - len(buf)))
+        data = b""
+        if not block and decompressor.needs_input:
+            raise ProtocolError("Truncated lz4 frame")
+        buf += block
+    return buf
+
+
+def decompress_zstd(data, size):
+    # Returns at most size + 1 bytes of the zstd frame data
+    reader = zstandard.ZstdDecompressor().stream_reader(data)
+    buf = bytearray()
+    while len(buf) <= size:
+        block = reader.read(min(DECODE_BLOCK, size + 1 - len(buf)))
+        if not block:
+            break
+        buf += block
+    return buf
+
+
+class CodedFrame:
+    # Frame received as MSG_CODED_FRAME, decoded with decode()
+    def __init__(self, timestamp, codec, shape, dtype, data):
+        self.timestamp = timestamp
+        self.codec = codec
+        self.shape = shape
+        self.dtype = dtype
+        self.data = data
+
+    def decode(self):
+        return decode(self.data, self.codec, self.shape, self.dtype)
+
+
+class BandwidthMeter:
+    # Moving average of the receive throughput of large messages, reported to the server with "auto" requests
+    MIN_BYTES = 256 * 1024  # Smaller messages are mostly latency
+
+    def __init__(self, weight=0.3):
+        self.weight = weight
+        self.bandwidth = None   # bytes/s, None until a large message has been received
+
+    def add(self, nbytes, seconds):
+        if nbytes < self.MIN_BYTES or seconds <= 0:
+            return
+        rate = nbytes / seconds
+        if self.bandwidth is None:
+            self.bandwidth = rate
+        else:
+            self.bandwidth += self.weight * (rate - self.bandwidth)
+
+
+def request_fields(codec, quality=90, bandwidth=None):
+    # Fields added to an "opencv" request by a client that decodes frames with this module
+    fields = {"codec": codec, "quality": quality, "accept": available()}
+    if codec == "auto" and bandwidth is not None:
+        fields["bandwidth"] = bandwidth
+    return fields
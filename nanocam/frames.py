@@ -0,0 +1,80 @@
+import numpy
+from threading import Lock
+from nanocam.globals import RingBuffer
+
+
+class FrameRing:
+    # Fixed capacity ring of frames backed by a single preallocated numpy block
+    # Frames are copied into the block as they arrive, so memory use is bounded by the capacity regardless of
+    # stream length.  If shape is None the block is allocated when the first frame arrives.
+
+    def __init__(self, capacity, shape=None, dtype=numpy.uint8, policy=RingBuffer.DROP_OLDEST):
+        self.capacity = capacity
+        self.policy = policy
+        self.dtype = dtype
+        self.block = None
+        self.timestamps = numpy.zeros(capacity, dtype=numpy.uint64)
+        self.head = 0           # Index of the next slot to write
+        self.count = 0          # Number of frames held
+        self.written = 0        # Frames stored since the last clear
+        self.dropped = 0        # Frames lost to the policy since the last clear
+        self.lock = Lock()
+        if shape is not None:
+            self.allocate(shape)
+
+    def allocate(self, shape):
+        self.block = numpy.empty((self.capacity,) + tuple(shape), dtype=self.dtype)
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        with self.lock:
+            self.head = 0
+            self.count = 0
+            self.written = 0
+            self.dropped = 0
+
+    def push(self, frame, timestamp=0):
+        # Copy frame into the ring. Returns False if the frame was discarded
+        with self.lock:
+            if self.block is None:
+                self.allocate(frame.shape)
+
+            if self.count == self.capacity:
+                self.dropped += 1
+                if self.policy == RingBuffer.DROP_NEWEST:
+                    return False
+            else:
+                self.count += 1
+
+            self.block[self.head] = frame
+            self.timestamps[self.head] = timestamp
+            self.head = (self.head + 1) % self.capacity
+            self.written += 1
+            return True
+
+    def indices(self, n=None):
+        # Slot indices of the last n frames (default all), oldest first
+        if n is None or n > self.count:
+            n = self.count
+        start = (self.head - n) % self.capacity
+        return [(start + i) % self.capacity for i in range(n)]
+
+    def latest(self, n=None):
+        # Returns a copy of the last n frames (default all) as an array of shape (n, height, width, channels)
+        with self.lock:
+            if self.block is None:
+                return numpy.empty((0,), dtype=self.dtype)
+            return self.block.take(self.indices(n), axis=0)
+
+    def view(self, n=None):
+        # Returns list of views of the last n frames (default all). The views are overwritten as new frames arrive
+        with self.lock:
+            if self.block is None:
+                return []
+            return [self.block[i] for i in self.indices(n)]
+
+    def latest_timestamps(self, n=None):
+        with self.lock:
+            return self.timestamps.take(self.indices(n))
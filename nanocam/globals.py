@@ -1,7 +1,10 @@
 
+from threading import Event
+
+
 class StreamStatus:
     LOCAL_BUSY = False
-    LOCAL_KILL = False
+    LOCAL_KILL = Event()    # Set to request that the active local stream shuts down
 
 
 class Camera:
@@ -37,3 +40,29 @@ class Camera:
     ENCODER_NVV4L2H265 = 5
     ENCODER_NVV4L2VP8 = 6
     ENCODER_NVV4L2VP9 = 7
+
+
+class Protocol:
+    # Framed messaging protocol shared by MediaServer and MediaClient
+    # Every message is a fixed header (magic, version, type, request id, payload length) followed by the payload
+    # Responses carry the id of the request they answer, so several requests can be in flight on one connection.
+    # NOTIFY_ID marks messages that do not belong to any request (e.g. the kill notification of close_pipeline)
+    MAGIC = b"NC"
+    VERSION = 3
+
+    MSG_JSON = 1        # JSON request or control message (e.g. {"type": "kill"})
+    MSG_OK = 2          # Request accepted
+    MSG_BUSY = 3        # Camera in use on server
+    MSG_FRAME = 4       # Frame header (timestamp, dtype, shape) followed by the raw C-contiguous array bytes
+    MSG_FILE = 5        # File name followed by file bytes
+    MSG_END = 6         # End of response
+    MSG_GOODBYE = 7     # Client is closing the connection
+    MSG_CODED_FRAME = 8  # Codec name and frame header followed by the encoded array bytes (see framecodec)
+
+    NOTIFY_ID = 0
+
+
+class RingBuffer:
+    # Policies for a full FrameRing
+    DROP_OLDEST = 0     # Overwrite the oldest frame
+    DROP_NEWEST = 1     # Discard the incoming frame
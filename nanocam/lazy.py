@@ -0,0 +1,20 @@
+import importlib
+
+# Heavy dependencies (OpenCV, GStreamer through nanocam.tools) are imported on first use, so that clients and
+# servers that never display images or build pipelines do not pay for them at import time
+
+
+class LazyModule:
+    # Stand-in for a module that is imported when one of its attributes is first accessed
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self, attr):
+        # Only called for attributes not found on the LazyModule itself
+        return getattr(self.load(), attr)
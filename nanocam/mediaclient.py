@@ -1,13 +1,18 @@
+import os
 import socket
-from threading import Thread
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock, Condition
 import time
 import json
-import cv2
 import sys
-import pickle, _pickle
+from nanocam import framecodec, protocol
+from nanocam.globals import Protocol
+from nanocam.lazy import LazyModule
 
-if sys.platform == 'linux':
-    from nanocam.tools import VideoStream
+# Imported on first display or UDP/HLS stream
+cv2 = LazyModule("cv2")
+tools = LazyModule("nanocam.tools")
 
 
 class MediaClient:
@@ -21,6 +26,19 @@ class MediaClient:
         self.thread2 = None
         self.WAIT_FOR_OK = False
         self.vid = None
+        self.request_id = 0      # Id of the last request sent
+        self.send_lock = Lock()
+        self.recv_cond = Condition()
+        self.reading = False     # A thread is reading a message from the socket
+        self.responses = {}      # Request id -> deque of received messages not yet consumed
+        self.header_buf = bytearray(protocol.HEADER.size)   # Reused for every message header
+        self.recv_buf = bytearray(protocol.WRITE_SIZE)      # Reused for file data, written to disk in full blocks
+        self.queue = {}          # Queue options added to image/video requests, see set_queue
+        self.queue_position = None  # Position in the server queue reported for the last request
+        self.codec = None        # (codec, JPEG quality) asked for with "opencv" requests, see set_codec
+        self.meter = framecodec.BandwidthMeter()    # Measured receive bandwidth, reported with codec "auto"
+        self.decode_workers = os.cpu_count() or 1   # Threads decoding the frames of fetch_files
+        self.decode_pool = None
 
     def set_hostip(self, host):
         self.hostip = host
@@ -31,24 +49,143 @@ class MediaClient:
     def set_media_path(self, path):
         self.media_path = path
 
+    def set_queue(self, enable=True, priority=0, deadline=None):
+        # Wait in the server queue when the camera is busy instead of receiving BUSY
+        # priority - higher priorities run first
+        # deadline - seconds the request may wait before the server gives up on it
+        self.queue = {}
+        if enable:
+            self.queue = {"queue": True, "priority": priority}
+            if deadline is not None:
+                self.queue["deadline"] = deadline
+
+    def set_codec(self, codec="auto", quality=90):
+        # Receive the frame arrays of "opencv" requests encoded with codec ("raw", "lz4", "zstd", "png", "jpeg" or
+        # "auto" to let the server choose from the measured bandwidth, see framecodec). None disables encoding
+        # quality - JPEG quality
+        self.codec = (codec, quality) if codec is not None else None
+
     def connect(self):
         # Check if socket is already connected
         try:
-            self.sock.send(b"OK")
+            self.sock.getpeername()
         except OSError:
             self.sock = socket.socket()
             self.sock.connect((self.hostip, self.port))
 
     def flush(self):
-        self.sock.send(b"GOODBYE")
+        protocol.send_msg(self.sock, Protocol.MSG_GOODBYE)
         self.sock.close()
 
+    def send_request(self, message):
+        # Send JSON request to server tagged with a new request id. Returns the request id
+        # Requests can be pipelined: send several, then read each response with fetch_files, recv_status or
+        # recv_json, from any thread and in any order
+        if self.queue and message["type"] in ("image", "video"):
+            message = dict(message, **self.queue)
+            self.queue_position = None
+        if self.codec is not None and message.get("format") == "opencv":
+            message = dict(message, **framecodec.request_fields(self.codec[0], self.codec[1], self.meter.bandwidth))
+        with self.send_lock:
+            # Id 0 is reserved for notifications
+            self.request_id = self.request_id % 0xFFFFFFFF + 1
+            protocol.send_json(self.sock, message, self.request_id)
+            return self.request_id
+
+    def recv_message(self):
+        # Read the next message from the socket. Files are written to the media path as they arrive
+        # Returns tuple of message type, request id, item (filename, array or payload), payload length
+        msg_type, request_id, length = protocol.recv_header(self.sock, self.header_buf)
+        t0 = time.perf_counter()
+
+        if msg_type == Protocol.MSG_FILE:
+            name, name_bytes = protocol.recv_file_name(self.sock)
+            item = self.local_name(name)
+            # Unbuffered file, the receive buffer already batches the writes
+            with open(item, 'wb', buffering=0) as f:
+                protocol.recv_to_file(self.sock, f, length - name_bytes, self.recv_buf)
+
+        elif msg_type == Protocol.MSG_FRAME:
+            timestamp, item = protocol.recv_frame(self.sock, length)
+
+        elif msg_type == Protocol.MSG_CODED_FRAME:
+            item = framecodec.CodedFrame(*protocol.recv_coded_frame(self.sock, length))
+
+        else:
+            item = bytes(protocol.recv_exact(self.sock, length)) if length else b""
+
+        self.meter.add(length, time.perf_counter() - t0)
+        return msg_type, request_id, item, length
+
+    def recv_response(self, request_id):
+        # Returns the next message of the response to request_id as tuple of message type, item, payload length
+        # Messages of other requests read in the meantime are kept until their owner asks for them. Only one thread
+        # reads from the socket at a time, the others wait for it to hand over their messages
+        with self.recv_cond:
+            while True:
+                messages = self.responses.get(request_id)
+                if messages:
+                    msg = messages.popleft()
+                    if not messages:
+                        del self.responses[request_id]
+                    return msg
+
+                if self.reading:
+                    self.recv_cond.wait()
+                    continue
+
+                self.reading = True
+                self.recv_cond.release()
+                try:
+                    msg_type, rid, item, length = self.recv_message()
+                finally:
+                    self.recv_cond.acquire()
+                    self.reading = False
+                    self.recv_cond.notify_all()
+
+                if rid == Protocol.NOTIFY_ID:
+                    # Notifications (e.g. late kill notifications of UDP streams) are not needed by any request
+                    continue
+                self.responses.setdefault(rid, deque()).append((msg_type, item, length))
+
+    def recv_status(self, request_id=None):
+        # Wait for OK/BUSY response from server
+        # request_id - request to wait for, defaults to the last request sent
+        if request_id is None:
+            request_id = self.request_id
+        msg_type, item, length = self.recv_response(request_id)
+        while msg_type == Protocol.MSG_JSON and self.queue_report(json.loads(item.decode())):
+            msg_type, item, length = self.recv_response(request_id)
+        return msg_type
+
+    def recv_json(self, request_id=None):
+        # Returns the JSON response of a status or metrics request
+        if request_id is None:
+            request_id = self.request_id
+        msg_type, item, length = self.recv_response(request_id)
+        return json.loads(item.decode())
+
+    def queue_report(self, _json):
+        # Handle a queue or error notification of the server. Returns False for other JSON messages
+        if _json.get("type") == "queued":
+            self.queue_position = _json["position"]
+            print("Request queued on server at position {}{}".format(
+                _json["position"], " (shared capture)" if _json.get("coalesced") else ""))
+            return True
+        elif _json.get("type") == "expired":
+            print("Request expired in the server queue")
+            return True
+        elif _json.get("type") == "error":
+            print("Server error: {}".format(_json.get("message")))
+            return True
+        return False
+
     def listen_for_close(self):
         # Deprecated
 
         print("Waiting for kill request from server to close UDP pipeline...")
-        data = self.sock.recv(1024).decode()
-        _json = json.loads(data)
+        msg_type, request_id, payload = protocol.recv_msg(self.sock)
+        _json = json.loads(payload.decode())
         if _json["type"] == "kill":
             print("Kill request received! Closing pipeline...")
             self.vid.Gstobj.quit()
@@ -70,7 +207,50 @@ class MediaClient:
 
         return status
 
-    def image_request(self, frames, interval, width=3280, height=2464, display=False, override=False):
+    def iter_images(self, frames, interval, width=3280, height=2464, override=False, max_age=None, crop=None):
+        # Stream a series of images from the server camera
+        # Yields the filename of each image as soon as it has been captured on the server and received, so the
+        # first image arrives one interval after the request instead of after the whole series
+        message = {"type": "image", "width": width, "height": height, "frames": frames, "interval": interval,
+                   "format": "file", "stream": True}
+        if max_age is not None:
+            message["max_age"] = max_age
+        if crop is not None:
+            message["crop"] = list(crop)
+        request_id = self.send_request(message)
+        for fname in self.iter_files(request_id):
+            yield fname
+
+        # iter_files call will check for b"BUSY" and set WAIT_FOR_OK flag if received
+        if self.WAIT_FOR_OK:
+            self.WAIT_FOR_OK = False
+            if override and self.send_kill():
+                for fname in self.iter_files(request_id):
+                    yield fname
+            else:
+                print("Server is busy, try again later or override")
+
+    def iter_arrays(self, frames, interval, width=3280, height=2464, override=False, crop=None):
+        # Stream a series of images from the server camera as numpy arrays
+        # Yields each image as soon as it has been captured on the server and received
+        message = {"type": "image", "width": width, "height": height, "frames": frames, "interval": interval,
+                   "format": "opencv", "stream": True}
+        if crop is not None:
+            message["crop"] = list(crop)
+        request_id = self.send_request(message)
+        for arr in self.iter_files(request_id):
+            yield arr
+
+        if self.WAIT_FOR_OK:
+            self.WAIT_FOR_OK = False
+            if override and self.send_kill():
+                for arr in self.iter_files(request_id):
+                    yield arr
+            else:
+                print("Server is busy, try again later or override")
+
+    def image_request(self, frames, interval, width=3280, height=2464, display=False, override=False, callback=None,
+                      max_age=None, crop=None):
         # Fetch a series of images from the server camera
         # frames - number of frames to capture
         # interval - time interval between frames
@@ -78,16 +258,29 @@ class MediaClient:
         # height - output height of retrieved frames
         # display - display images immediately upon receipt
         # override - issue command to server to immediately close any existing pipelines to process this one
+        # callback - called with each filename as soon as the image has been received
+        # max_age - accept a single image captured by the server up to max_age seconds ago, served from its cache
+        # crop - (left, top, right, bottom) rectangle of the camera image in pixels, scaled by the server to
+        #        width x height before encoding
         # Returns tuple of arrays - filenames, images
 
         fname = []
         img_array = []
 
-        # Request "file" pipeline to be opened on server
-        message = {"type": "image", "width": width, "height": height, "frames": frames, "interval": interval, "format": "file"}
-        _json_str = json.dumps(message)
-        self.sock.send(_json_str.encode())
-        fname = self.fetch_images()
+        if callback is not None:
+            for name in self.iter_images(frames, interval, width, height, override, max_age, crop):
+                fname.append(name)
+                callback(name)
+
+        else:
+            # Request "file" pipeline to be opened on server
+            message = {"type": "image", "width": width, "height": height, "frames": frames, "interval": interval, "format": "file"}
+            if max_age is not None:
+                message["max_age"] = max_age
+            if crop is not None:
+                message["crop"] = list(crop)
+            request_id = self.send_request(message)
+            fname = self.fetch_images(request_id)
 
         # fetch_images call will check for b"BUSY" and set WAIT_FOR_OK flag if received
         if self.WAIT_FOR_OK and not override:
@@ -97,7 +290,7 @@ class MediaClient:
         elif self.WAIT_FOR_OK and override:
             status = self.send_kill()
             if status:
-                fname = self.fetch_images()
+                fname = self.fetch_images(request_id)
 
         if display:
             for name in fname:
@@ -112,7 +305,7 @@ class MediaClient:
 
         return fname, img_array
 
-    def video_request(self, duration, width=3280, height=2464, display=False, override=False, src="file"):
+    def video_request(self, duration, width=3280, height=2464, display=False, override=False, src="file", crop=None):
         # Fetch a video from the server camera
         # duration - length of time to stream in seconds
         # width - output width of retrieved video
@@ -120,6 +313,7 @@ class MediaClient:
         # display - display video immediately upon receipt
         # override - issue command to server to immediately close any existing pipelines to process this one
         # src - select source for video stream on the client side (e.g. "file", "udp")
+        # crop - (left, top, right, bottom) rectangle of the camera image, see image_request
         # Returns tuple of arrays - filenames, images
 
         fname = []
@@ -129,9 +323,10 @@ class MediaClient:
         if src == "file":
             # Request "file" pipeline to be opened on server
             message = {"type": "video", "width": width, "height": height, "duration": duration, "format": "file"}
-            _json_str = json.dumps(message)
-            self.sock.send(_json_str.encode())
-            fname = self.fetch_video()
+            if crop is not None:
+                message["crop"] = list(crop)
+            request_id = self.send_request(message)
+            fname = self.fetch_video(request_id)
 
             # fetch_video call will check for b"BUSY" and set WAIT_FOR_OK flag if received
             if self.WAIT_FOR_OK and not override:
@@ -141,7 +336,7 @@ class MediaClient:
             elif self.WAIT_FOR_OK and override:
                 status = self.send_kill()
                 if status:
-                    fname = self.fetch_video()
+                    fname = self.fetch_video(request_id)
 
             if display:
                 print("Displaying video {}".format(fname[0]))
@@ -164,22 +359,26 @@ class MediaClient:
         # Stream via UDP to file on client using VideoStream class
         elif src == "udp":
             if sys.platform == 'linux':
-                self.vid = VideoStream(duration, src="udp", sink="file")
+                self.vid = tools.VideoStream(duration, src="udp", sink="file")
                 self.vid.set_output_resolution(width, height)
                 self.vid.configure_udp_conn(port=self.media_port)
 
                 # Request "udp" pipeline to be opened on server
                 message = {"type": "video", "width": width, "height": height, "duration": duration, "format": "udp"}
-                _json_str = json.dumps(message)
-                self.sock.send(_json_str.encode())
+                if crop is not None:
+                    message["crop"] = list(crop)
+                request_id = self.send_request(message)
 
                 # Wait for response from server
-                data = self.sock.recv(1024)
-                if data == b"OK":
+                status = self.recv_status(request_id)
+                if status == Protocol.MSG_OK:
                     self.WAIT_FOR_OK = False
                     self.start_threads()
-                elif data == b"BUSY":
+                elif status == Protocol.MSG_BUSY:
                     self.WAIT_FOR_OK = True
+                else:
+                    # Rejected or expired request
+                    return fname, img_array
 
                 # Issue override command if enabled and server is busy
                 if self.WAIT_FOR_OK and not override:
@@ -216,24 +415,23 @@ class MediaClient:
 
         # Request UDP pipeline from server
         message = {"type": "video", "width": width, "height": height, "duration": duration, "format": "udp"}
-        _json_str = json.dumps(message)
-        self.sock.send(_json_str.encode())
+        request_id = self.send_request(message)
 
         # Instantiate VideoStream object
         if sys.platform == 'linux':
-            self.vid = VideoStream(duration, src="udp", sink="hls")
+            self.vid = tools.VideoStream(duration, src="udp", sink="hls")
             self.vid.set_output_resolution(width, height)
             self.vid.configure_udp_conn(port=self.media_port)
             self.vid.configure_hls(hls_len, hls_maxfiles, hls_duration, hls_root, hls_playloc, hls_loc)
 
             # Wait for response from server
             print("Waiting for OK from server...",)
-            data = self.sock.recv(1024)
-            if data == b"OK":
+            status = self.recv_status(request_id)
+            if status == Protocol.MSG_OK:
                 print("OK! Starting stream.")
                 self.start_threads()
                 return True
-            elif data == b"BUSY":
+            elif status == Protocol.MSG_BUSY:
                 print("BUSY!")
                 if override:
 
@@ -247,20 +445,32 @@ class MediaClient:
                     print("Server is busy, try again later or override")
                     return False
 
+    def status_request(self):
+        # Returns dict describing the server state, e.g. {"busy": True, "clients": 2, "streaming": False}
+        return self.recv_json(self.send_request({"type": "status"}))
+
+    def metrics_request(self, format_="json"):
+        # Returns the server metrics as a dict (format_="json") or Prometheus text (format_="prometheus")
+        reply = self.recv_json(self.send_request({"type": "metrics", "format": format_}))
+        return reply["text"] if format_ == "prometheus" else reply["metrics"]
+
+    def cached_image_request(self):
+        # Fetch the images from the most recent image capture on the server without using the camera
+        # Returns array of filenames
+        return self.fetch_images(self.send_request({"type": "cached_image"}))
+
     def send_timer_reset(self, duration):
         message = {"type": "reset_timer", "duration": str(duration)}
-        _json_str = json.dumps(message)
-        self.sock.send(_json_str.encode())
+        self.send_request(message)
 
     def send_kill(self):
         # This function is called automatically whenever override flag is set to True
         print("Server is busy. Sending override command...")
         message = {"type": "kill"}
-        _json_str = json.dumps(message)
-        self.sock.send(_json_str.encode())
+        request_id = self.send_request(message)
         print("Waiting for OK...",)
-        data = self.sock.recv(1024)
-        if data == b"OK":
+        status = self.recv_status(request_id)
+        if status == Protocol.MSG_OK:
             print("OK!")
             self.WAIT_FOR_OK = False
             return True
@@ -268,117 +478,55 @@ class MediaClient:
             print("unknown response received.")
             return False
 
-    def fetch_images(self):
-        loop_count = 0
-        fname_complete = False
-        fname = b""
-        fdata = b""
-        fname_list_in = []
-        fname_list_out = []
+    def local_name(self, name):
+        # Map file name from server to a valid path in the local media directory
+        return self.media_path + name.split('/')[-1].replace(':', '+')
+
+    def fetch_images(self, request_id=None):
+        # Server response format: <MSG_FILE file1> <MSG_FILE file2> ... <MSG_END>
+        return self.fetch_files(request_id)
+
+    def fetch_video(self, request_id=None):
+        # Server response format: <MSG_FILE file> <MSG_END>
+        return self.fetch_files(request_id)
+
+    def fetch_files(self, request_id=None):
+        # Coded frames are decoded in parallel once the whole response has been received
+        items = list(self.iter_files(request_id, decode=False))
+        coded = [i for i, item in enumerate(items) if isinstance(item, framecodec.CodedFrame)]
+        if coded:
+            if self.decode_pool is None:
+                self.decode_pool = ThreadPoolExecutor(self.decode_workers)
+            for i, arr in zip(coded, self.decode_pool.map(framecodec.CodedFrame.decode, [items[i] for i in coded])):
+                items[i] = arr
+        return items
+
+    def iter_files(self, request_id=None, decode=True):
+        # Yields each file (or numpy array of a MSG_FRAME) of the server response as soon as it has been received
+        # request_id - request whose response is read, defaults to the last request sent
+        # decode - decode coded frames, otherwise they are yielded as framecodec.CodedFrame
+        if request_id is None:
+            request_id = self.request_id
         tot_bytes = 0
 
-        # Server response format: pickle([filename1, filename2 ... ])DONE<file1 bytes>MORE<file2 bytes>MORE...<filen bytes>QUIT
         while True:
-            data = self.sock.recv(1024)
-
-            # Check for BUSY or DONE response
-            if loop_count == 0:
-                if data.find(b"BUSY") != -1:
-                    self.WAIT_FOR_OK = True
-                    return fname_list_out
-                else:
-                    loop_count += 1
-            if data.find(b"DONE") != -1:
-                data_arr = data.split(b"DONE")
-                fname += data_arr[0]
-                fdata = data_arr[1]
-                tot_bytes += sys.getsizeof(fdata)
-                fname_complete = True
-                try:
-                    fname_list = pickle.loads(fname)
-                    for _file in fname_list:
-                        file_name = _file.split('/')[-1]
-                        file_name = file_name.replace(':', '+')
-                        fname_list_out.append(self.media_path + file_name)
-                except _pickle.UnpicklingError:
-                    print("Invalid pickle packet")
-                    return fname_list_out
-
-                f = open(fname_list_out[0], 'wb')
-                i = 0
-                f.write(fdata)
-            else:
-                if fname_complete:
-                    if data.find(b"MORE") != -1:
-                        i += 1
-                        data_arr = data.split(b"MORE")
-                        tot_bytes += sys.getsizeof(data_arr)
-                        f.write(data_arr[0])
-                        f.close()
-                        f = open(fname_list_out[i], 'wb')
-                        f.write(data_arr[1])
-                    elif data.find(b"QUIT") != -1:
-                        data = data[:-4]
-                        f.write(data)
-                        tot_bytes += sys.getsizeof(data)
-                        f.close()
-                        print("Received {} kB from server".format(tot_bytes/1000))
-                        return fname_list_out
-                    else:
-                        f.write(data)
-                        tot_bytes += sys.getsizeof(data)
-                else:
-                    fname += data
+            msg_type, item, length = self.recv_response(request_id)
 
-    def fetch_video(self):
+            if msg_type == Protocol.MSG_BUSY:
+                self.WAIT_FOR_OK = True
+                return
 
-        loop_count = 0
-        fname_complete = False
-        fname = b""
-        fdata = b""
-        fname_list = []
-        tot_bytes = 0
-
-        # Server response format: pickle([filename])DONE<file bytes>QUIT
-        while True:
-            data = self.sock.recv(1024)
-
-            # Check for BUSY or DONE response
-            if loop_count == 0:
-                if data.find(b"BUSY") != -1:
-                    self.WAIT_FOR_OK = True
-                    return fname_list
-                else:
-                    loop_count += 1
-            if data.find(b"DONE") != -1:
-                data_arr = data.split(b"DONE")
-                fname += data_arr[0]
-                fdata = data_arr[1]
-                tot_bytes += sys.getsizeof(fdata)
-                fname_complete = True
-                try:
-                    fname_list = pickle.loads(fname)
-                    fname_list[0] = fname_list[0].split('/')[-1]
-                    fname_list[0] = self.media_path + fname_list[0].replace(':', '+')
-                except _pickle.UnpicklingError:
-                    print("Invalid pickle packet")
-                    return fname_list
-                f = open(fname_list[0], 'wb')
-                f.write(fdata)
-            else:
-                if fname_complete:
-                    if data.find(b"QUIT") != -1:
-                        data = data[:-4]
-                        f.write(data)
-                        tot_bytes += sys.getsizeof(data)
-                        f.close()
-                        print("Received {} kB from server".format(tot_bytes/1000))
-                        return [fname_list[0]]
-                    else:
-                        f.write(data)
-                        tot_bytes += sys.getsizeof(data)
-                else:
-                    fname += data
+            elif msg_type in (Protocol.MSG_FILE, Protocol.MSG_FRAME):
+                tot_bytes += length
+                yield item
 
+            elif msg_type == Protocol.MSG_CODED_FRAME:
+                tot_bytes += length
+                yield item.decode() if decode else item
 
+            elif msg_type == Protocol.MSG_END:
+                print("Received {} kB from server".format(tot_bytes/1000))
+                return
 
+            elif msg_type == Protocol.MSG_JSON:
+                self.queue_report(json.loads(item.decode()))
@@ -1,9 +1,105 @@
-import pickle, _pickle
 import json
+import os
 import socket
-from threading import Thread
-from nanocam import tools, globals
-import sys
+import time
+import selectors
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread, Lock
+from nanocam import framecodec, globals, protocol
+from nanocam.globals import Protocol
+from nanocam.lazy import LazyModule
+from nanocam.metrics import REGISTRY
+from nanocam.scheduler import RequestScheduler, Waiter
+from nanocam.snapshotcache import Snapshot, SnapshotCache
+
+# GStreamer is imported when the server is created
+tools = LazyModule("nanocam.tools")
+
+
+def get_crop(_json):
+    # Crop rectangle (left, top, right, bottom) of a request, or None
+    crop = _json.get("crop")
+    if crop is None:
+        return None
+    left, top, right, bottom = [int(v) for v in crop]
+    if left < 0 or top < 0 or right <= left or bottom <= top:
+        raise ValueError("Invalid crop rectangle {}".format(crop))
+    return left, top, right, bottom
+
+
+class CameraLock:
+    # Lock held by the thread that is using the camera. A kill override applies to the current holder only:
+    # StreamStatus.LOCAL_KILL is set while the lock is held and cleared before the lock is handed to the next request
+
+    # Seconds the next request of the client holding the lock waits for it before being refused (see acquire_for)
+    OWNER_GRACE = 0.5
+
+    def __init__(self):
+        self.lock = Lock()
+        self.kill_lock = Lock()
+        self.owner = None           # Client whose request holds the lock, if known
+
+    def acquire(self, blocking=True, timeout=-1):
+        return self.lock.acquire(blocking, timeout)
+
+    def acquire_for(self, owner):
+        # Take the lock for a request of owner without waiting. A client may send its next request as soon as it
+        # has received the END of the previous one, just before that request releases the camera, so a request of
+        # the client holding the lock waits up to OWNER_GRACE seconds instead of being refused with BUSY
+        with self.kill_lock:
+            if self.lock.acquire(blocking=False):
+                self.owner = owner
+                return True
+            held_by_owner = self.owner is owner
+        if not (held_by_owner and self.lock.acquire(timeout=self.OWNER_GRACE)):
+            return False
+        self.owner = owner
+        return True
+
+    def release(self):
+        with self.kill_lock:
+            globals.StreamStatus.LOCAL_KILL.clear()
+            self.owner = None
+            self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def kill(self):
+        # Ask the holder to shut down its pipeline. Returns False if the camera is not in use
+        with self.kill_lock:
+            if not self.lock.locked():
+                return False
+            globals.StreamStatus.LOCAL_KILL.set()
+            return True
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+
+class ClientConnection:
+    # State for a single connected client. Replies can be sent from worker threads, so all writes to the
+    # socket must hold send_lock
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.send_lock = Lock()
+        self.buffer = bytearray()
+        self.last_json = {}         # Last request rejected with BUSY, processed if the client sends a kill
+        self.last_request_id = 0    # Request id of last_json, used for the response once it is processed
+
+    def read_messages(self):
+        # Read the data available on the socket without blocking. Returns list of complete messages
+        data = self.conn.recv(protocol.BLOCK_SIZE, socket.MSG_DONTWAIT)
+        if not data:
+            raise ConnectionError("Connection closed by peer")
+        self.buffer += data
+        return protocol.unpack_messages(self.buffer, protocol.MAX_REQUEST_SIZE)
+
 
 class MediaServer:
     def __init__(self, port):
@@ -11,127 +107,566 @@ class MediaServer:
         self.media_port = 5004      # Port for streaming media via UDP
         self.media_path = ''        # Working directory for server images/videos
         self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind(('0.0.0.0', self.port))
-        self.sock.listen(1)
-        self.CLIENT_CONNECTED = False
+        self.sock.listen(16)
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ)
+        self.wakeup = socket.socketpair()  # Written by shutdown() to stop the event loop
+        self.selector.register(self.wakeup[0], selectors.EVENT_READ)
+        self.serving = False
+        self.clients = {}           # Connected clients keyed by socket
+        self.camera_lock = CameraLock()     # Held by the worker thread that is using the camera
         self.THREAD_ACTIVE = False
-        self.WAIT_FOR_CLOSE = False
-        self.last_json = {}
         self.thread = None
-        self.conn = None
-        self.addr = None
+        self.stream_client = None   # Client receiving the active UDP stream
+        self.last_images = []       # Filenames of the most recent image capture
         self.vid = None
         self.timer = None
         self.csicam = tools.CSIcamera()
+        self.capture = None         # CaptureService keeping the camera pipeline warm between requests
+        self.stream_end = 0         # End time of a UDP stream served by the capture service
+        self.metrics = REGISTRY     # Metrics of the server and its pipelines
+        self.metrics_http = None
+        self.scheduler = RequestScheduler(self.run_job, self.expire_job, self.camera_lock, self.job_exclusive)
+        self.queue_requests = False  # Queue all image/video requests instead of replying BUSY
+        self.snapshots = SnapshotCache()  # Recent images served to requests with max_age
+        self.encode_workers = os.cpu_count() or 1  # Threads encoding frame arrays (see framecodec)
+        self.encode_pool = None     # Created on the first encoded response, once encode_workers is final
+        self.encode_lock = Lock()
+
+    def enable_capture_service(self):
+        # Keep the camera running between requests. Image and video requests are then served by attaching branches
+        # to the running pipeline, so they start without waiting for the camera and snapshots can be taken while
+        # a video is being recorded
+        self.capture = tools.CaptureService(self.csicam)
+        self.capture.media_path = self.media_path
+        self.capture.start()
+
+    def enable_metrics_http(self, port=9100):
+        # Serve the metrics for Prometheus at http://<server>:port/metrics (JSON at /metrics.json)
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import ThreadingMixIn
+
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/metrics':
+                    body = metrics.to_prometheus().encode()
+                    content_type = 'text/plain; version=0.0.4'
+                elif self.path == '/metrics.json':
+                    body = metrics.to_json().encode()
+                    content_type = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
 
-    def start(self):
+            def log_message(self, *args):
+                pass
 
-        while True:
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
 
-            # Establish socket connection with client [BLOCKING]
-            if not self.CLIENT_CONNECTED:
-                print("Waiting for remote client connection...",)
-                self.conn, self.addr = self.sock.accept()
-                print("Client connected!")
-                self.CLIENT_CONNECTED = True
+        self.metrics_http = Server(('0.0.0.0', port), Handler)
+        Thread(target=self.metrics_http.serve_forever, daemon=True).start()
 
-            # Receive requests from client [BLOCKING]
-            print("Listening for client requests...",)
+    def start(self):
+        # Event loop serving all connected clients. Requests that use the camera run in worker threads so that
+        # cheap requests (status, cached image, timer reset) are answered while a capture is in progress
+        print("Waiting for remote client connections...")
+        self.serving = True
+        while self.serving:
+            for key, mask in self.selector.select():
+                if key.fileobj is self.sock:
+                    self.accept()
+                elif key.fileobj is self.wakeup[0]:
+                    self.wakeup[0].recv(1)
+                else:
+                    self.service(key.data)
+        self.close_connections()
+
+    def shutdown(self):
+        # Stop the server from any thread. start() returns after disconnecting the clients. Requests that are being
+        # served finish on their worker threads, but no further frames are encoded
+        if self.serving:
+            self.serving = False
+            self.wakeup[1].send(b'\0')
+        else:
+            self.close_connections()
+
+        with self.encode_lock:
+            if self.encode_pool is not None:
+                self.encode_pool.shutdown(wait=False)
+        if self.capture is not None:
+            self.capture.stop()
+        if self.metrics_http is not None:
+            self.metrics_http.shutdown()
+            self.metrics_http.server_close()
+
+    def close_connections(self):
+        for client in list(self.clients.values()):
+            self.disconnect(client)
+        self.selector.close()
+        self.sock.close()
+        for sock in self.wakeup:
+            sock.close()
+
+    def accept(self):
+        conn, addr = self.sock.accept()
+        client = ClientConnection(conn, addr)
+        self.clients[conn] = client
+        self.selector.register(conn, selectors.EVENT_READ, client)
+        self.metrics.set("clients", len(self.clients))
+        print("Client {}:{} connected! ({} clients)".format(addr[0], addr[1], len(self.clients)))
+
+    def disconnect(self, client):
+        self.selector.unregister(client.conn)
+        del self.clients[client.conn]
+        client.conn.close()
+        self.metrics.set("clients", len(self.clients))
+        print("Client {}:{} disconnected! ({} clients)".format(client.addr[0], client.addr[1], len(self.clients)))
+
+    def service(self, client):
+        try:
+            messages = client.read_messages()
+        except BlockingIOError:
+            return
+        except (OSError, protocol.ProtocolError) as e:
+            print("Client connection closed! ({})".format(e))
+            self.disconnect(client)
+            return
+
+        for msg_type, request_id, payload in messages:
+            if msg_type == Protocol.MSG_GOODBYE:
+                print("Client object destroyed")
+                self.disconnect(client)
+                return
+            elif msg_type == Protocol.MSG_JSON:
+                try:
+                    _json = json.loads(payload.decode())
+                except (UnicodeDecodeError, json.decoder.JSONDecodeError):
+                    print("Error: Invalid JSON received from client")
+                    continue
+                self.handle_request(client, request_id, _json)
+            else:
+                print("Error: Unexpected message type {} received from client".format(msg_type))
+
+    def handle_request(self, client, request_id, _json):
+        # Valid requests:
+        # {type: "image", width: wwww, height: hhhh, frames: xx, interval: yy, format: "opencv"/"file", stream: true/false,
+        #  at: tt, max_age: ss, crop: [left, top, right, bottom]}
+        # {type: "video", width: wwww, height: hhhh, duration: xx, format: "opencv"/"file"/"udp", max_frames: nn,
+        #  crop: [left, top, right, bottom]}
+        # crop - rectangle of the camera image in pixels, cropped before scaling to width x height
+        # "opencv" requests may add {codec: "raw"/"lz4"/"zstd"/"png"/"jpeg"/"auto", quality: qq, accept: [...],
+        #  bandwidth: bb} to receive encoded frames, see frame_codec
+        # Image and video requests may add {queue: true, priority: pp, deadline: dd} to wait for the camera instead
+        # of receiving BUSY, see submit_request
+        # Malformed image and video requests are answered with <MSG_JSON {"type": "error", "message": "..."}> <MSG_END>
+        # {type: "kill"}
+        # {type: "reset_timer", duration: xx}
+        # {type: "status"}
+        # {type: "cached_image"}
+        # {type: "metrics", format: "json"/"prometheus"}
+        _type = _json.get("type")
+        received = time.perf_counter()
+        self.metrics.inc("requests_total", type=str(_type))
+
+        if _type in ("status", "cached_image", "metrics"):
+            self.dispatch(self.process_reply, client, request_id, _json)
+
+        elif _type == "reset_timer":
             try:
-                msg = self.conn.recv(1024).decode()
-            except ConnectionResetError:
-                self.CLIENT_CONNECTED = False
-            print("received new message!")
-
-            # Valid requests:
-            # {type: "image", width: wwww, height: hhhh, frames: xx, interval: yy, format: "opencv"/"file"}
-            # {type: "video", width: wwww, height: hhhh, duration: xx, format: "opencv"/"file"/"udp"}
-            # {type: "kill"}
-            # {type: "reset_timer", duration: xx}
-            _flag_VALIDMSG = False
-            _json = {}
-
-            # Check for valid JSON from client
+                duration = int(_json["duration"])
+            except (KeyError, TypeError, ValueError):
+                print("Error: Invalid timer reset received from client")
+                return
+            if self.capture is not None:
+                self.stream_end = time.time() + duration
+            elif self.vid is not None:
+                self.vid.Gstobj.update_timer(duration)
+
+        elif _type == "kill":
+            self.dispatch(self.process_kill, client, request_id)
+
+        elif _type in ("image", "video"):
             try:
-                _json = json.loads(msg)
-                _flag_VALIDMSG = True
-            except json.decoder.JSONDecodeError:
-                if msg == '':
-                    self.CLIENT_CONNECTED = False
-                    print("Client connection closed!")
-                elif msg == b"GOODBYE":
-                    self.CLIENT_CONNECTED = False
-                    print("Client object destroyed")
+                self.check_request(_json)
+            except (KeyError, TypeError, ValueError) as e:
+                message = "Missing field {}".format(e) if isinstance(e, KeyError) else str(e)
+                print("Error: Invalid {} request received from client ({})".format(_type, message))
+                self.dispatch(self.send_error, client, request_id, message)
+                return
+
+            # Fresh enough snapshots are served from memory without waiting for the camera
+            if _type == "image" and _json.get("max_age") is not None:
+                snap = self.cached_snapshot(_json)
+                if snap is not None:
+                    self.dispatch(self.send_cached, client, request_id, _json, snap)
+                    return
+            if _json.get("queue", self.queue_requests):
+                self.submit_request(client, request_id, _json, received)
+            else:
+                self.dispatch(self.process_request, client, request_id, _json, received)
+
+        else:
+            print("Error: Unknown request type {} received from client".format(_type))
+
+    def dispatch(self, target, *args):
+        # Run target on a new worker thread. The selector thread never writes to client sockets: a write blocks
+        # while another thread holds the client's send_lock for a transfer, which would stall every other client
+        Thread(target=target, args=args, daemon=True).start()
+
+    def process_reply(self, client, request_id, _json):
+        # Answer a status, cached_image or metrics request
+        _type = _json["type"]
+        try:
+            if _type == "status":
+                status = {"type": "status", "busy": self.camera_lock.locked(), "clients": len(self.clients),
+                          "streaming": self.THREAD_ACTIVE, "queued": len(self.scheduler),
+                          "codecs": framecodec.available(), "time": time.time()}
+                with client.send_lock:
+                    protocol.send_json(client.conn, status, request_id)
+
+            elif _type == "cached_image":
+                self.send_files(client, self.last_images, request_id)
+
+            elif _type == "metrics":
+                if _json.get("format") == "prometheus":
+                    reply = {"type": "metrics", "format": "prometheus", "text": self.metrics.to_prometheus()}
                 else:
-                    print("Error: Invalid JSON received from client")
-                    _flag_VALIDMSG = False
-
-            if _flag_VALIDMSG:
-
-                # Check for active local streams that require shutdown prior to fulfilling client request
-                if globals.StreamStatus.LOCAL_BUSY and _json["type"] != "kill":
-                    print("Stream already being processed on server. Sending BUSY response to client")
-                    self.last_json = _json
-                    self.conn.send(b"BUSY")
-                elif globals.StreamStatus.LOCAL_BUSY and _json["type"] == "kill":
-                    if self.last_json["format"] == "udp":
-                        print("Kill request received from client. Shutting down the pipeline!")
-                        self.conn.send(b"OK")
-                        _json = self.last_json
-                    globals.StreamStatus.LOCAL_KILL = True
-                    self.WAIT_FOR_CLOSE = True
-                elif "format" in _json:
-                    if not globals.StreamStatus.LOCAL_BUSY and _json["format"] == "udp":
-                        self.conn.send(b"OK")
-
-                # If kill command received from client, wait for pipeline to close before proceeding with request
-                print("Waiting for pipeline to close...",)
-                if self.WAIT_FOR_CLOSE:
-                    self.WAIT_FOR_CLOSE = False
-                    while globals.StreamStatus.LOCAL_BUSY:
-                        pass
-                    print("done!")
-
-                # Process request from client
-                if not globals.StreamStatus.LOCAL_BUSY:
-                    _type = _json["type"]
-                    _width = int(_json["width"])
-                    _height = int(_json["height"])
-                    _format = _json["format"]
-
-                    if _type == "image":
-                        _frames = int(_json["frames"])
-                        _interval = int(_json["interval"])
-                        ret_array = self.get_images(_width, _height, _frames, _interval, _format)
-
-                        if _format == "opencv":
-                            self.send_array(ret_array)
-
-                        elif _format == "file":
-                            # Send image filenames
-                            self.send_array(ret_array)
-
-                            # Send image files
-                            self.send_files(ret_array)
-
-                    elif _type == "video":
-                        _duration = int(_json["duration"])
-                        ret_array = self.get_video(_width, _height, _duration, _format)
-
-                        if _format == "opencv":
-                            self.send_array(ret_array)
-
-                        elif _format == "file":
-                            self.send_array(ret_array)
-                            self.send_files(ret_array)
-                # New
+                    reply = {"type": "metrics", "format": "json", "metrics": self.metrics.snapshot()}
+                with client.send_lock:
+                    protocol.send_json(client.conn, reply, request_id)
+        except OSError as e:
+            print("Error: Failed to send response to client ({})".format(e))
+
+    def check_request(self, _json):
+        # Validate the fields of an image or video request before it is queued or handed to a worker thread
+        # Raises KeyError, TypeError or ValueError for malformed requests
+        _type = _json["type"]
+        formats = ("opencv", "file") if _type == "image" else ("opencv", "file", "udp")
+        if _json["format"] not in formats:
+            raise ValueError("Unsupported {} format {}".format(_type, _json["format"]))
+        if int(_json["width"]) <= 0 or int(_json["height"]) <= 0:
+            raise ValueError("Invalid resolution {}x{}".format(_json["width"], _json["height"]))
+
+        if _type == "image":
+            if int(_json["frames"]) <= 0 or int(_json["interval"]) < 0:
+                raise ValueError("Invalid frames {} or interval {}".format(_json["frames"], _json["interval"]))
+            if _json.get("at") is not None:
+                float(_json["at"])
+            if _json.get("max_age") is not None and float(_json["max_age"]) < 0:
+                raise ValueError("Invalid max_age {}".format(_json["max_age"]))
+        else:
+            if int(_json["duration"]) < 0:
+                raise ValueError("Invalid duration {}".format(_json["duration"]))
+            if _json.get("max_frames") is not None and int(_json["max_frames"]) <= 0:
+                raise ValueError("Invalid max_frames {}".format(_json["max_frames"]))
+
+        int(_json.get("priority", 0))
+        if _json.get("deadline") is not None:
+            float(_json["deadline"])
+        get_crop(_json)
+        self.frame_codec(_json)
+
+    def snapshot_key(self, w, h, format_, crop=None):
+        return int(w), int(h), format_, crop, self.csicam.settings_key()
+
+    def cached_snapshot(self, _json):
+        # Returns the cached image for a single image request if one was captured less than max_age seconds ago with
+        # the same resolution, format and camera settings, or None if a capture is needed. The request must have
+        # passed check_request
+        if int(_json["frames"]) != 1 or _json.get("at") is not None:
+            return None
+        snap = self.snapshots.get(self.snapshot_key(_json["width"], _json["height"], _json["format"],
+                                                    get_crop(_json)), float(_json["max_age"]))
+        self.metrics.inc("snapshot_cache_hits_total" if snap is not None else "snapshot_cache_misses_total")
+        return snap
+
+    def send_cached(self, client, request_id, _json, snap):
+        # Answer an image request with a snapshot from the cache. Runs on a worker thread, since frames may have to be
+        # encoded and the transfer blocks
+        try:
+            with client.send_lock:
+                if snap.name is not None:
+                    tot_bytes = protocol.send_file_bytes(client.conn, snap.name, snap.data, request_id)
                 else:
+                    tot_bytes = self.write_frame(client, snap.data, request_id, codec=self.frame_codec(_json))
+                tot_bytes += protocol.send_msg(client.conn, Protocol.MSG_END, request_id=request_id)
+        except OSError as e:
+            print("Error: Failed to send response to client ({})".format(e))
+            return
+
+        self.metrics.inc("bytes_sent_total", tot_bytes)
+        print("Cached image sent! {} kB sent to client".format(tot_bytes/1000))
+
+    def cache_snapshot(self, w, h, format_, crop, item, captured=None):
+        # Keep the last image of a capture for requests with max_age
+        if item is None:
+            return
+        if captured is None:
+            captured = time.time()
+        if format_ == "file":
+            try:
+                with open(item, "rb") as f:
+                    snap = Snapshot(item, f.read(), captured)
+            except OSError:
+                return
+        else:
+            snap = Snapshot(None, item, captured)
+        self.snapshots.put(self.snapshot_key(w, h, format_, crop), snap)
+        self.metrics.set("snapshot_cache_bytes", self.snapshots.nbytes)
+
+    def process_kill(self, client, request_id):
+        # Shut down the active pipeline, then serve the request that the client was refused with BUSY
+        if self.camera_lock.kill():
+            print("Kill request received from client. Shutting down the pipeline!")
+
+        print("Waiting for pipeline to close...",)
+        with self.camera_lock:
+            print("done!")
+            self.camera_lock.owner = client
+            _json = client.last_json
+            client.last_json = {}
+            try:
+                self.send_status(client, Protocol.MSG_OK, request_id)
+                if _json:
+                    # Answered under the id of the refused request, so pipelining clients can tell it apart
+                    self.timed_request(client, client.last_request_id, _json)
+            except (OSError, protocol.ProtocolError) as e:
+                print("Error: Failed to send response to client ({})".format(e))
+
+    def process_request(self, client, request_id, _json, received=None):
+        # received - perf_counter time the request was received, for the queue wait metric
+        # Snapshots from the capture service do not need exclusive use of the camera
+        if self.capture is not None and _json["type"] == "image":
+            try:
+                self.timed_request(client, request_id, _json, received)
+            except (OSError, protocol.ProtocolError) as e:
+                print("Error: Failed to send response to client ({})".format(e))
+            return
+
+        # Check for active local streams that require shutdown prior to fulfilling client request
+        if not self.camera_lock.acquire_for(client):
+            print("Stream already being processed on server. Sending BUSY response to client")
+            self.metrics.inc("requests_busy_total", type=_json["type"])
+            client.last_json = _json
+            client.last_request_id = request_id
+            self.send_status(client, Protocol.MSG_BUSY, request_id)
+            return
+
+        try:
+            if _json["format"] == "udp":
+                self.send_status(client, Protocol.MSG_OK, request_id)
+            self.timed_request(client, request_id, _json, received)
+        except (OSError, protocol.ProtocolError) as e:
+            print("Error: Failed to send response to client ({})".format(e))
+        finally:
+            self.camera_lock.release()
+
+    def submit_request(self, client, request_id, _json, received):
+        # Queue a request until the camera is free. Higher priorities run first (default 0), and a request that has
+        # not started within deadline seconds of being received is answered with
+        # <MSG_JSON {"type": "expired"}> <MSG_END>. The client is told its place in the queue with
+        # <MSG_JSON {"type": "queued", "position": n, "coalesced": true/false}>, where position 1 runs next.
+        # Single snapshots with the same resolution and format that are waiting together share one capture
+        key = None
+        if (_json["type"] == "image" and int(_json.get("frames", 1)) == 1 and not _json.get("stream", False)
+                and _json.get("at") is None):
+            key = ("image", int(_json["width"]), int(_json["height"]), _json["format"], get_crop(_json),
+                   self.frame_codec(_json) if _json["format"] == "opencv" else None)
+        deadline = _json.get("deadline")
+        if deadline is not None:
+            deadline = received + float(deadline)
+
+        waiter = Waiter(client, request_id, deadline)
+        job, position, coalesced = self.scheduler.submit(waiter, _json, int(_json.get("priority", 0)), key, received)
+        self.metrics.set("request_queue_depth", len(self.scheduler))
+        if coalesced:
+            self.metrics.inc("requests_coalesced_total", type=_json["type"])
+        self.dispatch(self.send_queued, waiter, position, coalesced)
+
+    def send_queued(self, waiter, position, coalesced):
+        # Tell a client its place in the queue. The other messages of the request wait for waiter.notified, so the
+        # notification is always the first message of the response
+        try:
+            with waiter.client.send_lock:
+                protocol.send_json(waiter.client.conn, {"type": "queued", "position": position, "coalesced": coalesced},
+                                   waiter.request_id)
+        except OSError as e:
+            print("Error: Failed to send response to client ({})".format(e))
+        finally:
+            waiter.notified.set()
+
+    def job_exclusive(self, job):
+        # Snapshots from the capture service do not need exclusive use of the camera
+        return not (self.capture is not None and job.request["type"] == "image")
+
+    def run_job(self, job):
+        # Run a queued request once the camera is free, serving every request coalesced into it. The scheduler
+        # holds self.camera_lock for exclusive jobs
+        self.metrics.set("request_queue_depth", len(self.scheduler))
+        _json = job.request
+        if len(job.waiters) == 1:
+            waiter = job.waiters[0]
+            client, request_id = waiter.client, waiter.request_id
+            if self.job_exclusive(job):
+                self.camera_lock.owner = client
+            waiter.notified.wait()
+            try:
+                if _json["format"] == "udp":
+                    self.send_status(client, Protocol.MSG_OK, request_id)
+                self.timed_request(client, request_id, _json, job.received)
+            except (OSError, protocol.ProtocolError) as e:
+                print("Error: Failed to send response to client ({})".format(e))
+        else:
+            self.run_shared(job)
 
-                    if _json["type"] == "reset_timer":
-                        if self.vid is not None:
-                            self.vid.Gstobj.update_timer(int(_json["duration"]))
+    def run_shared(self, job):
+        # Capture one snapshot and send it to all waiters of a coalesced job
+        _json = job.request
+        _format = _json["format"]
+        labels = {"type": "image", "format": _format}
+        self.metrics.observe("request_queue_seconds", time.perf_counter() - job.received, **labels)
 
-    def get_images(self, w, h, frames, interval, format_):
+        _crop = get_crop(_json)
+        with self.metrics.timer("request_seconds", **labels):
+            try:
+                ret_array = self.get_images(int(_json["width"]), int(_json["height"]), 1,
+                                            int(_json.get("interval", 1)), _format, crop=_crop)
+            except Exception as e:
+                for waiter in job.waiters:
+                    waiter.notified.wait()
+                    self.fail_request(waiter.client, waiter.request_id, _json, e)
+                return
+            if ret_array:
+                self.cache_snapshot(_json["width"], _json["height"], _format, _crop, ret_array[-1])
+            if _format == "file":
+                self.last_images = ret_array
+
+            print("Sending shared snapshot to {} clients...".format(len(job.waiters)))
+            for waiter in job.waiters:
+                waiter.notified.wait()
+                try:
+                    if _format == "opencv":
+                        self.send_array(waiter.client, ret_array, waiter.request_id, codec=self.frame_codec(_json))
+                    else:
+                        self.send_files(waiter.client, ret_array, waiter.request_id)
+                except (OSError, protocol.ProtocolError) as e:
+                    print("Error: Failed to send response to client ({})".format(e))
+
+    def expire_job(self, job, waiters):
+        # Answer the waiters of job whose own deadline passed before the camera was free. The other waiters of a
+        # coalesced job stay queued
+        print("Queued request passed its deadline before the camera was free")
+        self.metrics.set("request_queue_depth", len(self.scheduler))
+        for waiter in waiters:
+            self.metrics.inc("requests_expired_total", type=job.request["type"])
+            waiter.notified.wait()
+            try:
+                with waiter.client.send_lock:
+                    protocol.send_json(waiter.client.conn, {"type": "expired"}, waiter.request_id)
+                    protocol.send_msg(waiter.client.conn, Protocol.MSG_END, request_id=waiter.request_id)
+            except OSError as e:
+                print("Error: Failed to send response to client ({})".format(e))
+
+    def timed_request(self, client, request_id, _json, received=None):
+        # run_request, recording the queue wait and wall time of the request
+        labels = {"type": _json["type"], "format": str(_json.get("format"))}
+        if received is not None:
+            self.metrics.observe("request_queue_seconds", time.perf_counter() - received, **labels)
+        with self.metrics.timer("request_seconds", **labels):
+            try:
+                self.run_request(client, request_id, _json)
+            except (OSError, protocol.ProtocolError):
+                raise
+            except Exception as e:
+                self.fail_request(client, request_id, _json, e)
+
+    def fail_request(self, client, request_id, _json, error):
+        # End the response of a request that failed on the server, so the client does not wait for MSG_END forever
+        print("Error: {} request failed ({})".format(_json["type"], error))
+        self.metrics.inc("requests_failed_total", type=_json["type"])
+        self.send_error(client, request_id, "Request failed: {}".format(error))
+
+    def run_request(self, client, request_id, _json):
+        # Process request from client. Caller must hold self.camera_lock
+        _type = _json["type"]
+        _width = int(_json["width"])
+        _height = int(_json["height"])
+        _format = _json["format"]
+        _crop = get_crop(_json)
+        _codec = self.frame_codec(_json) if _format == "opencv" else None
+
+        if _type == "image":
+            _frames = int(_json["frames"])
+            _interval = int(_json["interval"])
+            _stream = _json.get("stream", False)
+
+            # Synchronised requests start capturing at the server time "at" (seconds since the epoch) and report the
+            # time each image was captured in a MSG_JSON before the images
+            _at = _json.get("at")
+            captured = []
+            if _at is not None and globals.StreamStatus.LOCAL_KILL.wait(max(0.0, float(_at) - time.time())):
+                self.send_end(client, request_id)
+                return
+
+            def on_image(item):
+                captured.append(time.time())
+                if _stream:
+                    self.send_image(client, item, _format, request_id, _codec)
+
+            ret_array = self.get_images(_width, _height, _frames, _interval, _format, on_image, _crop)
+            if ret_array:
+                self.cache_snapshot(_width, _height, _format, _crop, ret_array[-1], captured[-1] if captured else None)
+            if _at is not None:
+                self.send_capture_report(client, float(_at), captured, request_id)
+
+            # Streaming requests receive each image as soon as it has been captured
+            if _stream:
+                self.send_end(client, request_id)
+                if _format == "file":
+                    self.last_images = ret_array
+                return
+
+            if _format == "opencv":
+                self.send_array(client, ret_array, request_id, codec=_codec)
+
+            elif _format == "file":
+                self.last_images = ret_array
+                self.send_files(client, ret_array, request_id)
+
+        elif _type == "video":
+            _duration = int(_json["duration"])
+            ret_array = self.get_video(client, _width, _height, _duration, _format, _json.get("max_frames"), _crop)
+
+            if _format == "opencv":
+                self.send_array(client, ret_array, request_id, codec=_codec)
+
+            elif _format == "file":
+                self.send_files(client, ret_array, request_id)
+
+            elif _format == "udp":
+                # Hold the camera until the UDP stream has finished or was killed, then tell the client to close
+                # its receiving pipeline
+                self.thread.join()
+                self.close_pipeline()
+                self.THREAD_ACTIVE = False
+                self.stream_client = None
+
+    def get_images(self, w, h, frames, interval, format_, on_image=None, crop=None):
+        # on_image - called with each image/filename as soon as it has been captured
+        # crop - (left, top, right, bottom) rectangle of the camera image, scaled to w x h
+
+        if self.capture is not None:
+            return self.get_snapshots(w, h, frames, interval, format_, on_image, crop)
 
         # Returns array of images to the client
         if format_ == "opencv":
@@ -140,6 +675,10 @@ class MediaServer:
             imager.connect_camera(self.csicam)
             imager.set_frames(frames)
             imager.set_interval(interval)
+            imager.set_output_resolution(w, h)
+            if crop is not None:
+                imager.set_crop(*crop)
+            imager.on_image = on_image
             img_arr = imager.start_stream()
             return img_arr
 
@@ -150,10 +689,90 @@ class MediaServer:
             imager.connect_camera(self.csicam)
             imager.set_frames(frames)
             imager.set_interval(interval)
+            imager.set_output_resolution(w, h)
+            if crop is not None:
+                imager.set_crop(*crop)
+            imager.on_image = on_image
             f_arr = imager.start_stream()
             return f_arr
 
-    def get_video(self, w, h, dur, format_):
+    def get_snapshots(self, w, h, frames, interval, format_, on_image=None, crop=None):
+        # Returns array of images (opencv) or filenames (file) captured from the running capture service
+        print("Processing image request [Capture service]...")
+        arr = []
+        for i in range(frames):
+            if i > 0 and globals.StreamStatus.LOCAL_KILL.wait(interval):
+                break
+            if format_ == "opencv":
+                item = self.capture.frame(w, h, crop)
+            else:
+                item = self.capture.save_snapshot(w, h, crop=crop)
+            if item is not None:
+                arr.append(item)
+                if on_image is not None:
+                    on_image(item)
+
+        return arr
+
+    def get_capture_video(self, client, w, h, dur, format_, max_frames=None, crop=None):
+        # Serve a video request by attaching a branch to the running capture service
+        if format_ == "opencv":
+            print("Processing video request [Capture service, OpenCV sink]...")
+            if max_frames is None:
+                img_arr = []
+                bid = self.capture.add_appsink(lambda sample: img_arr.append(tools.sample_to_array(sample)), w, h,
+                                               crop)
+                globals.StreamStatus.LOCAL_KILL.wait(dur)
+                self.capture.detach(bid, eos=False)
+                return img_arr
+
+            # Only the most recent max_frames frames are kept, copied from the mapped buffers into a preallocated ring
+            ring = tools.FrameRing(int(max_frames))
+
+            def on_sample(sample):
+                with tools.MappedFrame(sample) as frame:
+                    ring.push(frame.array, frame.pts)
+
+            bid = self.capture.add_appsink(on_sample, w, h, crop)
+            globals.StreamStatus.LOCAL_KILL.wait(dur)
+            self.capture.detach(bid, eos=False)
+            print("Ring buffer: {} frames stored, {} frames dropped".format(ring.written, ring.dropped))
+            self.metrics.inc("frames_dropped_total", ring.dropped, pipeline="capture", reason="ring")
+            return ring.latest()
+
+        elif format_ == "file":
+            print("Processing video request [Capture service, File sink]...")
+            bid, fname = self.capture.record(w, h, crop=crop)
+            globals.StreamStatus.LOCAL_KILL.wait(dur)
+            self.capture.detach(bid)
+            return [fname]
+
+        elif format_ == "udp":
+            print("Processing video request [Capture service, UDP sink]...")
+            bid = self.capture.stream_udp(client.addr[0], self.media_port, w, h, crop)
+            self.stream_end = time.time() + dur
+            self.stream_client = client
+            self.thread = Thread(target=self.wait_capture_stream, args=(bid,))
+            self.thread.start()
+            print("UDP pipeline opened. Streaming to client {}:{} for {} seconds.".format(client.addr[0], self.media_port, dur))
+            self.THREAD_ACTIVE = True
+            return []
+
+    def wait_capture_stream(self, bid):
+        # Keep the UDP branch attached until stream_end, which can be extended by reset_timer requests
+        remaining = self.stream_end - time.time()
+        while remaining > 0:
+            if globals.StreamStatus.LOCAL_KILL.wait(remaining):
+                break
+            remaining = self.stream_end - time.time()
+        self.capture.detach(bid)
+
+    def get_video(self, client, w, h, dur, format_, max_frames=None, crop=None):
+        # max_frames - for "opencv" requests, only the most recent max_frames frames are kept and returned
+        # crop - (left, top, right, bottom) rectangle of the camera image, scaled to w x h
+
+        if self.capture is not None:
+            return self.get_capture_video(client, w, h, dur, format_, max_frames, crop)
 
         # Returns array of images to the client
         if format_ == "opencv":
@@ -161,6 +780,10 @@ class MediaServer:
             vid = tools.VideoStream(dur, src="camera", sink="opencv")
             vid.connect_camera(self.csicam)
             vid.set_output_resolution(w, h)
+            if crop is not None:
+                vid.set_crop(*crop)
+            if max_frames is not None:
+                vid.set_ring_buffer(int(max_frames))
             img_arr = vid.start_stream()
             return img_arr
 
@@ -170,6 +793,8 @@ class MediaServer:
             vid = tools.VideoStream(dur, src="camera", sink="file")
             vid.connect_camera(self.csicam)
             vid.set_output_resolution(w, h)
+            if crop is not None:
+                vid.set_crop(*crop)
             f_arr = vid.start_stream()
             return f_arr
 
@@ -178,10 +803,13 @@ class MediaServer:
             self.vid = tools.VideoStream(dur, src="camera", sink="udp")
             self.vid.connect_camera(self.csicam)
             self.vid.set_output_resolution(w, h)
-            self.vid.configure_udp_conn(self.addr[0], self.media_port)
+            if crop is not None:
+                self.vid.set_crop(*crop)
+            self.vid.configure_udp_conn(client.addr[0], self.media_port)
+            self.stream_client = client
             self.thread = Thread(target=self.vid.start_stream, args=())
             self.thread.start()
-            print("UDP pipeline opened. Streaming to client {}:{} for {} seconds.".format(self.addr[0], self.media_port, dur))
+            print("UDP pipeline opened. Streaming to client {}:{} for {} seconds.".format(client.addr[0], self.media_port, dur))
             self.THREAD_ACTIVE = True
             return []
 
@@ -195,46 +823,113 @@ class MediaServer:
         return status
 
     def close_pipeline(self):
+        # Notify the client of the UDP stream that the stream has ended: <MSG_JSON {"type": "kill"}> with NOTIFY_ID
         print("Sending command to client to close pipeline...")
         _json = {"type": "kill"}
-        _json_str = json.dumps(_json)
-        self.conn.send(_json_str.encode())
-        self.timer.cancel()
-        self.timer = None
-        self.start()
-
-    def send_files(self, arr):
+        client = self.stream_client
+        if client is not None:
+            try:
+                with client.send_lock:
+                    protocol.send_json(client.conn, _json, Protocol.NOTIFY_ID)
+            except OSError as e:
+                print("Error: Failed to notify client of closed pipeline ({})".format(e))
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def send_status(self, client, msg_type, request_id):
+        with client.send_lock:
+            protocol.send_msg(client.conn, msg_type, request_id=request_id)
+
+    def send_files(self, client, arr, request_id):
+        # Response format: <MSG_FILE file1> <MSG_FILE file2> ... <MSG_END>
         print("Sending {} files to client...".format(len(arr)))
         tot_bytes = 0
 
-        for i, fname in enumerate(arr):
-            sendfile = open(fname, "rb")
-            data = sendfile.read(1024)
-            _bytes = sys.getsizeof(data)
-            while data:
-                self.conn.send(data)
-                data = sendfile.read(1024)
-                _bytes += sys.getsizeof(data)
-            sendfile.close()
-            tot_bytes += _bytes
-            _bytes = 0
-            if i != len(arr) - 1:
-                self.conn.send(b"MORE")
-            else:
-                self.conn.send(b"QUIT")
+        with client.send_lock:
+            for fname in arr:
+                tot_bytes += protocol.send_file(client.conn, fname, request_id)
+            tot_bytes += protocol.send_msg(client.conn, Protocol.MSG_END, request_id=request_id)
 
+        self.metrics.inc("bytes_sent_total", tot_bytes)
         print("Transfer complete! {} kB sent to client".format(tot_bytes/1000))
 
-    def send_array(self, arr):
-        print("Sending array to client...")
-        tot_bytes = sys.getsizeof(arr)
-
-        data = pickle.dumps(arr, protocol=2)
-        self.conn.sendall(data)
-        self.conn.send(b"DONE")
+    def send_image(self, client, item, format_, request_id, codec=None):
+        # Send a single image of a streaming request: <MSG_FILE file> or <MSG_FRAME image>
+        with client.send_lock:
+            if format_ == "file":
+                tot_bytes = protocol.send_file(client.conn, item, request_id)
+            else:
+                tot_bytes = self.write_frame(client, item, request_id, codec=codec)
+
+        self.metrics.inc("bytes_sent_total", tot_bytes)
+        print("Image sent! {} kB sent to client".format(tot_bytes/1000))
+
+    def frame_codec(self, _json):
+        # Returns (codec, JPEG quality) for the frame arrays of a request, negotiated from the codec the client asked
+        # for, the codecs it can decode and its measured bandwidth (see framecodec.choose)
+        codec = framecodec.choose(_json.get("codec", "raw"), _json.get("accept"), _json.get("bandwidth"))
+        return codec, int(_json.get("quality", 90))
+
+    def encode_frame(self, frame, codec):
+        # Returns tuple of the codec used, encoded bytes
+        with self.metrics.timer("frame_encode_seconds", codec=codec[0]):
+            used, data = framecodec.encode(frame, codec[0], codec[1])
+        self.metrics.inc("frames_encoded_total", codec=used)
+        return used, data
+
+    def write_frame(self, client, frame, request_id, timestamp=0, codec=None, encoded=None):
+        # Send one frame as MSG_FRAME, or MSG_CODED_FRAME if codec is not raw. Caller must hold client.send_lock
+        # encoded - result of encode_frame if the frame has already been encoded
+        if codec is None or codec[0] == "raw":
+            return protocol.send_frame(client.conn, frame, timestamp, request_id)
+        if encoded is None:
+            encoded = self.encode_frame(frame, codec)
+        used, data = encoded
+        if used == "raw":
+            return protocol.send_frame(client.conn, frame, timestamp, request_id)
+        return protocol.send_coded_frame(client.conn, data, used, frame.shape, frame.dtype, timestamp, request_id)
+
+    def send_capture_report(self, client, at, captured, request_id):
+        # <MSG_JSON {"type": "capture", "at": tt, "captured": [t1, t2, ...]}> with times in seconds since the epoch
+        report = {"type": "capture", "at": at, "captured": captured}
+        with client.send_lock:
+            protocol.send_json(client.conn, report, request_id)
+
+    def send_end(self, client, request_id):
+        with client.send_lock:
+            protocol.send_msg(client.conn, Protocol.MSG_END, request_id=request_id)
+
+    def send_error(self, client, request_id, message):
+        # <MSG_JSON {"type": "error", "message": "..."}> <MSG_END>
+        try:
+            with client.send_lock:
+                protocol.send_json(client.conn, {"type": "error", "message": message}, request_id)
+                protocol.send_msg(client.conn, Protocol.MSG_END, request_id=request_id)
+        except OSError as e:
+            print("Error: Failed to send response to client ({})".format(e))
+
+    def send_array(self, client, arr, request_id, timestamps=None, codec=None):
+        # Response format: <MSG_FRAME frame1> <MSG_FRAME frame2> ... <MSG_END>, or MSG_CODED_FRAMEs with a codec
+        # timestamps - optional capture time in ns of each frame
+        # codec - (codec, JPEG quality) from frame_codec. Frames are encoded on the worker pool, ahead of the frame
+        #         being sent
+        print("Sending {} frames to client...".format(len(arr)))
+        tot_bytes = 0
 
+        encoded = [None] * len(arr)
+        if codec is not None and codec[0] != "raw":
+            with self.encode_lock:
+                if self.encode_pool is None:
+                    self.encode_pool = ThreadPoolExecutor(self.encode_workers)
+            encoded = [self.encode_pool.submit(self.encode_frame, frame, codec) for frame in arr]
+
+        with client.send_lock:
+            for i, frame in enumerate(arr):
+                timestamp = int(timestamps[i]) if timestamps is not None else 0
+                tot_bytes += self.write_frame(client, frame, request_id, timestamp, codec,
+                                              encoded[i].result() if encoded[i] is not None else None)
+            tot_bytes += protocol.send_msg(client.conn, Protocol.MSG_END, request_id=request_id)
+
+        self.metrics.inc("bytes_sent_total", tot_bytes)
         print("Transfer complete! {} kB sent to client".format(tot_bytes/1000))
-
-
-
-
@@ -0,0 +1,154 @@
+import json
+import time
+from threading import Lock
+
+# Counters, gauges and latency histograms collected by GstBackEnd and MediaServer.  Read them with
+# REGISTRY.snapshot() (dict), REGISTRY.to_json() or REGISTRY.to_prometheus() (Prometheus text exposition format),
+# remotely with a {"type": "metrics"} request or over HTTP with MediaServer.enable_metrics_http
+
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Help text of the metrics recorded by nanocam
+DESCRIPTIONS = {
+    "pipeline_build_seconds": "Time to create and link the elements of a pipeline",
+    "pipeline_playing_seconds": "Time from requesting PLAYING until the pipeline reached PLAYING",
+    "pipeline_first_frame_seconds": "Time from requesting PLAYING until the first frame left the converter",
+    "pipeline_eos_seconds": "Time from sending EOS until the pipeline posted EOS",
+    "pipeline_run_seconds": "Time from requesting PLAYING until the pipeline was shut down",
+    "pipeline_errors_total": "Errors posted on pipeline buses",
+    "frames_processed_total": "Frames that left the converter of a pipeline",
+    "frames_dropped_total": "Frames dropped by warm-up filtering or full ring buffers",
+    "requests_total": "Requests received by the media server",
+    "requests_busy_total": "Requests refused with BUSY",
+    "requests_failed_total": "Requests that failed on the server, answered with an error",
+    "requests_coalesced_total": "Queued requests served by the capture of an identical queued request",
+    "requests_expired_total": "Queued requests that passed their deadline before the camera was free",
+    "request_queue_depth": "Requests waiting in the scheduler queue",
+    "request_queue_seconds": "Time from receiving a request until it started to run",
+    "request_seconds": "Time from a request starting to run until its response was sent",
+    "bytes_sent_total": "Bytes sent to clients",
+    "frames_encoded_total": "Frame arrays encoded for clients, by codec",
+    "frame_encode_seconds": "Time to encode one frame array for a client",
+    "snapshot_cache_hits_total": "Image requests with max_age answered from the snapshot cache",
+    "snapshot_cache_misses_total": "Image requests with max_age that needed a capture",
+    "snapshot_cache_bytes": "Size of the images in the snapshot cache",
+    "clients": "Connected clients",
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+class Metrics:
+    def __init__(self, prefix="nanocam"):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.counters = {}      # (name, labels) -> value
+        self.gauges = {}        # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., count, sum]
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = [0] * (len(BUCKETS) + 2)
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += 1
+            hist[-1] += value
+
+    def timer(self, name, **labels):
+        # Context manager observing the time spent in the block
+        return Timer(self, name, labels)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        # Returns dict of metric name: list of {"labels": {...}, "value": x} for counters and gauges, or
+        # {"labels": {...}, "count": n, "sum": s, "buckets": {bound: cumulative count}} for histograms
+        with self.lock:
+            out = {"time": time.time()}
+            for store in (self.counters, self.gauges):
+                for (name, labels), value in store.items():
+                    out.setdefault(name, []).append({"labels": dict(labels), "value": value})
+            for (name, labels), hist in self.histograms.items():
+                buckets = {str(bound): hist[i] for i, bound in enumerate(BUCKETS)}
+                out.setdefault(name, []).append({"labels": dict(labels), "count": hist[-2], "sum": hist[-1],
+                                                 "buckets": buckets})
+        return out
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for kind, store in (("counter", self.counters), ("gauge", self.gauges)):
+                for name in sorted({name for name, labels in store}):
+                    full = self.prefix + "_" + name
+                    if name in DESCRIPTIONS:
+                        lines.append("# HELP {} {}".format(full, DESCRIPTIONS[name]))
+                    lines.append("# TYPE {} {}".format(full, kind))
+                    for (n, labels), value in sorted(store.items()):
+                        if n == name:
+                            lines.append("{}{} {}".format(full, format_labels(labels), value))
+
+            for name in sorted({name for name, labels in self.histograms}):
+                full = self.prefix + "_" + name
+                if name in DESCRIPTIONS:
+                    lines.append("# HELP {} {}".format(full, DESCRIPTIONS[name]))
+                lines.append("# TYPE {} histogram".format(full))
+                for (n, labels), hist in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    for i, bound in enumerate(BUCKETS):
+                        lines.append("{}_bucket{} {}".format(full, format_labels(labels + (("le", bound),)), hist[i]))
+                    lines.append("{}_bucket{} {}".format(full, format_labels(labels + (("le", "+Inf"),)), hist[-2]))
+                    lines.append("{}_count{} {}".format(full, format_labels(labels), hist[-2]))
+                    lines.append("{}_sum{} {}".format(full, format_labels(labels), hist[-1]))
+
+        return "\n".join(lines) + "\n"
+
+
+class Timer:
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.t0 = None
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.t0, **self.labels)
+        return False
+
+
+# Registry shared by all pipelines and servers of the process
+REGISTRY = Metrics()
@@ -0,0 +1,289 @@
+import json
+import os
+import struct
+from nanocam.globals import Protocol
+
+# Header format: magic (2s), version (B), message type (B), request id (I), payload length (Q)
+HEADER = struct.Struct('!2sBBIQ')
+
+# File payloads are prefixed with the length of the UTF-8 encoded file name
+FILE_NAME = struct.Struct('!H')
+
+# Frame payloads are prefixed with timestamp in ns (Q), numpy dtype string (8s), number of dimensions (B), followed by
+# one Q per dimension. The array bytes are always C-contiguous, so the strides follow from dtype and shape
+FRAME = struct.Struct('!Q8sB')
+FRAME_DIM = struct.Struct('!Q')
+
+# Coded frame payloads are prefixed with the codec name (8s) followed by the frame prefix of the decoded array
+CODEC = struct.Struct('!8s')
+
+# Only plain numeric arrays are accepted from peers
+FRAME_KINDS = 'biuf'
+
+# Size of the blocks used to read from sockets and files
+BLOCK_SIZE = 256 * 1024
+
+# Size of the blocks written to disk when receiving files
+WRITE_SIZE = 1024 * 1024
+
+# Payloads smaller than this are sent in the same call as the header
+SMALL_PAYLOAD = 64 * 1024
+
+# Largest message accepted from a client. Requests are small JSON payloads, so a larger header is a corrupt or
+# hostile peer, which would otherwise make the server buffer the declared length in memory
+MAX_REQUEST_SIZE = 1024 * 1024
+
+# Stream files with the kernel sendfile call instead of reading them into Python
+USE_SENDFILE = True
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def pack_header(msg_type, length, request_id=0):
+    return HEADER.pack(Protocol.MAGIC, Protocol.VERSION, msg_type, request_id, length)
+
+
+def send_msg(sock, msg_type, payload=b"", request_id=0):
+    header = pack_header(msg_type, len(payload), request_id)
+    if len(payload) < SMALL_PAYLOAD:
+        sock.sendall(header + payload)
+    else:
+        sock.sendall(header)
+        sock.sendall(payload)
+
+    return HEADER.size + len(payload)
+
+
+def send_json(sock, obj, request_id=0):
+    return send_msg(sock, Protocol.MSG_JSON, json.dumps(obj).encode(), request_id)
+
+
+def send_file(sock, path, request_id=0, zero_copy=None):
+    # Sends a single file as MSG_FILE: <name length><name><file bytes>
+    # Returns the number of bytes written to the socket
+    name = os.path.basename(path).encode()
+    prefix = FILE_NAME.pack(len(name)) + name
+
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        sock.sendall(pack_header(Protocol.MSG_FILE, len(prefix) + size, request_id) + prefix)
+        sent = copy_file(sock, f, size, zero_copy)
+
+    if sent != size:
+        raise ProtocolError("File {} truncated while sending".format(path))
+
+    return HEADER.size + len(prefix) + sent
+
+
+def send_file_bytes(sock, name, data, request_id=0):
+    # Sends file contents held in memory as MSG_FILE, received like a file sent with send_file
+    # Returns the number of bytes written to the socket
+    name = os.path.basename(name).encode()
+    return send_msg(sock, Protocol.MSG_FILE, FILE_NAME.pack(len(name)) + name + data, request_id)
+
+
+def copy_file(sock, f, size, zero_copy=None):
+    # Copy size bytes from an open file to the socket. Returns the number of bytes sent
+    if size == 0:
+        return 0
+    if zero_copy is None:
+        zero_copy = USE_SENDFILE
+
+    # socket.sendfile uses os.sendfile where the platform supports it and falls back to send() otherwise.
+    # It does not accept non-blocking sockets, so those always take the buffered path
+    if zero_copy and sock.gettimeout() != 0.0:
+        return sock.sendfile(f, 0, size)
+
+    return send_buffered(sock, f, size)
+
+
+def send_buffered(sock, f, size):
+    buf = bytearray(min(BLOCK_SIZE, size))
+    view = memoryview(buf)
+    sent = 0
+    while sent < size:
+        n = f.readinto(view[:min(len(buf), size - sent)])
+        if not n:
+            break
+        sock.sendall(view[:n])
+        sent += n
+
+    return sent
+
+
+def send_frame(sock, arr, timestamp=0, request_id=0):
+    # Sends a numpy array as MSG_FRAME without copying it (unless it is not C-contiguous)
+    # Returns the number of bytes written to the socket
+    import numpy
+
+    arr = numpy.ascontiguousarray(arr)
+    meta = FRAME.pack(timestamp, arr.dtype.str.encode(), arr.ndim) + b"".join(FRAME_DIM.pack(d) for d in arr.shape)
+    sock.sendall(pack_header(Protocol.MSG_FRAME, len(meta) + arr.nbytes, request_id) + meta)
+    if arr.nbytes:
+        sock.sendall(memoryview(arr.reshape(-1)).cast('B'))
+
+    return HEADER.size + len(meta) + arr.nbytes
+
+
+def send_coded_frame(sock, data, codec, shape, dtype, timestamp=0, request_id=0):
+    # Sends the bytes-like data of an array of shape and dtype encoded with codec as MSG_CODED_FRAME
+    # Returns the number of bytes written to the socket
+    import numpy
+
+    data = memoryview(data).cast('B')
+    meta = (CODEC.pack(codec.encode()) + FRAME.pack(timestamp, numpy.dtype(dtype).str.encode(), len(shape))
+            + b"".join(FRAME_DIM.pack(d) for d in shape))
+    sock.sendall(pack_header(Protocol.MSG_CODED_FRAME, len(meta) + len(data), request_id) + meta)
+    if len(data):
+        sock.sendall(data)
+
+    return HEADER.size + len(meta) + len(data)
+
+
+def frame_dtype(dtype_str):
+    # Returns the numpy dtype of the dtype string of a frame prefix
+    import numpy
+
+    try:
+        dtype = numpy.dtype(dtype_str.rstrip(b"\0").decode())
+    except (TypeError, ValueError, UnicodeDecodeError):
+        raise ProtocolError("Invalid frame dtype received")
+    if dtype.kind not in FRAME_KINDS:
+        raise ProtocolError("Unsupported frame dtype {}".format(dtype))
+    return dtype
+
+
+def frame_shape(dims):
+    ndim = len(dims) // FRAME_DIM.size
+    return tuple(FRAME_DIM.unpack_from(dims, i * FRAME_DIM.size)[0] for i in range(ndim))
+
+
+def frame_array(dtype_str, dims, length):
+    # Allocate the array described by the dtype string and packed dimensions of a MSG_FRAME of length bytes
+    # The size is checked against the length before allocating, so a bogus shape can not exhaust memory
+    import math
+    import numpy
+
+    shape = frame_shape(dims)
+    dtype = frame_dtype(dtype_str)
+    if math.prod(shape) * dtype.itemsize != length - FRAME.size - len(dims):
+        raise ProtocolError("Frame size does not match message length")
+
+    return numpy.empty(shape, dtype=dtype)
+
+
+def recv_frame(sock, length):
+    # Reads the payload of a MSG_FRAME directly into a newly allocated array. Returns tuple of timestamp, array
+    timestamp, dtype_str, ndim = FRAME.unpack(recv_exact(sock, FRAME.size))
+    dims = recv_exact(sock, ndim * FRAME_DIM.size)
+    arr = frame_array(dtype_str, dims, length)
+    if arr.nbytes:
+        recv_into(sock, memoryview(arr.reshape(-1)).cast('B'))
+
+    return timestamp, arr
+
+
+def recv_coded_frame(sock, length):
+    # Reads the payload of a MSG_CODED_FRAME. Returns tuple of timestamp, codec, shape, dtype, encoded bytes
+    (codec,) = CODEC.unpack(recv_exact(sock, CODEC.size))
+    timestamp, dtype_str, ndim = FRAME.unpack(recv_exact(sock, FRAME.size))
+    dims = recv_exact(sock, ndim * FRAME_DIM.size)
+    size = length - CODEC.size - FRAME.size - len(dims)
+    if size < 0:
+        raise ProtocolError("Frame size does not match message length")
+
+    return (timestamp, codec.rstrip(b"\0").decode(), frame_shape(dims), frame_dtype(dtype_str),
+            recv_exact(sock, size))
+
+
+def recv_into(sock, view):
+    # Fill the writable buffer view completely from the socket
+    pos = 0
+    size = len(view)
+    while pos < size:
+        n = sock.recv_into(view[pos:], min(BLOCK_SIZE, size - pos))
+        if n == 0:
+            raise ConnectionError("Connection closed by peer")
+        pos += n
+
+
+def recv_exact(sock, length):
+    buf = bytearray(length)
+    recv_into(sock, memoryview(buf))
+    return buf
+
+
+def unpack_header(buf, offset=0):
+    # Returns tuple of message type, request id, payload length of the header at offset in buf
+    magic, version, msg_type, request_id, length = HEADER.unpack_from(buf, offset)
+    if magic != Protocol.MAGIC:
+        raise ProtocolError("Invalid message header received")
+    if version != Protocol.VERSION:
+        raise ProtocolError("Unsupported protocol version {}".format(version))
+
+    return msg_type, request_id, length
+
+
+def recv_header(sock, buf=None):
+    # Returns tuple of message type, request id, payload length
+    # buf - optional reusable bytearray of HEADER.size bytes
+    if buf is None:
+        buf = bytearray(HEADER.size)
+    recv_into(sock, memoryview(buf))
+    return unpack_header(buf)
+
+
+def recv_msg(sock):
+    # Returns tuple of message type, request id, payload
+    msg_type, request_id, length = recv_header(sock)
+    payload = bytes(recv_exact(sock, length)) if length else b""
+    return msg_type, request_id, payload
+
+
+def recv_file_name(sock):
+    # Reads the name prefix of a MSG_FILE payload. Returns tuple of name, number of bytes consumed
+    (name_len,) = FILE_NAME.unpack(recv_exact(sock, FILE_NAME.size))
+    name = bytes(recv_exact(sock, name_len)).decode()
+    return name, FILE_NAME.size + name_len
+
+
+def recv_to_file(sock, f, length, buf=None):
+    # Copy exactly length bytes from the socket to an open file
+    # buf - optional reusable bytearray. Each write to the file is a full buffer (default WRITE_SIZE bytes)
+    if buf is None:
+        buf = bytearray(max(1, min(WRITE_SIZE, length)))
+    view = memoryview(buf)
+    remaining = length
+    while remaining > 0:
+        block = view[:min(len(buf), remaining)]
+        recv_into(sock, block)
+
+        # Unbuffered files may accept less than a full block
+        written = 0
+        while written < len(block):
+            written += f.write(block[written:])
+        remaining -= len(block)
+
+    return length
+
+
+def unpack_messages(buf, max_length=None):
+    # Extract all complete messages from the bytearray buf, removing them from the buffer
+    # max_length - raise ProtocolError for a header declaring a longer payload, before it is buffered
+    # Returns list of tuples of message type, request id, payload
+    messages = []
+    pos = 0
+    while len(buf) - pos >= HEADER.size:
+        msg_type, request_id, length = unpack_header(buf, pos)
+        if max_length is not None and length > max_length:
+            raise ProtocolError("Message of {} bytes exceeds the limit of {} bytes".format(length, max_length))
+        if len(buf) - pos - HEADER.size < length:
+            break
+        start = pos + HEADER.size
+        messages.append((msg_type, request_id, bytes(buf[start:start + length])))
+        pos = start + length
+
+    del buf[:pos]
+    return messages
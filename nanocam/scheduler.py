@@ -0,0 +1,193 @@
+import heapq
+import itertools
+import time
+from threading import Condition, Event, Thread
+
+# Queue of camera requests for MediaServer.  Jobs run one at a time on a worker thread, highest priority first, then
+# earliest deadline, then in order of arrival.  Requests with the same coalescing key that are waiting in the queue
+# share a single job, so one capture serves all of them.  Jobs stay in the queue, where they can still be coalesced,
+# overtaken and expired, until the lock they need is free.  A separate thread expires requests as soon as their
+# deadline passes, also while a long job is running.
+
+
+class Waiter:
+    # A request served by a job
+    def __init__(self, client, request_id, deadline=None):
+        self.client = client
+        self.request_id = request_id
+        self.deadline = deadline    # perf_counter time by which this request must have started, or None
+        self.notified = Event()     # Set once the client has been told its place in the queue
+
+
+class Job:
+    def __init__(self, request, priority, key, received):
+        self.request = request      # JSON request of the first waiter
+        self.priority = priority    # Higher runs first
+        self.deadline = None        # Earliest deadline of the waiters, or None
+        self.key = key              # Coalescing key, or None if the request can not be shared
+        self.received = received    # perf_counter time the first request was received
+        self.waiters = []           # Waiters of every request served by this job
+        self.entry = None           # Heap entry
+
+    def update_deadline(self):
+        deadlines = [waiter.deadline for waiter in self.waiters if waiter.deadline is not None]
+        self.deadline = min(deadlines) if deadlines else None
+
+    def take_expired(self, now):
+        # Remove and return the waiters whose own deadline has passed
+        expired = [waiter for waiter in self.waiters if waiter.deadline is not None and waiter.deadline <= now]
+        if expired:
+            self.waiters = [waiter for waiter in self.waiters if waiter not in expired]
+            self.update_deadline()
+        return expired
+
+
+class RequestScheduler:
+    # Interval in seconds at which the worker looks at the queue again while it waits for the lock
+    LOCK_POLL = 0.1
+
+    def __init__(self, run, expire, lock=None, exclusive=None):
+        # run - called on the worker thread with each job
+        # expire - called with a job and its waiters whose deadline passed before the job could start
+        # lock - lock held while a job runs (e.g. the camera lock), released once the job has finished
+        # exclusive - called with a job, returns False for jobs that run without the lock. Default all jobs
+        self.run = run
+        self.expire = expire
+        self.lock = lock
+        self.exclusive = exclusive
+        self.cond = Condition()
+        self.heap = []
+        self.pending = {}           # Coalescing key -> queued job
+        self.counter = itertools.count()
+        self.thread = None
+        self.sweeper = None
+        self.running = None         # Job being run
+
+    def __len__(self):
+        with self.cond:
+            return len(self.heap)
+
+    @staticmethod
+    def sort_key(priority, deadline, seq):
+        return [-priority, deadline if deadline is not None else float('inf'), seq]
+
+    def submit(self, waiter, request, priority=0, key=None, received=None):
+        # Queue a request, or add it to a queued job with the same key
+        # waiter - Waiter of the request, with its own deadline
+        # Returns tuple of job, queue position (1 is next to run), coalesced
+        if received is None:
+            received = time.perf_counter()
+
+        with self.cond:
+            job = self.pending.get(key) if key is not None else None
+            coalesced = job is not None
+            if not coalesced:
+                job = Job(request, priority, key, received)
+                job.entry = self.sort_key(priority, None, next(self.counter)) + [job]
+                heapq.heappush(self.heap, job.entry)
+                if key is not None:
+                    self.pending[key] = job
+
+            # The job runs as early as its most urgent request requires
+            job.waiters.append(waiter)
+            job.priority = max(job.priority, priority)
+            job.update_deadline()
+            self.resort(job)
+
+            position = 1 + sum(1 for entry in self.heap if entry[:3] < job.entry[:3])
+            if self.running is not None:
+                position += 1
+
+            if self.thread is None:
+                self.thread = Thread(target=self.worker, args=(), daemon=True)
+                self.thread.start()
+                self.sweeper = Thread(target=self.sweep, args=(), daemon=True)
+                self.sweeper.start()
+            self.cond.notify_all()
+
+        return job, position, coalesced
+
+    def resort(self, job):
+        # Update the heap entry of a queued job after its priority or deadline changed. Caller must hold self.cond
+        key = self.sort_key(job.priority, job.deadline, job.entry[2])
+        if key != job.entry[:3]:
+            job.entry[:3] = key
+            heapq.heapify(self.heap)
+
+    def remove(self, job):
+        # Remove a queued job without running it. Caller must hold self.cond
+        self.heap.remove(job.entry)
+        heapq.heapify(self.heap)
+        if self.pending.get(job.key) is job:
+            del self.pending[job.key]
+
+    def worker(self):
+        while True:
+            with self.cond:
+                while not self.heap:
+                    self.cond.wait()
+                head = self.heap[0][-1]
+
+            locked = False
+            if self.lock is not None and (self.exclusive is None or self.exclusive(head)):
+                if not self.lock.acquire(timeout=self.LOCK_POLL):
+                    continue
+                locked = True
+
+            try:
+                with self.cond:
+                    # The head may have been overtaken or expired while waiting for the lock
+                    if not self.heap or self.heap[0][-1] is not head:
+                        continue
+                    job = heapq.heappop(self.heap)[-1]
+                    if self.pending.get(job.key) is job:
+                        del self.pending[job.key]
+                    expired = job.take_expired(time.perf_counter())
+                    if job.waiters:
+                        self.running = job
+
+                self.expire_waiters(job, expired)
+                if not job.waiters:
+                    continue
+
+                try:
+                    self.run(job)
+                except Exception as e:
+                    print("Error: Scheduled request failed ({})".format(e))
+                finally:
+                    with self.cond:
+                        self.running = None
+            finally:
+                if locked:
+                    self.lock.release()
+
+    def sweep(self):
+        # Expire waiters when their deadline passes instead of when their job reaches the front of the queue
+        while True:
+            with self.cond:
+                now = time.perf_counter()
+                deadlines = [entry[-1].deadline for entry in self.heap if entry[-1].deadline is not None]
+                if not deadlines or min(deadlines) > now:
+                    self.cond.wait(min(deadlines) - now if deadlines else None)
+                    continue
+
+                expired = []
+                for job in [entry[-1] for entry in self.heap]:
+                    waiters = job.take_expired(now)
+                    if waiters:
+                        expired.append((job, waiters))
+                        if job.waiters:
+                            self.resort(job)
+                        else:
+                            self.remove(job)
+
+            for job, waiters in expired:
+                self.expire_waiters(job, waiters)
+
+    def expire_waiters(self, job, waiters):
+        if not waiters:
+            return
+        try:
+            self.expire(job, waiters)
+        except Exception as e:
+            print("Error: Failed to expire scheduled request ({})".format(e))
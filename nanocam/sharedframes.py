@@ -0,0 +1,226 @@
+import mmap
+import os
+import struct
+import time
+import numpy
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    # Python < 3.8 (e.g. JetPack 4.x): segments are files in /dev/shm mapped with mmap
+    shared_memory = None
+
+# Shared memory ring of frames published by one process and read zero-copy by any number of worker processes.
+#
+# Layout of the segment:
+#   0    static header: magic, number of slots, dtype, ndim, shape
+#   64   head: number of frames published so far
+#   128  seqs[slots]: sequence number + 1 of the frame held by each slot, 0 while the slot is being written
+#   ...  timestamps[slots]
+#   ...  frames[slots, *shape] (64 byte aligned)
+#
+# The publisher never waits for readers.  A reader that falls more than a ring behind skips to the newest frame
+# and counts the frames it missed.  Since a slot can be overwritten while a reader is using its view, readers
+# check valid(seq) after processing a frame (or use copy=True).
+
+MAGIC = b"NCFRAMES"
+STATIC = struct.Struct('<8sQ8sB7x4Q')
+HEAD_OFFSET = 64
+SLOTS_OFFSET = 128
+MAX_DIMS = 4
+
+
+def align(n, a=64):
+    return (n + a - 1) // a * a
+
+
+def segment_size(slots, shape, dtype):
+    frame_bytes = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    return align(SLOTS_OFFSET + 16 * slots) + slots * align(frame_bytes)
+
+
+class SharedSegment:
+    # Named block of shared memory
+    def __init__(self, name, size=0, create=False):
+        self.name = name
+        self.create = create
+        self.shm = None
+        self.mmap = None
+
+        if shared_memory is not None:
+            self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+            self.buf = self.shm.buf
+            if not create:
+                # Stop the resource tracker from unlinking the publisher's segment when this process exits
+                try:
+                    from multiprocessing import resource_tracker
+                    resource_tracker.unregister(self.shm._name, "shared_memory")
+                except (ImportError, AttributeError):
+                    pass
+        else:
+            path = '/dev/shm/' + name
+            if create:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+                os.ftruncate(fd, size)
+            else:
+                fd = os.open(path, os.O_RDWR)
+                size = os.fstat(fd).st_size
+            try:
+                self.mmap = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            self.buf = memoryview(self.mmap)
+
+    def close(self):
+        self.buf = None
+        if self.shm is not None:
+            self.shm.close()
+        elif self.mmap is not None:
+            self.mmap.close()
+
+    def unlink(self):
+        if self.shm is not None:
+            self.shm.unlink()
+        else:
+            try:
+                os.remove('/dev/shm/' + self.name)
+            except FileNotFoundError:
+                pass
+
+
+class SharedFrameRing:
+    # Base class mapping the arrays of a segment
+    def __init__(self, segment, slots, shape, dtype):
+        self.segment = segment
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+
+        buf = segment.buf
+        frame_bytes = int(numpy.prod(self.shape)) * self.dtype.itemsize
+        frames_offset = align(SLOTS_OFFSET + 16 * slots)
+        self.head = numpy.ndarray((1,), dtype=numpy.uint64, buffer=buf, offset=HEAD_OFFSET)
+        self.seqs = numpy.ndarray((slots,), dtype=numpy.uint64, buffer=buf, offset=SLOTS_OFFSET)
+        self.timestamps = numpy.ndarray((slots,), dtype=numpy.uint64, buffer=buf, offset=SLOTS_OFFSET + 8 * slots)
+        strides = [align(frame_bytes)]
+        step = self.dtype.itemsize
+        for dim in reversed(self.shape):
+            strides.insert(1, step)
+            step *= dim
+        self.frames = numpy.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=buf, offset=frames_offset,
+                                    strides=tuple(strides))
+
+    def close(self):
+        self.head = self.seqs = self.timestamps = self.frames = None
+        self.segment.close()
+
+
+class SharedFramePublisher(SharedFrameRing):
+    # Creates the segment and publishes frames into it. Only one publisher per segment
+
+    def __init__(self, name, shape, dtype=numpy.uint8, slots=8):
+        if len(shape) > MAX_DIMS:
+            raise ValueError("Frames can have at most {} dimensions".format(MAX_DIMS))
+        size = segment_size(slots, shape, dtype)
+        try:
+            segment = SharedSegment(name, size, create=True)
+        except FileExistsError:
+            # Left behind by a publisher that did not unlink it
+            stale = SharedSegment(name)
+            stale.close()
+            stale.unlink()
+            segment = SharedSegment(name, size, create=True)
+        dims = tuple(shape) + (0,) * (MAX_DIMS - len(shape))
+        segment.buf[:STATIC.size] = STATIC.pack(MAGIC, slots, numpy.dtype(dtype).str.encode(), len(shape), *dims)
+        SharedFrameRing.__init__(self, segment, slots, shape, dtype)
+        self.head[0] = 0
+        self.seqs[:] = 0
+
+    def publish(self, frame, timestamp=0):
+        # Copy frame into the next slot. Never blocks, slow readers are overwritten
+        # Returns the sequence number of the frame
+        seq = int(self.head[0])
+        slot = seq % self.slots
+        self.seqs[slot] = 0
+        self.frames[slot] = frame
+        self.timestamps[slot] = timestamp
+        self.seqs[slot] = seq + 1
+        self.head[0] = seq + 1
+        return seq
+
+    def unlink(self):
+        # Remove the segment once all readers are finished with it
+        self.close()
+        self.segment.unlink()
+
+
+class SharedFrameReader(SharedFrameRing):
+    # Attaches to a segment by name and reads frames without copying them
+    #
+    #   reader = SharedFrameReader("nanocam0")
+    #   while True:
+    #       seq, timestamp, frame = reader.next_frame()
+    #       result = process(frame)
+    #       if not reader.valid(seq):
+    #           continue        # frame was overwritten while processing, result is unreliable
+
+    def __init__(self, name, timeout=10, poll_interval=0.005):
+        # timeout - seconds to wait for the publisher to create the segment
+        # poll_interval - seconds between checks for new frames
+        self.poll_interval = poll_interval
+        deadline = time.time() + timeout
+        while True:
+            try:
+                segment = SharedSegment(name)
+                break
+            except FileNotFoundError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+        magic, slots, dtype_str, ndim, *dims = STATIC.unpack(bytes(segment.buf[:STATIC.size]))
+        if magic != MAGIC:
+            segment.close()
+            raise ValueError("{} is not a nanocam frame segment".format(name))
+        SharedFrameRing.__init__(self, segment, slots, dims[:ndim], dtype_str.rstrip(b"\0").decode())
+
+        # Start with the newest frame
+        self.next_seq = max(0, int(self.head[0]) - 1)
+        self.skipped = 0    # Frames missed because this reader fell behind
+
+    def valid(self, seq):
+        # True if the slot still holds frame seq
+        return int(self.seqs[seq % self.slots]) == seq + 1
+
+    def next_frame(self, timeout=None, copy=False):
+        # Returns tuple of sequence number, timestamp, frame for the next unread frame, or None on timeout
+        # copy - return an independent copy, checked to be complete
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            head = int(self.head[0])
+            if head > self.next_seq:
+                # The slot of the oldest frames is being reused once the reader is a full ring behind
+                if head - self.next_seq >= self.slots:
+                    self.skipped += head - 1 - self.next_seq
+                    self.next_seq = head - 1
+
+                seq = self.next_seq
+                slot = seq % self.slots
+                self.next_seq += 1
+                if not self.valid(seq):
+                    self.skipped += 1
+                    continue
+
+                timestamp = int(self.timestamps[slot])
+                if not copy:
+                    return seq, timestamp, self.frames[slot]
+
+                frame = self.frames[slot].copy()
+                if self.valid(seq):
+                    return seq, timestamp, frame
+                self.skipped += 1
+                continue
+
+            if deadline is not None and time.time() > deadline:
+                return None
+            time.sleep(self.poll_interval)
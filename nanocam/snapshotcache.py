@@ -0,0 +1,65 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+
+# Recent snapshots kept in memory by MediaServer, so image requests with a "max_age" are answered without starting
+# a capture.  Only the newest snapshot of each key (resolution, format and camera settings) is kept.  Entries expire
+# after ttl seconds, and the least recently used entries are evicted once the cache holds more than max_bytes.
+
+
+class Snapshot:
+    def __init__(self, name, data, captured):
+        self.name = name            # File name for "file" snapshots, None for arrays
+        self.data = data            # Encoded image bytes, or numpy array
+        self.captured = captured    # time.time() of the capture
+        self.nbytes = len(data) if isinstance(data, bytes) else data.nbytes
+
+
+class SnapshotCache:
+    def __init__(self, ttl=10.0, max_bytes=64 * 1024 * 1024):
+        # ttl - seconds a snapshot is kept
+        # max_bytes - total size of the cached snapshots
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        self.entries = OrderedDict()    # key -> Snapshot, least recently used first
+        self.nbytes = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, max_age):
+        # Returns the snapshot of key if it was captured less than max_age seconds ago, else None
+        now = time.time()
+        with self.lock:
+            self.expire(now)
+            snap = self.entries.get(key)
+            if snap is None or now - snap.captured > max_age:
+                return None
+            self.entries.move_to_end(key)
+            return snap
+
+    def put(self, key, snap):
+        if snap.nbytes > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self.entries[key] = snap
+            self.nbytes += snap.nbytes
+            self.expire(time.time())
+            while self.nbytes > self.max_bytes:
+                key, old = self.entries.popitem(last=False)
+                self.nbytes -= old.nbytes
+
+    def expire(self, now):
+        # Caller must hold self.lock
+        for key in [key for key, snap in self.entries.items() if now - snap.captured > self.ttl]:
+            self.nbytes -= self.entries.pop(key).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
@@ -1,106 +1,601 @@
+import ctypes
+import ctypes.util
 import gi
 import numpy
+import queue
 import time
 import os
 import sys
 from datetime import datetime
-from nanocam.globals import StreamStatus, Camera
-from threading import Thread, Timer
+from nanocam.globals import StreamStatus, Camera, RingBuffer
+from nanocam.metrics import REGISTRY
+from nanocam.frames import FrameRing
+from nanocam.sharedframes import SharedFramePublisher
+from threading import Event, Lock, Thread, Timer
 
 gi.require_version('Gst', '1.0')
-from gi.repository import GObject, Gst
+from gi.repository import GLib, Gst
 
+# GstVideo provides the row stride of mapped frames, MappedFrame falls back to guessing it without
+try:
+    gi.require_version('GstVideo', '1.0')
+    from gi.repository import GstVideo
+except (ValueError, ImportError):
+    GstVideo = None
+
+
+class GstRuntime:
+    # Process wide GStreamer runtime. GStreamer is initialised once and a single GLib main loop thread dispatches the
+    # bus watches of all pipelines, so pipelines are cheap to create and several can run at the same time.
+    # Use GstRuntime.get() rather than creating instances
+
+    # Maximum time in milliseconds between a kill request and EOS being sent to the pipelines
+    KILL_POLL_MS = 50
+
+    instance = None
+    instance_lock = Lock()
 
-class GstBackEnd:
     def __init__(self):
-        self.loop = None
+        Gst.init(sys.argv)
+        self.lock = Lock()
+        self.watchers = set()       # GstBackEnds shut down by StreamStatus.LOCAL_KILL
+        self.kill_source = None
+        self.loop = GLib.MainLoop()
+        self.thread = Thread(target=self.loop.run, args=(), daemon=True)
+        self.thread.start()
+
+    @classmethod
+    def get(cls):
+        if cls.instance is None:
+            with cls.instance_lock:
+                if cls.instance is None:
+                    cls.instance = GstRuntime()
+        return cls.instance
+
+    def watch_kill(self, backend):
+        # Kill requests are checked by a single main loop source while any pipeline is watching
+        with self.lock:
+            self.watchers.add(backend)
+            if self.kill_source is None:
+                self.kill_source = GLib.timeout_add(self.KILL_POLL_MS, self.check_kill_flag)
+
+    def unwatch_kill(self, backend):
+        with self.lock:
+            self.watchers.discard(backend)
+            if not self.watchers and self.kill_source is not None:
+                GLib.source_remove(self.kill_source)
+                self.kill_source = None
+
+    def check_kill_flag(self):
+        # The flag stays set until whoever requested the kill clears it (MediaServer clears it when the camera lock
+        # is released), so the rest of the interrupted request, e.g. the remaining frames of an ImageStream, also stops
+        if StreamStatus.LOCAL_KILL.is_set():
+            with self.lock:
+                watchers = list(self.watchers)
+                self.watchers.clear()
+                self.kill_source = None
+            for backend in watchers:
+                backend.quit()
+            return False
+
+        return True
+
+
+class GstBackEnd:
+    # A pipeline hosted by the shared GstRuntime. start() blocks the calling thread until the pipeline has finished
+
+    # Kept for compatibility, see GstRuntime.KILL_POLL_MS
+    KILL_POLL_MS = GstRuntime.KILL_POLL_MS
+
+    def __init__(self, watch_kill=True, name="pipeline"):
+        self.runtime = None
         self.pipeline = None
         self.bus = None
+        self.done = Event()             # Set by the bus watch on EOS or error
         self.cycles = 0
-        self.killthread = Thread(target=self.check_kill_flag, args=())
+        self.watch_kill = watch_kill    # Shut down the pipeline when StreamStatus.LOCAL_KILL is set
         self.timer = None
+        self.expired = Event()          # Set when the duration timer of this pipeline has run out
+        self.name = name                # "pipeline" label of the metrics recorded for this pipeline
+        self.t_start = None             # perf_counter time PLAYING was requested
+        self.t_eos = None               # perf_counter time EOS was sent
+        self.first_frame = False
 
     def init(self):
-        if self.cycles == 0:
-            Gst.init(sys.argv)
-
-        GObject.threads_init()
-        self.loop = GObject.MainLoop()
-        if not self.killthread.is_alive():
-            self.killthread.start()
+        self.runtime = GstRuntime.get()
 
         # Timer is required to kill the camera stream. There was an issue with nvargus-daemon hanging if the
         # timeout property of the camera was set
+        self.expired.clear()
         if self.timer is not None:
             self.timer.start()
 
+        # A pipeline that was created but never started is replaced
+        if self.bus is not None:
+            self.bus.remove_watch()
+
         self.pipeline = Gst.Pipeline()
         self.bus = self.pipeline.get_bus()
-        self.bus.add_watch(0, self.bus_call, self.loop)
+        self.bus.add_watch(GLib.PRIORITY_DEFAULT, self.bus_call)
+        self.done.clear()
 
     def set_timer(self, duration):
-        self.timer = Timer(duration, self.set_kill_flag)
+        self.timer = Timer(duration, self.expire)
 
     def update_timer(self, duration):
-        self.timer.cancel()
-        self.timer = Timer(duration, self.set_kill_flag)
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = Timer(duration, self.expire)
         self.timer.start()
 
-    def quit(self):
-        self.pipeline.send_event(Gst.Event.new_eos())
-
-    def set_kill_flag(self):
-        StreamStatus.LOCAL_KILL = True
-        self.timer.cancel()
+    def expire(self):
+        # Called by the duration timer. Only this pipeline is shut down; StreamStatus.LOCAL_KILL is left to the
+        # server's kill override, which stops every pipeline of the runtime
         self.timer = None
+        self.expired.set()
+        self.quit()
 
-    def check_kill_flag(self):
-        while True:
-            if StreamStatus.LOCAL_KILL:
-                StreamStatus.LOCAL_KILL = False
-                self.quit()
-                break
+    def quit(self):
+        # Sending an event is thread-safe, so this may be called from any thread
+        pipeline = self.pipeline
+        if pipeline is not None:
+            if self.t_eos is None:
+                self.t_eos = time.perf_counter()
+            pipeline.send_event(Gst.Event.new_eos())
+
+    def finish(self):
+        # Return from start() without waiting for EOS
+        self.done.set()
+
+    def count_frames(self, pad):
+        # Record first frame latency and frames processed for the buffers passing pad
+        def on_buffer(pad, info):
+            if not self.first_frame:
+                self.first_frame = True
+                if self.t_start is not None:
+                    REGISTRY.observe("pipeline_first_frame_seconds", time.perf_counter() - self.t_start,
+                                     pipeline=self.name)
+            REGISTRY.inc("frames_processed_total", pipeline=self.name)
+            return Gst.PadProbeReturn.OK
+
+        pad.add_probe(Gst.PadProbeType.BUFFER, on_buffer)
 
     def start(self):
+        self.t_start = time.perf_counter()
+        self.t_eos = None
+        self.first_frame = False
+        if self.watch_kill:
+            self.runtime.watch_kill(self)
         self.pipeline.set_state(Gst.State.PLAYING)
         print("Starting pipeline")
-        try:
-
-            self.loop.run()
-
-        except Exception as e:
-
-            print(e)
+        # EOS sent before the pipeline was playing is lost, so a timer that has already run out is applied again
+        if self.expired.is_set():
+            self.quit()
+        self.done.wait()
 
         # Cleanup
+        if self.watch_kill:
+            self.runtime.unwatch_kill(self)
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
         self.pipeline.set_state(Gst.State.NULL)
-        self.loop = None
+        self.bus.remove_watch()
+        REGISTRY.observe("pipeline_run_seconds", time.perf_counter() - self.t_start, pipeline=self.name)
         self.pipeline = None
         self.bus = None
         self.cycles += 1
 
     def bus_call(self, bus, msg, *args):
+        # Called from the runtime main loop thread
 
         if msg.type == Gst.MessageType.EOS:
 
             print("End-of-stream")
+            if self.t_eos is not None:
+                REGISTRY.observe("pipeline_eos_seconds", time.perf_counter() - self.t_eos, pipeline=self.name)
 
-            self.pipeline.send_event(Gst.Event.new_eos())
-            self.loop.quit()
+            self.done.set()
 
-            return
+            return True
 
         elif msg.type == Gst.MessageType.ERROR:
 
             print("GST ERROR", msg.parse_error())
+            REGISTRY.inc("pipeline_errors_total", pipeline=self.name)
 
-            self.loop.quit()
+            self.done.set()
 
-            return
+            return True
+
+        elif msg.type == Gst.MessageType.STATE_CHANGED and msg.src == self.pipeline:
+            old, new, pending = msg.parse_state_changed()
+            if new == Gst.State.PLAYING and self.t_start is not None:
+                REGISTRY.observe("pipeline_playing_seconds", time.perf_counter() - self.t_start, pipeline=self.name)
 
         return True
 
 
+# Substitutes for elements, e.g. to run the pipelines without a Jetson and CSI camera (see use_synthetic_elements)
+# Keys are element names used by the pipelines, values are element names or launch descriptions
+ELEMENT_MAP = {}
+
+# Software elements standing in for the Jetson camera, converter and hardware encoders
+SYNTHETIC_ELEMENTS = {
+    "nvarguscamerasrc": "videotestsrc is-live=true pattern=ball",
+    "nvvidconv": "videoconvert ! videoscale",
+    "nvjpegenc": "jpegenc",
+    "omxh264enc": "x264enc tune=zerolatency speed-preset=ultrafast",
+    "nvv4l2h264enc": "x264enc tune=zerolatency speed-preset=ultrafast",
+}
+
+
+def use_synthetic_elements(enable=True):
+    # Replace the Jetson specific elements of all pipelines with SYNTHETIC_ELEMENTS
+    ELEMENT_MAP.clear()
+    if enable:
+        ELEMENT_MAP.update(SYNTHETIC_ELEMENTS)
+
+
+def make_element(factory, name=None):
+    # Gst.ElementFactory.make, applying the substitutions in ELEMENT_MAP
+    desc = ELEMENT_MAP.get(factory)
+    if desc is None:
+        return Gst.ElementFactory.make(factory, name)
+
+    if '!' in desc:
+        elem = Gst.parse_bin_from_description(desc, True)
+    else:
+        elem = Gst.parse_launch(desc)
+    if name is not None:
+        elem.set_property('name', name)
+    return elem
+
+
+def set_element_property(elem, label, val):
+    # Properties that a substituted element does not have are skipped
+    if ELEMENT_MAP and elem.find_property(label) is None:
+        return
+    elem.set_property(label, val)
+
+
+def camera_caps(caps_str):
+    # Caps of the camera source. Substituted sources produce system memory buffers instead of NVMM
+    if "nvarguscamerasrc" in ELEMENT_MAP:
+        caps_str = caps_str.replace('(memory:NVMM)', '')
+    return Gst.caps_from_string(caps_str)
+
+
+def crop_elements(convert, crop, res):
+    # Crop to the rectangle crop = (left, top, right, bottom) in pixels of the camera image of resolution res in the
+    # nvvidconv element convert, before it scales to the output caps
+    # Returns elements to link in front of convert: a videocrop when nvvidconv has been substituted (see
+    # use_synthetic_elements), since the software converters can not crop
+    if crop is None:
+        return []
+    left, top, right, bottom = [int(v) for v in crop]
+    if "nvvidconv" not in ELEMENT_MAP:
+        for label, val in (("left", left), ("top", top), ("right", right), ("bottom", bottom)):
+            convert.set_property(label, val)
+        return []
+
+    # videocrop takes the number of pixels removed from each edge
+    videocrop = make_element('videocrop', None)
+    for label, val in (("left", left), ("top", top), ("right", res[0] - right), ("bottom", res[1] - bottom)):
+        videocrop.set_property(label, val)
+    return [videocrop]
+
+
+def encoder_factory(encoder):
+    # Returns the GStreamer element name for a Camera.ENCODER_* value (default omxh264enc)
+    if encoder == Camera.ENCODER_OMXH265:
+        return "omxh265enc"
+    elif encoder == Camera.ENCODER_OMXVP8:
+        return "omxvp8enc"
+    elif encoder == Camera.ENCODER_OMXVP9:
+        return "omxvp9enc"
+    elif encoder == Camera.ENCODER_NVV4L2H264:
+        return "nvv4l2h264enc"
+    elif encoder == Camera.ENCODER_NVV4L2H265:
+        return "nvv4l2h265enc"
+    elif encoder == Camera.ENCODER_NVV4L2VP8:
+        return "nvv4l2vp8enc"
+    elif encoder == Camera.ENCODER_NVV4L2VP9:
+        return "nvv4l2vp9enc"
+    else:
+        return "omxh264enc"
+
+
+# Number of bytes per pixel for the raw formats that can be delivered to an appsink
+FRAME_CHANNELS = {"BGR": 3, "RGB": 3, "GRAY8": 1, "BGRx": 4, "BGRA": 4, "RGBx": 4, "RGBA": 4}
+
+
+class GstMapInfo(ctypes.Structure):
+    # Layout of the C GstMapInfo structure, used to map buffers without copying them into Python bytes
+    _fields_ = [("memory", ctypes.c_void_p),
+                ("flags", ctypes.c_int),
+                ("data", ctypes.POINTER(ctypes.c_ubyte)),
+                ("size", ctypes.c_size_t),
+                ("maxsize", ctypes.c_size_t),
+                ("user_data", ctypes.c_void_p * 4),
+                ("_gst_reserved", ctypes.c_void_p * 4)]
+
+
+class PyGBoxed(ctypes.Structure):
+    # Start of the PyGBoxed structure of the public pygobject.h header: the Python object header followed by the
+    # pointer to the wrapped C structure
+    _fields_ = [("ob_refcnt", ctypes.c_ssize_t),
+                ("ob_type", ctypes.c_void_p),
+                ("boxed", ctypes.c_void_p)]
+
+
+try:
+    _libgst = ctypes.CDLL(ctypes.util.find_library('gstreamer-1.0') or 'libgstreamer-1.0.so.0')
+    _libgst.gst_buffer_map.argtypes = [ctypes.c_void_p, ctypes.POINTER(GstMapInfo), ctypes.c_int]
+    _libgst.gst_buffer_map.restype = ctypes.c_bool
+    _libgst.gst_buffer_unmap.argtypes = [ctypes.c_void_p, ctypes.POINTER(GstMapInfo)]
+    _libgst.gst_buffer_unmap.restype = None
+except (OSError, AttributeError):
+    _libgst = None
+
+
+def buffer_pointer(buffer):
+    # Address of the C GstBuffer wrapped by a Gst.Buffer. PyGObject has no Python API for it, so it is read from the
+    # PyGBoxed structure (id() is the address of the Python object in CPython)
+    return PyGBoxed.from_address(id(buffer)).boxed
+
+
+def frame_stride(buffer, caps, width, height, channels, size):
+    # Returns tuple of byte offset and stride of the first row of a packed video frame
+    if GstVideo is not None:
+        # Producers that pad rows differently from the default layout describe them with a GstVideoMeta
+        meta = GstVideo.buffer_get_video_meta(buffer)
+        if meta is not None:
+            return meta.offset[0], meta.stride[0]
+        info = GstVideo.VideoInfo()
+        if info.from_caps(caps):
+            return info.offset[0], info.stride[0]
+
+    # Without GstVideo trust the buffer size if every row has the same length, otherwise assume rows padded to a
+    # multiple of 4 bytes, the GStreamer default
+    if height > 0 and size % height == 0:
+        return 0, size // height
+    return 0, (width * channels + 3) & ~3
+
+
+class MappedFrame:
+    # numpy view of the memory of a Gst.Sample, without copying the frame
+    # The view is only valid until release() is called (or the with block exits), after which GStreamer may reuse
+    # the memory.  Use copy() to keep the frame.
+    #
+    #   with MappedFrame(sample) as frame:
+    #       process(frame.array)
+
+    def __init__(self, sample):
+        self.sample = sample
+        self.buffer = sample.get_buffer()
+        self.pts = self.buffer.pts
+        self.mapinfo = None
+        self.pointer = None         # Address of the GstBuffer if it was mapped with ctypes
+        self.array = None
+
+        caps = sample.get_caps()
+        structure = caps.get_structure(0)
+        self.width = structure.get_value('width')
+        self.height = structure.get_value('height')
+        self.format = structure.get_value('format')
+        channels = FRAME_CHANNELS.get(self.format, 3)
+
+        # PyGObject returns a copy of the data for Gst.Buffer.map() on older versions, so the buffer is mapped with
+        # ctypes where possible
+        if _libgst is not None:
+            pointer = buffer_pointer(self.buffer)
+            mapinfo = GstMapInfo()
+            if not pointer or not _libgst.gst_buffer_map(pointer, ctypes.byref(mapinfo), Gst.MapFlags.READ):
+                raise RuntimeError("Unable to map buffer")
+            self.mapinfo, self.pointer = mapinfo, pointer
+            size = mapinfo.size
+            if size == 0 or not mapinfo.data:
+                self.release()
+                raise RuntimeError("Mapped buffer is empty")
+            data = (ctypes.c_ubyte * size).from_address(ctypes.addressof(mapinfo.data.contents))
+        else:
+            ok, mapinfo = self.buffer.map(Gst.MapFlags.READ)
+            if not ok:
+                raise RuntimeError("Unable to map buffer")
+            self.mapinfo = mapinfo
+            size = mapinfo.size
+            data = mapinfo.data
+            if size == 0 or not data:
+                self.release()
+                raise RuntimeError("Mapped buffer is empty")
+
+        offset, stride = frame_stride(self.buffer, caps, self.width, self.height, channels, size)
+        if self.height <= 0 or stride < self.width * channels or \
+                offset + stride * (self.height - 1) + self.width * channels > size:
+            self.release()
+            raise RuntimeError("Buffer of {} bytes is too small for a {}x{} {} frame".format(
+                size, self.width, self.height, self.format))
+
+        if channels == 1:
+            self.array = numpy.ndarray((self.height, self.width), dtype=numpy.uint8, buffer=data, offset=offset,
+                                       strides=(stride, 1))
+        else:
+            self.array = numpy.ndarray((self.height, self.width, channels), dtype=numpy.uint8, buffer=data,
+                                       offset=offset, strides=(stride, channels, 1))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def __del__(self):
+        self.release()
+
+    def copy(self):
+        # Returns a contiguous copy of the frame that remains valid after release()
+        return self.array.copy()
+
+    def release(self):
+        if self.mapinfo is None:
+            return
+        self.array = None
+        if self.pointer is not None:
+            _libgst.gst_buffer_unmap(self.pointer, ctypes.byref(self.mapinfo))
+        else:
+            self.buffer.unmap(self.mapinfo)
+        self.mapinfo = None
+        self.pointer = None
+        self.buffer = None
+        self.sample = None
+
+
+def publish_frame(publisher, name, slots, frame):
+    # Publish a MappedFrame to shared memory, creating the segment on the first frame or if the frame shape changes
+    # Returns the publisher
+    if publisher is None or publisher.shape != frame.array.shape:
+        if publisher is not None:
+            publisher.unlink()
+        publisher = SharedFramePublisher(name, frame.array.shape, frame.array.dtype, slots)
+    publisher.publish(frame.array, frame.pts)
+    return publisher
+
+
+def sample_to_array(sample, copy=True):
+    # Convert a raw video Gst.Sample to a numpy array
+    # copy - return an independent array. If False a MappedFrame is returned, which must be released by the caller
+    frame = MappedFrame(sample)
+    if not copy:
+        return frame
+
+    arr = frame.copy()
+    frame.release()
+    return arr
+
+
+class PadStats:
+    # Buffer count, bytes and inter-buffer interval statistics of a pad
+    def __init__(self):
+        self.buffers = 0
+        self.bytes = 0
+        self.last = None            # Time of the last buffer, reset between pipelines
+        self.intervals = 0
+        self.interval_mean = 0.0
+        self.interval_m2 = 0.0      # Sum of squared deviations of the intervals (Welford)
+
+    def add(self, now, size):
+        if self.last is not None:
+            interval = now - self.last
+            self.intervals += 1
+            delta = interval - self.interval_mean
+            self.interval_mean += delta / self.intervals
+            self.interval_m2 += delta * (interval - self.interval_mean)
+        self.last = now
+        self.buffers += 1
+        self.bytes += size
+
+    def rates(self):
+        # Returns tuple of buffers/s, bytes/s, jitter (standard deviation of the interval) in seconds
+        if self.intervals == 0 or self.interval_mean == 0:
+            return None, None, None
+        fps = 1 / self.interval_mean
+        jitter = (self.interval_m2 / self.intervals) ** 0.5
+        return fps, fps * self.bytes / self.buffers, jitter
+
+
+class PadProfiler:
+    # Opt-in buffer probes on the pads of every element of a pipeline (see VideoStream.enable_profiling).
+    # For each element it records the buffers and bytes leaving it, the buffer rate and jitter, and the processing
+    # latency from a buffer entering the element to a buffer with the same PTS leaving it.  Elements that change
+    # timestamps or aggregate buffers (muxers) have no latency.  Stats accumulate over all attached pipelines
+    MAX_PENDING = 256   # Buffers in flight tracked per element
+
+    def __init__(self):
+        self.lock = Lock()
+        self.elements = {}      # Element name -> dict of factory, input PadStats, output PadStats, latency stats
+        self.order = []
+
+    def attach(self, elements):
+        for elem in elements:
+            name = elem.get_name()
+            factory = elem.get_factory()
+            stats = self.elements.get(name)
+            if stats is None:
+                stats = {"factory": factory.get_name() if factory is not None else "bin", "in": PadStats(),
+                         "out": PadStats(), "pending": {}, "latency_n": 0, "latency_sum": 0.0, "latency_max": 0.0}
+                self.elements[name] = stats
+                self.order.append(name)
+            else:
+                # Restart the intervals, the gap between pipelines is not jitter
+                stats["in"].last = None
+                stats["out"].last = None
+                stats["pending"].clear()
+
+            for pad in elem.sinkpads:
+                pad.add_probe(Gst.PadProbeType.BUFFER, self.on_input, stats)
+            for pad in elem.srcpads:
+                pad.add_probe(Gst.PadProbeType.BUFFER, self.on_output, stats)
+
+    def on_input(self, pad, info, stats):
+        now = time.perf_counter()
+        buf = info.get_buffer()
+        with self.lock:
+            stats["in"].add(now, buf.get_size())
+            pending = stats["pending"]
+            if len(pending) >= self.MAX_PENDING:
+                pending.clear()
+            pending[buf.pts] = now
+        return Gst.PadProbeReturn.OK
+
+    def on_output(self, pad, info, stats):
+        now = time.perf_counter()
+        buf = info.get_buffer()
+        with self.lock:
+            stats["out"].add(now, buf.get_size())
+            t_in = stats["pending"].pop(buf.pts, None)
+            if t_in is not None:
+                latency = now - t_in
+                stats["latency_n"] += 1
+                stats["latency_sum"] += latency
+                stats["latency_max"] = max(stats["latency_max"], latency)
+        return Gst.PadProbeReturn.OK
+
+    def summary(self):
+        # Returns list of dicts, one per element in pipeline order. Rates are taken from the element output, or its
+        # input for sinks. bottleneck marks the element with the highest mean latency
+        out = []
+        with self.lock:
+            for name in self.order:
+                stats = self.elements[name]
+                pad = stats["out"] if stats["out"].buffers else stats["in"]
+                fps, byte_rate, jitter = pad.rates()
+                n = stats["latency_n"]
+                out.append({"element": name, "factory": stats["factory"], "buffers": pad.buffers, "bytes": pad.bytes,
+                            "fps": fps, "bytes_per_s": byte_rate,
+                            "jitter_ms": jitter * 1000 if jitter is not None else None,
+                            "latency_ms": stats["latency_sum"] / n * 1000 if n else None,
+                            "latency_max_ms": stats["latency_max"] * 1000 if n else None, "bottleneck": False})
+
+        latencies = [e for e in out if e["latency_ms"] is not None]
+        if latencies:
+            max(latencies, key=lambda e: e["latency_ms"])["bottleneck"] = True
+        return out
+
+    def print_summary(self):
+        def fmt(val, spec):
+            return format(val, spec) if val is not None else "-"
+
+        print("{:<12} {:<20} {:>8} {:>8} {:>10} {:>10} {:>12} {:>10}".format(
+            "element", "factory", "buffers", "fps", "MB/s", "jitter ms", "latency ms", "max ms"))
+        for e in self.summary():
+            print("{:<12} {:<20} {:>8} {:>8} {:>10} {:>10} {:>12} {:>10}{}".format(
+                e["element"], e["factory"], e["buffers"], fmt(e["fps"], ".1f"),
+                fmt(e["bytes_per_s"] / 1e6 if e["bytes_per_s"] is not None else None, ".2f"),
+                fmt(e["jitter_ms"], ".2f"), fmt(e["latency_ms"], ".2f"), fmt(e["latency_max_ms"], ".2f"),
+                "  <- bottleneck" if e["bottleneck"] else ""))
+
+
 class CSIcamera:
     def __init__(self):
         # nvarguscamera properties
@@ -148,6 +643,11 @@ class CSIcamera:
 
         return -1
 
+    def settings_key(self):
+        # Hashable summary of the properties that have been set, identifies images taken with the same settings
+        return tuple((_dict.get("label", _dict.get("custom")), str(_dict["val"])) for _dict in self.cam_props
+                     if _dict["val"] is not None and _dict.get("label") not in ("name", "parent"))
+
     def set_resolution(self, width, height):
         idx = self.get_custom_index("resolution")
         self.cam_props[idx]["val"] = [width, height]
@@ -379,9 +879,10 @@ class VideoStream:
 
         self.duration = duration
         self.port = 5004
-        self.Gstobj = GstBackEnd()
+        self.Gstobj = GstBackEnd(name="video")
         self.cycles = 0
         self.output_res = [3280, 2464]
+        self.crop = None        # Crop rectangle of the camera image (see set_crop)
         self.hostip = None
         self.hls_playlist_length = None
         self.hls_max_files = None
@@ -391,6 +892,17 @@ class VideoStream:
         self.hls_loc = None
         self.encoder = None
         self.img_array = []
+        self.on_frame = None    # Called with a MappedFrame for every frame of the "opencv" sink instead of storing it
+        self.ring = None        # FrameRing holding the frames of the "opencv" sink (see set_ring_buffer)
+        self.ring_last = None
+        self.ring_view = False
+        self.frame_queue = None     # Hands frames to iter_frames
+        self.frame_stop = Event()
+        self.shared = None          # Shared memory publisher for worker processes (see publish_shared)
+        self.shared_name = None
+        self.shared_slots = 8
+        self.profiler = None        # PadProfiler when profiling is enabled
+        self.profile = None         # Per element summary of the last profiled stream
         if duration != 0:
             self.Gstobj.set_timer(self.duration)
         self.Gstobj.init()
@@ -420,6 +932,42 @@ class VideoStream:
     def set_output_resolution(self, width, height):
         self.output_res = [width, height]
 
+    def set_crop(self, left, top, right, bottom):
+        # Crop the camera image to the rectangle from (left, top) to (right, bottom) in pixels before it is scaled
+        # to the output resolution
+        self.crop = [left, top, right, bottom]
+
+    def clear_crop(self):
+        self.crop = None
+
+    def set_ring_buffer(self, capacity, policy=RingBuffer.DROP_OLDEST, last=None, view=False):
+        # Store frames of the "opencv" sink in a preallocated ring of capacity frames instead of an unbounded list
+        # policy - RingBuffer.DROP_OLDEST or RingBuffer.DROP_NEWEST when the ring is full
+        # last - number of most recent frames returned by start_stream (default all frames in the ring)
+        # view - return views into the ring instead of copies. Views are overwritten by the next stream
+        self.ring = FrameRing(capacity, policy=policy)
+        self.ring_last = last
+        self.ring_view = view
+
+    def publish_shared(self, name, slots=8):
+        # Publish every frame of the "opencv" sink to the shared memory segment name, where any number of worker
+        # processes can read them with sharedframes.SharedFrameReader.  The streaming thread never waits for the
+        # workers; a worker that falls behind skips frames.  Frames are not kept in the returned array unless a
+        # ring buffer, on_frame or iter_frames is also used
+        self.shared_name = name
+        self.shared_slots = slots
+
+    def enable_profiling(self, enable=True):
+        # Attach buffer probes to every element to measure per element latency, buffer rate, byte rate and jitter.
+        # The summary is printed at the end of each stream and stored in self.profile. Adds overhead per buffer
+        self.profiler = PadProfiler() if enable else None
+
+    def close_shared(self):
+        # Remove the shared memory segment once the workers are finished with it
+        if self.shared is not None:
+            self.shared.unlink()
+            self.shared = None
+
     def configure_udp_conn(self, host='', port=5000):
         self.hostip = host
         self.port = port
@@ -440,14 +988,29 @@ class VideoStream:
             self.Gstobj.init()
             self.img_array = []
 
-        self.create_elements()
+        if self.ring is not None:
+            self.ring.clear()
+
+        with REGISTRY.timer("pipeline_build_seconds", pipeline=self.Gstobj.name):
+            self.create_elements()
         StreamStatus.LOCAL_BUSY = True
         self.Gstobj.start()
         StreamStatus.LOCAL_BUSY = False
         self.cycles += 1
         print("Completed cleanup")
 
-        if self.APPSINK:
+        if self.profiler is not None:
+            self.profile = self.profiler.summary()
+            self.profiler.print_summary()
+            self.profiler = PadProfiler()
+
+        if self.APPSINK and self.ring is not None:
+            print("Ring buffer: {} frames stored, {} frames dropped".format(self.ring.written, self.ring.dropped))
+            REGISTRY.inc("frames_dropped_total", self.ring.dropped, pipeline=self.Gstobj.name, reason="ring")
+            if self.ring_view:
+                return self.ring.view(self.ring_last)
+            return self.ring.latest(self.ring_last)
+        elif self.APPSINK:
             return self.img_array
         else:
             return [self.outfile]
@@ -459,7 +1022,7 @@ class VideoStream:
         # Setup camera source element if enabled
         if self.CAMERASRC:
             # Create nvarguscamerasrc element
-            videosrc = Gst.ElementFactory.make('nvarguscamerasrc', 'camsrc')
+            videosrc = make_element('nvarguscamerasrc', 'camsrc')
 
             # Set properties for nvarguscamerasrc using linked camera object settings
             for _dict in self.csicam.cam_props:
@@ -470,24 +1033,25 @@ class VideoStream:
                     # Do not add "num-buffers" or "timeout" property for video, timing will be handled by GstObj
                     if val is not None:
                         if label != "num-buffers" and label != "timeout":
-                            videosrc.set_property(label, val)
+                            set_element_property(videosrc, label, val)
 
             # Create caps for videosrc
-            vidcaps = Gst.ElementFactory.make('capsfilter', 'vidcaps')
+            vidcaps = make_element('capsfilter', 'vidcaps')
             res = self.csicam.get_resolution()
             format = self.csicam.get_capture_format()
             rate = self.csicam.get_framerate()
             caps_str = 'video/x-raw(memory:NVMM), width=(int)' + str(res[0]) + ',' + ' height=(int)' + str(res[1]) + \
                        ',' + ' format=(string)' + format + ',' + ' framerate=(fraction)' + str(rate) + '/1'
             print(caps_str)
-            vidcaps.set_property('caps', Gst.caps_from_string(caps_str))
+            vidcaps.set_property('caps', camera_caps(caps_str))
 
             # Create nvvidconv element
-            nvidconv = Gst.ElementFactory.make('nvvidconv', 'convert')
-            nvidconv.set_property('flip-method', self.csicam.get_flip_method())
+            nvidconv = make_element('nvvidconv', 'convert')
+            set_element_property(nvidconv, 'flip-method', self.csicam.get_flip_method())
+            crop = crop_elements(nvidconv, self.crop, res)
 
             # Create output caps
-            outcaps = Gst.ElementFactory.make('capsfilter', 'outcaps')
+            outcaps = make_element('capsfilter', 'outcaps')
             caps_str = 'video/x-raw, width=(int)' + str(self.output_res[0]) + ',' + ' height=(int)' + str(self.output_res[1])
             print(caps_str)
             outcaps.set_property('caps', Gst.caps_from_string(caps_str))
@@ -495,55 +1059,40 @@ class VideoStream:
             # Add elements to list
             gst_elements.append(videosrc)
             gst_elements.append(vidcaps)
+            gst_elements.extend(crop)
             gst_elements.append(nvidconv)
             gst_elements.append(outcaps)
+            self.Gstobj.count_frames(outcaps.get_static_pad('src'))
 
         # Setup UDP source element if enabled
         elif self.UDPSRC:
             # Create udpsrc element
-            udpsrc = Gst.ElementFactory.make('udpsrc', 'udpsrc')
+            udpsrc = make_element('udpsrc', 'udpsrc')
 
             # Set properties for udpsrc
             udpsrc.set_property('port', self.port)
             udpsrc.set_property('caps', Gst.caps_from_string('application/x-rtp, encoding-name=H264, payload=96'))
 
             # Create remaining elements required for udpsrc
-            rtpdepay = Gst.ElementFactory.make('rtph264depay', 'depay')
-            parse = Gst.ElementFactory.make('h264parse', 'parse')
+            rtpdepay = make_element('rtph264depay', 'depay')
+            parse = make_element('h264parse', 'parse')
 
             gst_elements.append(udpsrc)
             gst_elements.append(rtpdepay)
             gst_elements.append(parse)
 
         # Configure encoder (only H264 encoders work presently)
-        if self.encoder == Camera.ENCODER_OMXH264:
-            encoder_str = "omxh264enc"
-        elif self.encoder == Camera.ENCODER_OMXH265:
-            encoder_str = "omxh265enc"
-        elif self.encoder == Camera.ENCODER_OMXVP8:
-            encoder_str = "omxvp8enc"
-        elif self.encoder == Camera.ENCODER_OMXVP9:
-            encoder_str = "omxvp9enc"
-        elif self.encoder == Camera.ENCODER_NVV4L2H264:
-            encoder_str = "nvv4l2h264enc"
-        elif self.encoder == Camera.ENCODER_NVV4L2H265:
-            encoder_str = "nvv4l2h265enc"
-        elif self.encoder == Camera.ENCODER_NVV4L2VP8:
-            encoder_str = "nvv4l2vp8enc"
-        elif self.encoder == Camera.ENCODER_NVV4L2VP9:
-            encoder_str = "nvv4l2vp9enc"
-        elif self.encoder is None:
-            encoder_str = "omxh264enc"
+        encoder_str = encoder_factory(self.encoder)
 
         if self.CAMERASRC:
             if self.FILESINK:
-                encoder = Gst.ElementFactory.make(encoder_str, 'encoder')
+                encoder = make_element(encoder_str, 'encoder')
                 gst_elements.append(encoder)
             elif self.UDPSINK:
-                encoder = Gst.ElementFactory.make(encoder_str, 'encoder')
-                encoder_caps = Gst.ElementFactory.make('capsfilter', 'enc_caps')
+                encoder = make_element(encoder_str, 'encoder')
+                encoder_caps = make_element('capsfilter', 'enc_caps')
                 encoder_caps.set_property('caps', Gst.caps_from_string('video/x-h264, stream-format=byte-stream'))
-                rtppay = Gst.ElementFactory.make('rtph264pay', 'rtp_pay')
+                rtppay = make_element('rtph264pay', 'rtp_pay')
 
                 gst_elements.append(encoder)
                 gst_elements.append(encoder_caps)
@@ -551,33 +1100,33 @@ class VideoStream:
 
         # Configure mux
         if self.FILESINK:
-            mux = Gst.ElementFactory.make('qtmux', 'mux')
+            mux = make_element('qtmux', 'mux')
             gst_elements.append(mux)
 
         elif self.HLSSINK:
-            mux = Gst.ElementFactory.make('mpegtsmux', 'mux')
+            mux = make_element('mpegtsmux', 'mux')
             gst_elements.append(mux)
 
         # Configure sink
         if self.FILESINK:
-            sink = Gst.ElementFactory.make('filesink', 'sink')
+            sink = make_element('filesink', 'sink')
             self.outfile = self.media_path + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '.mp4'
             sink.set_property('location', self.outfile)
 
         elif self.APPSINK:
-            sink = Gst.ElementFactory.make('appsink', 'sink')
+            sink = make_element('appsink', 'sink')
             sink.set_property('emit-signals', True)
             caps2 = Gst.caps_from_string('video/x-raw, format=(string)BGR')
             sink.set_property("caps", caps2)
             sink.connect("new-sample", self.new_buffer, sink)
 
         elif self.UDPSINK:
-            sink = Gst.ElementFactory.make('udpsink', 'sink')
+            sink = make_element('udpsink', 'sink')
             sink.set_property('host', self.hostip)
             sink.set_property('port', self.port)
 
         elif self.HLSSINK:
-            sink = Gst.ElementFactory.make('hlssink', 'sink')
+            sink = make_element('hlssink', 'sink')
             sink.set_property('playlist-length', self.hls_playlist_length)
             sink.set_property('max-files', self.hls_max_files)
             sink.set_property('target-duration', self.hls_target_duration)
@@ -599,39 +1148,131 @@ class VideoStream:
             else:
                 break
 
+        if self.profiler is not None:
+            self.profiler.attach(gst_elements)
+
         return
 
+    def iter_frames(self, max_queue=4, copy=False):
+        # Run the stream in the background and yield tuples of (timestamp, frame) from the "opencv" sink as they
+        # arrive. timestamp is the buffer PTS in nanoseconds
+        # max_queue - frames waiting for the consumer. The streaming thread blocks when the queue is full, so a slow
+        #             consumer slows the pipeline down instead of growing memory
+        # copy - yield independent arrays. Otherwise each frame is a view of the mapped buffer that is only valid
+        #        until the next iteration
+        # Leaving the loop early (break, exception or close()) shuts the pipeline down
+        if not self.APPSINK:
+            print("iter_frames requires the \"opencv\" sink...ignoring")
+            return
+
+        self.frame_queue = queue.Queue(max_queue)
+        self.frame_stop.clear()
+
+        def run():
+            try:
+                self.start_stream()
+            finally:
+                self.frame_queue.put(None)
+
+        thread = Thread(target=run, args=(), daemon=True)
+        thread.start()
+
+        finished = False
+        frame = None
+        try:
+            while True:
+                frame = self.frame_queue.get()
+                if frame is None:
+                    finished = True
+                    break
+                if copy:
+                    arr = frame.copy()
+                    frame.release()
+                    yield frame.pts, arr
+                else:
+                    yield frame.pts, frame.array
+                    frame.release()
+        finally:
+            if frame is not None:
+                frame.release()
+
+            # Stop the pipeline and release queued frames until the stream thread has finished
+            if not finished:
+                self.frame_stop.set()
+                self.Gstobj.quit()
+                while True:
+                    try:
+                        frame = self.frame_queue.get(timeout=1)
+                    except queue.Empty:
+                        self.Gstobj.quit()
+                        continue
+                    if frame is None:
+                        break
+                    frame.release()
+
+            thread.join()
+            self.frame_queue = None
+
     def new_buffer(self, sink, data):
         sample = sink.emit("pull-sample")
+
+        # Publish to worker processes
+        if self.shared_name is not None:
+            with MappedFrame(sample) as frame:
+                self.shared = publish_frame(self.shared, self.shared_name, self.shared_slots, frame)
+            if self.frame_queue is None and self.on_frame is None and self.ring is None:
+                return Gst.FlowReturn.OK
+
+        # Hand the mapped frame to iter_frames, blocking while the consumer is behind
+        if self.frame_queue is not None:
+            frame = MappedFrame(sample)
+            while not self.frame_stop.is_set():
+                try:
+                    self.frame_queue.put(frame, timeout=0.1)
+                    return Gst.FlowReturn.OK
+                except queue.Full:
+                    pass
+            frame.release()
+            return Gst.FlowReturn.OK
+
+        # Frames passed to on_frame are mapped views that are only valid for the duration of the call
+        if self.on_frame is not None:
+            with MappedFrame(sample) as frame:
+                self.on_frame(frame)
+            return Gst.FlowReturn.OK
+
+        # Copy straight from the mapped buffer into the preallocated ring
+        if self.ring is not None:
+            with MappedFrame(sample) as frame:
+                self.ring.push(frame.array, frame.pts)
+            return Gst.FlowReturn.OK
+
         arr = VideoStream.gst_to_opencv(sample)
         self.img_array.append(arr)
         return Gst.FlowReturn.OK
 
     @staticmethod
-    def gst_to_opencv(self, sample):
-        buf = sample.get_buffer()
-        caps = sample.get_caps()
-
-        arr = numpy.ndarray(
-            (caps.get_structure(0).get_value('height'),
-             caps.get_structure(0).get_value('width'), 3),
-            buffer=buf.extract_dup(0, buf.get_size()), dtype=numpy.uint8)
-
-        return arr
+    def gst_to_opencv(sample, copy=True):
+        return sample_to_array(sample, copy)
 
 
 class ImageStream:
     # Class for streaming images from nvarguscamerasrc to Jetson Nano (tested on R32.4.2)
     # The following source:sink combinations are currently available -
     # "camera":"file"
+    # "camera":"jpeg"  (JPEG encoded bytes returned in memory)
     # "camera":"opencv"  [not tested]
     # Note that the class is configured to collect a number of frames determined by self.delay_frames each time
     # a single image is collected.  The saved image is the last frame.  This allows the camera time to adjust to
     # lighting conditions and produces much better images.
+    # By default the first (self.delay_frames-1) frames are dropped before they reach the encoder and the last frame
+    # is pulled from an appsink into memory, so each image is encoded and written once.  Setting drop_warmup to False
+    # restores the previous behaviour of encoding every frame to self.tmppath.
 
     def __init__(self, frames, interval, sink=None):
         self.APPSINK = False
         self.FILESINK = False
+        self.JPEGSINK = False
         self.media_path = ""
         self.fnames_array = []
         self.outfile = ''
@@ -640,21 +1281,33 @@ class ImageStream:
             self.APPSINK = True
         elif sink == "file":
             self.FILESINK = True
+        elif sink == "jpeg":
+            self.JPEGSINK = True
 
         self.csicam = None
-        self.calc_framerate = round(frames/interval)
+        self.calc_framerate = round(frames/interval) if interval else 0
         self.tmppath = ""
         self.tmpname = "tmp%05d.jpg"
         self.frames = frames        # Total number of frames to collect
         self.interval = interval    # Interval between frames in seconds
         self.delay_frames = 20      # The first (self.delay_frames-1) frames are thrown away, the last one is saved
-        self.Gstobj = GstBackEnd()
+        self.drop_warmup = True     # Drop warm-up frames before encoding and keep the saved frame in memory
+        self.warmup_count = 0
+        self.jpeg = None            # Encoded bytes of the last captured image
+        self.on_image = None        # Called with each filename/image as soon as it has been captured
+        self.shared = None          # Shared memory publisher for worker processes (see publish_shared)
+        self.shared_name = None
+        self.shared_slots = 8
+        self.profiler = None        # PadProfiler when profiling is enabled
+        self.profile = None         # Per element summary of the last profiled series of images
+        self.Gstobj = GstBackEnd(name="image")
         self.cycles = 0
         self.img_array = []
         self.new_start = 0
         self.tnow = time.time()
         self.tinit = time.time()
         self.output_res = [1920, 1080]
+        self.crop = None            # Crop rectangle of the camera image (see set_crop)
         self.Gstobj.init()
 
     def connect_camera(self, cam):
@@ -673,6 +1326,14 @@ class ImageStream:
     def set_output_resolution(self, width, height):
         self.output_res = [width, height]
 
+    def set_crop(self, left, top, right, bottom):
+        # Crop the camera image to the rectangle from (left, top) to (right, bottom) in pixels before it is scaled
+        # to the output resolution and encoded
+        self.crop = [left, top, right, bottom]
+
+    def clear_crop(self):
+        self.crop = None
+
     def set_output_file(self, fpath):
         if not self.FILESINK:
             print("Object not configured to use a filesink...ignoring")
@@ -682,6 +1343,21 @@ class ImageStream:
     def set_frames(self, frames):
         self.frames = frames
 
+    def publish_shared(self, name, slots=8):
+        # Publish every image of the "opencv" sink to the shared memory segment name for worker processes
+        # (see VideoStream.publish_shared)
+        self.shared_name = name
+        self.shared_slots = slots
+
+    def enable_profiling(self, enable=True):
+        # Profile the pipelines of all images of a series (see VideoStream.enable_profiling)
+        self.profiler = PadProfiler() if enable else None
+
+    def close_shared(self):
+        if self.shared is not None:
+            self.shared.unlink()
+            self.shared = None
+
     def set_interval(self, interval):
         self.interval = interval
 
@@ -692,44 +1368,81 @@ class ImageStream:
 
         StreamStatus.LOCAL_BUSY = True
         while True:
+            # Sleep until the next frame is due, waking immediately if a kill is requested
             self.tnow = time.time()
-
-            if StreamStatus.LOCAL_KILL:
+            if StreamStatus.LOCAL_KILL.wait(max(0, self.interval - (self.tnow - self.tinit))):
                 StreamStatus.LOCAL_BUSY = False
-                StreamStatus.LOCAL_KILL = False
                 return self.fnames_array
 
-            if self.tnow - self.tinit >= self.interval:
-                self.tinit = time.time()
-                self.Gstobj.init()
+            self.tinit = time.time()
+            self.Gstobj.init()
+            with REGISTRY.timer("pipeline_build_seconds", pipeline=self.Gstobj.name):
                 self.create_elements()
-                self.Gstobj.start()
+            self.Gstobj.start()
+            if self.FILESINK or self.JPEGSINK:
                 self.extract_image()
-                self.cycles += 1
-                print("Completed cleanup")
-
-                if self.cycles == self.frames:
-                    self.cycles = 0
-                    self.new_start += 1
-                    if self.APPSINK:
-                        StreamStatus.LOCAL_BUSY = False
-                        return self.img_array
-                    elif self.FILESINK:
-                        StreamStatus.LOCAL_BUSY = False
-                        return self.fnames_array
+            self.emit_image()
+            self.cycles += 1
+            print("Completed cleanup")
+
+            if self.cycles == self.frames:
+                self.cycles = 0
+                self.new_start += 1
+                if self.profiler is not None:
+                    self.profile = self.profiler.summary()
+                    self.profiler.print_summary()
+                    self.profiler = PadProfiler()
+                if self.APPSINK or self.JPEGSINK:
+                    StreamStatus.LOCAL_BUSY = False
+                    return self.img_array
+                elif self.FILESINK:
+                    StreamStatus.LOCAL_BUSY = False
+                    return self.fnames_array
 
     def extract_image(self):
-        fname_base = self.tmpname.split('%')[0]
-        fname = self.tmppath + fname_base + '000' + str(self.delay_frames - 1) + '.jpg'
+        if self.drop_warmup or self.JPEGSINK:
+            if self.jpeg is None:
+                print("No image received from pipeline")
+            elif self.JPEGSINK:
+                self.img_array.append(self.jpeg)
+            else:
+                with open(self.fnames_array[-1], 'wb') as f:
+                    f.write(self.jpeg)
+            self.jpeg = None
+            return
+
+        fname = self.tmppath + (self.tmpname % (self.delay_frames - 1))
         os.rename(fname, self.fnames_array[-1])
-        os.system('rm -rf %s*' % self.tmppath)
+        for i in range(self.delay_frames - 1):
+            tmpfile = self.tmppath + (self.tmpname % i)
+            if os.path.exists(tmpfile):
+                os.remove(tmpfile)
+
+    def emit_image(self):
+        # Pass the image captured in this cycle to the on_image callback
+        if self.on_image is None:
+            return
+        if self.FILESINK:
+            if self.fnames_array and os.path.exists(self.fnames_array[-1]):
+                self.on_image(self.fnames_array[-1])
+        elif len(self.img_array) > self.cycles:
+            self.on_image(self.img_array[-1])
+
+    def drop_warmup_frames(self, pad, info):
+        # Buffer probe on the converter input. Only the last of the self.delay_frames frames is passed on
+        self.warmup_count += 1
+        if self.warmup_count < self.delay_frames:
+            REGISTRY.inc("frames_dropped_total", pipeline=self.Gstobj.name, reason="warmup")
+            return Gst.PadProbeReturn.DROP
+
+        return Gst.PadProbeReturn.OK
 
     def create_elements(self):
 
         gst_elements = []
 
         # Create nvarguscamerasrc element
-        videosrc = Gst.ElementFactory.make('nvarguscamerasrc', 'camsrc')
+        videosrc = make_element('nvarguscamerasrc', 'camsrc')
 
         # Set properties for nvarguscamerasrc using linked camera object settings
         for _dict in self.csicam.cam_props:
@@ -739,48 +1452,62 @@ class ImageStream:
 
                 # Override 'num-buffers' to only collect 20 frames
                 if label == "num-buffers":
-                    videosrc.set_property(label, self.delay_frames)
+                    set_element_property(videosrc, label, self.delay_frames)
                 elif label != "timeout" and val is not None:
-                    videosrc.set_property(label, val)
+                    set_element_property(videosrc, label, val)
 
         # Create caps for videosrc
-        vidcaps = Gst.ElementFactory.make('capsfilter', 'vidcaps')
+        vidcaps = make_element('capsfilter', 'vidcaps')
         res = self.csicam.get_resolution()
         format = self.csicam.get_capture_format()
         rate = self.csicam.get_framerate()
-        vidcaps.set_property('caps', Gst.caps_from_string('video/x-raw(memory:NVMM), width=(int)' + str(res[0])
+        vidcaps.set_property('caps', camera_caps('video/x-raw(memory:NVMM), width=(int)' + str(res[0])
                                                           + ',' + ' height=(int)' + str(res[1]) + ',' +
                                                           ' format=(string)' + format + ',' + ' framerate=(fraction)'
                                                           + str(rate) + '/1'))
 
         # Create nvvidconv element
-        nvidconv = Gst.ElementFactory.make('nvvidconv', 'convert')
-        nvidconv.set_property('flip-method', self.csicam.get_flip_method())
+        nvidconv = make_element('nvvidconv', 'convert')
+        set_element_property(nvidconv, 'flip-method', self.csicam.get_flip_method())
+        crop = crop_elements(nvidconv, self.crop, res)
+        if self.drop_warmup:
+            self.warmup_count = 0
+            nvidconv.get_static_pad('sink').add_probe(Gst.PadProbeType.BUFFER, self.drop_warmup_frames)
 
         # Create output caps
-        outcaps = Gst.ElementFactory.make('capsfilter', 'outcaps')
+        outcaps = make_element('capsfilter', 'outcaps')
         outcaps.set_property('caps', Gst.caps_from_string('video/x-raw, width=(int)' + str(self.output_res[0]) + ','
                                                           + ' height=(int)' + str(self.output_res[1])))
 
         # Add elements to list
         gst_elements.append(videosrc)
         gst_elements.append(vidcaps)
+        gst_elements.extend(crop)
         gst_elements.append(nvidconv)
         gst_elements.append(outcaps)
+        self.Gstobj.count_frames(outcaps.get_static_pad('src'))
 
         # Create encoder element
-        encoder = Gst.ElementFactory.make('nvjpegenc', 'encoder')
+        encoder = make_element('nvjpegenc', 'encoder')
         gst_elements.append(encoder)
 
         # Create sink
         if self.FILESINK:
-            sink = Gst.ElementFactory.make('multifilesink', 'sink')
             self.outfile = self.media_path + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '.jpg'
             self.fnames_array.append(self.outfile)
+
+        if self.JPEGSINK or (self.FILESINK and self.drop_warmup):
+            sink = make_element('appsink', 'sink')
+            sink.set_property('emit-signals', True)
+            sink.set_property('sync', False)
+            sink.connect("new-sample", self.new_jpeg, sink)
+
+        elif self.FILESINK:
+            sink = make_element('multifilesink', 'sink')
             sink.set_property('location', self.tmppath + self.tmpname)
-            
+
         elif self.APPSINK:
-            sink = Gst.ElementFactory.make('appsink', 'sink')
+            sink = make_element('appsink', 'sink')
             sink.set_property('emit-signals', True)
             caps2 = Gst.caps_from_string('video/x-raw, format=(string){BGR, GRAY8}')
             sink.set_property("caps", caps2)
@@ -800,24 +1527,290 @@ class ImageStream:
             else:
                 break
 
+        if self.profiler is not None:
+            self.profiler.attach(gst_elements)
+
         return
 
     def new_buffer(self, sink, data):
         sample = sink.emit("pull-sample")
+        if self.shared_name is not None:
+            with MappedFrame(sample) as frame:
+                self.shared = publish_frame(self.shared, self.shared_name, self.shared_slots, frame)
+
         arr = ImageStream.gst_to_opencv(sample)
         self.img_array.append(arr)
         return Gst.FlowReturn.OK
 
-    @staticmethod
-    def gst_to_opencv(self, sample):
+    def new_jpeg(self, sink, data):
+        sample = sink.emit("pull-sample")
         buf = sample.get_buffer()
-        caps = sample.get_caps()
+        self.jpeg = buf.extract_dup(0, buf.get_size())
+        return Gst.FlowReturn.OK
+
+    @staticmethod
+    def gst_to_opencv(sample, copy=True):
+        return sample_to_array(sample, copy)
 
-        arr = numpy.ndarray(
-            (caps.get_structure(0).get_value('height'),
-             caps.get_structure(0).get_value('width'), 3),
-            buffer=buf.extract_dup(0, buf.get_size()), dtype=numpy.uint8)
 
-        return arr
+class CaptureService:
+    # Keeps a single nvarguscamerasrc pipeline running and fans the camera out through a tee to branches that are
+    # attached and detached on demand (JPEG snapshot, mp4 recording, UDP/RTP stream, appsink).  Camera open, ISP
+    # initialisation and auto-exposure convergence are paid once when the service starts instead of per request,
+    # and branches can run concurrently (e.g. a snapshot can be taken during a recording)
+    # nvarguscamerasrc -> capsfilter -> tee -> queue -> <branch elements>
 
+    def __init__(self, cam):
+        self.csicam = cam
+        self.media_path = ""
+        self.encoder = None
+        self.Gstobj = GstBackEnd(watch_kill=False, name="capture")
+        self.tee = None
+        self.thread = None
+        self.branches = {}
+        self.branch_count = 0
+        self.lock = Lock()
+        self.start_timeout = 10     # Seconds to wait for the camera to reach PLAYING
+        self.pull_timeout = 5       # Seconds to wait for a snapshot or frame
 
+        # If required settings have not already be made on camera, set them here
+        if self.csicam.get_resolution() is None:
+            self.csicam.set_resolution(3280, 2464)
+        if self.csicam.get_capture_format() is None:
+            self.csicam.set_capture_format("NV12")
+        if self.csicam.get_framerate() is None:
+            self.csicam.set_framerate(20)
+        if self.csicam.get_flip_method() is None:
+            self.csicam.set_flip_method(2)
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        if self.is_running():
+            return
+
+        self.Gstobj.init()
+
+        # Create nvarguscamerasrc element
+        videosrc = make_element('nvarguscamerasrc', 'camsrc')
+        for _dict in self.csicam.cam_props:
+            if "label" in _dict:
+                label = _dict["label"]
+                val = _dict["val"]
+
+                # The source runs until the service is stopped
+                if val is not None and label != "num-buffers" and label != "timeout":
+                    set_element_property(videosrc, label, val)
+
+        # Create caps for videosrc
+        vidcaps = make_element('capsfilter', 'vidcaps')
+        res = self.csicam.get_resolution()
+        format = self.csicam.get_capture_format()
+        rate = self.csicam.get_framerate()
+        vidcaps.set_property('caps', camera_caps('video/x-raw(memory:NVMM), width=(int)' + str(res[0])
+                                                          + ',' + ' height=(int)' + str(res[1]) + ',' +
+                                                          ' format=(string)' + format + ',' + ' framerate=(fraction)'
+                                                          + str(rate) + '/1'))
+
+        # Branches are linked to request pads of the tee. Frames are dropped while no branch is attached
+        self.tee = make_element('tee', 'tee')
+        self.tee.set_property('allow-not-linked', True)
+
+        for elem in (videosrc, vidcaps, self.tee):
+            self.Gstobj.pipeline.add(elem)
+        videosrc.link(vidcaps)
+        vidcaps.link(self.tee)
+        self.Gstobj.count_frames(vidcaps.get_static_pad('src'))
+
+        self.Gstobj.pipeline.set_state(Gst.State.PLAYING)
+        self.thread = Thread(target=self.Gstobj.start, args=(), daemon=True)
+        self.thread.start()
+
+        ret, state, pending = self.Gstobj.pipeline.get_state(self.start_timeout * Gst.SECOND)
+        if ret == Gst.StateChangeReturn.FAILURE:
+            print("Capture service failed to start camera pipeline")
+            self.stop()
+            return
+        print("Capture service running")
+
+    def stop(self):
+        for bid in list(self.branches):
+            self.detach(bid)
+
+        # No sink is left to post EOS on the bus, so start() is released directly once the camera has EOS
+        self.Gstobj.quit()
+        self.Gstobj.finish()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.tee = None
+
+    def attach(self, elements, leaky=False):
+        # Add a branch of elements behind the tee. Returns a branch id used to detach it
+        # leaky - drop old buffers instead of blocking the camera when the branch falls behind
+        queue = make_element('queue', None)
+        if leaky:
+            queue.set_property('leaky', 2)
+            queue.set_property('max-size-buffers', 2)
+        branch = [queue] + elements
+
+        with self.lock:
+            self.branch_count += 1
+            bid = self.branch_count
+
+            for elem in branch:
+                self.Gstobj.pipeline.add(elem)
+            for i in range(len(branch) - 1):
+                branch[i].link(branch[i + 1])
+
+            # EOS is caught at the end of the branch so that it does not end the whole pipeline
+            eos = Event()
+            branch[-1].get_static_pad('sink').add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.branch_event, eos)
+
+            for elem in reversed(branch):
+                elem.sync_state_with_parent()
+
+            tee_pad = self.tee.get_request_pad('src_%u')
+            tee_pad.link(queue.get_static_pad('sink'))
+            self.branches[bid] = {"pad": tee_pad, "elements": branch, "eos": eos}
+
+        return bid
+
+    def detach(self, bid, eos=True):
+        # Unlink a branch from the tee and remove it from the pipeline
+        # eos - send EOS through the branch first so that muxers can finalise their output
+        with self.lock:
+            branch = self.branches.pop(bid, None)
+        if branch is None:
+            return
+
+        unlinked = Event()
+        queue_pad = branch["elements"][0].get_static_pad('sink')
+
+        def unlink(pad, info):
+            pad.unlink(queue_pad)
+            if eos:
+                queue_pad.send_event(Gst.Event.new_eos())
+            unlinked.set()
+            return Gst.PadProbeReturn.REMOVE
+
+        branch["pad"].add_probe(Gst.PadProbeType.IDLE, unlink)
+        unlinked.wait(self.pull_timeout)
+        if eos:
+            branch["eos"].wait(self.pull_timeout)
+
+        for elem in branch["elements"]:
+            elem.set_state(Gst.State.NULL)
+            self.Gstobj.pipeline.remove(elem)
+        self.tee.release_request_pad(branch["pad"])
+
+    @staticmethod
+    def branch_event(pad, info, eos):
+        if info.get_event().type == Gst.EventType.EOS:
+            eos.set()
+            return Gst.PadProbeReturn.DROP
+
+        return Gst.PadProbeReturn.OK
+
+    def make_converter(self, width, height, caps_str='video/x-raw', crop=None):
+        # nvvidconv and output caps at the requested resolution
+        # crop - optional (left, top, right, bottom) rectangle of the camera image, see crop_elements
+        nvidconv = make_element('nvvidconv', None)
+        set_element_property(nvidconv, 'flip-method', self.csicam.get_flip_method())
+        elements = crop_elements(nvidconv, crop, self.csicam.get_resolution())
+        outcaps = make_element('capsfilter', None)
+        outcaps.set_property('caps', Gst.caps_from_string(caps_str + ', width=(int)' + str(width) + ','
+                                                          + ' height=(int)' + str(height)))
+        return elements + [nvidconv, outcaps]
+
+    def snapshot(self, width=1920, height=1080, crop=None):
+        # Returns JPEG encoded bytes of the next camera frame, or None on timeout
+        # crop - optional (left, top, right, bottom) rectangle of the camera image, also accepted by the other
+        #        branches
+        encoder = make_element('nvjpegenc', None)
+        sink = make_element('appsink', None)
+        sink.set_property('max-buffers', 1)
+        sink.set_property('drop', True)
+        sink.set_property('sync', False)
+
+        bid = self.attach(self.make_converter(width, height, crop=crop) + [encoder, sink], leaky=True)
+        sample = sink.emit('try-pull-sample', self.pull_timeout * Gst.SECOND)
+        self.detach(bid, eos=False)
+
+        if sample is None:
+            return None
+        buf = sample.get_buffer()
+        return buf.extract_dup(0, buf.get_size())
+
+    def save_snapshot(self, width=1920, height=1080, fpath=None, crop=None):
+        # Write a snapshot to fpath (default: timestamped jpg in media path). Returns the filename or None
+        data = self.snapshot(width, height, crop)
+        if data is None:
+            return None
+        if fpath is None:
+            fpath = self.media_path + datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f') + '.jpg'
+        with open(fpath, 'wb') as f:
+            f.write(data)
+        return fpath
+
+    def frame(self, width=1920, height=1080, crop=None):
+        # Returns the next camera frame as a BGR numpy array, or None on timeout
+        sink = make_element('appsink', None)
+        sink.set_property('max-buffers', 1)
+        sink.set_property('drop', True)
+        sink.set_property('sync', False)
+        sink.set_property('caps', Gst.caps_from_string('video/x-raw, format=(string)BGR'))
+
+        elements = self.make_converter(width, height, 'video/x-raw, format=(string)BGRx', crop)
+        elements += [make_element('videoconvert', None), sink]
+        bid = self.attach(elements, leaky=True)
+        sample = sink.emit('try-pull-sample', self.pull_timeout * Gst.SECOND)
+        self.detach(bid, eos=False)
+
+        if sample is None:
+            return None
+        return sample_to_array(sample)
+
+    def record(self, width=1920, height=1080, fpath=None, crop=None):
+        # Start recording mp4 to fpath (default: timestamped mp4 in media path)
+        # Returns tuple of branch id, filename. Call detach(bid) to stop and finalise the file
+        if fpath is None:
+            fpath = self.media_path + datetime.now().strftime('%Y-%m-%d %H:%M:%S') + '.mp4'
+        encoder = make_element(encoder_factory(self.encoder), None)
+        mux = make_element('qtmux', None)
+        sink = make_element('filesink', None)
+        sink.set_property('location', fpath)
+
+        bid = self.attach(self.make_converter(width, height, crop=crop) + [encoder, mux, sink])
+        return bid, fpath
+
+    def stream_udp(self, host, port, width=1920, height=1080, crop=None):
+        # Start an RTP/H264 stream to host:port. Returns branch id. Call detach(bid) to stop
+        encoder = make_element(encoder_factory(self.encoder), None)
+        encoder_caps = make_element('capsfilter', None)
+        encoder_caps.set_property('caps', Gst.caps_from_string('video/x-h264, stream-format=byte-stream'))
+        rtppay = make_element('rtph264pay', None)
+        sink = make_element('udpsink', None)
+        sink.set_property('host', host)
+        sink.set_property('port', port)
+
+        return self.attach(self.make_converter(width, height, crop=crop) + [encoder, encoder_caps, rtppay, sink],
+                           leaky=True)
+
+    def add_appsink(self, callback, width=1920, height=1080, crop=None):
+        # Call callback(sample) from the streaming thread for every BGR frame. Returns branch id
+        sink = make_element('appsink', None)
+        sink.set_property('emit-signals', True)
+        sink.set_property('sync', False)
+        sink.set_property('caps', Gst.caps_from_string('video/x-raw, format=(string)BGR'))
+
+        def new_sample(appsink):
+            callback(appsink.emit("pull-sample"))
+            return Gst.FlowReturn.OK
+
+        sink.connect("new-sample", new_sample)
+
+        elements = self.make_converter(width, height, 'video/x-raw, format=(string)BGRx', crop)
+        elements += [make_element('videoconvert', None), sink]
+        return self.attach(elements, leaky=True)